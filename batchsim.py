@@ -0,0 +1,264 @@
+#
+# Copyright 2011-2015 Jeff Bush
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+#
+# Runs many copies of the same program at once, each with its own machine
+# state, using NumPy.  This is useful for sweeping a program over a range of
+# inputs (initial memory contents or the values returned by hardware register
+# reads).  Requires NumPy, which the rest of the tools do not.
+#
+# Instances are stepped together, one instruction per step.  When control
+# flow diverges, instances are grouped by the opcode they are executing
+# rather than by address, so instances at different points in the program
+# still execute in the same vectorized operation.  The cycle counts for each
+# instance match what simulator.Simulator would report for the same inputs.
+#
+# Unlike simulator.Simulator, data memory is exactly memSize words and
+# addresses wrap around at that size.
+#
+
+import numpy as np
+from simulator import *
+
+NUM_OPCODES = 32
+
+# Total cycles and cycles per state, indexed by opcode
+OPCODE_CYCLES = np.array([ len(getInstructionStates(op)) for op in range(NUM_OPCODES) ],
+	dtype=np.int64)
+OPCODE_STATE_CYCLES = np.zeros((NUM_OPCODES, len(STATE_NAMES)), dtype=np.int64)
+for _op in range(NUM_OPCODES):
+	for _state in getInstructionStates(_op):
+		OPCODE_STATE_CYCLES[_op, _state] += 1
+
+class BatchSimulator:
+	def __init__(self, program, numInstances, memSize=MEM_SIZE, numRegisters=16, data=None):
+		if memSize & (memSize - 1):
+			raise Exception('memory size must be a power of two')
+
+		self.numInstances = numInstances
+		self.memSize = memSize
+		self.addressMask = memSize - 1
+		self.numRegisters = numRegisters
+		self.rom = np.zeros(0x10000, dtype=np.int64)
+		self.rom[:len(program)] = program
+
+		# Machine state for each instance.  Callers may modify these before
+		# calling run to set up different initial conditions.
+		self.ip = np.zeros(numInstances, dtype=np.int64)
+		self.sp = np.full(numInstances, (memSize - 8) & 0xffff, dtype=np.int64)
+		self.bp = np.full(numInstances, (memSize - 4) & 0xffff, dtype=np.int64)
+		self.tos = np.zeros(numInstances, dtype=np.int64)
+		self.memory = np.zeros((numInstances, memSize), dtype=np.int64)
+		if data:
+			self.memory[:, :len(data)] = data
+
+		# Values returned when an instance reads a hardware register, and the
+		# last value each instance wrote to a register.  Accesses to register
+		# indices beyond numRegisters read as zero and writes are dropped.
+		self.registerReadValues = np.zeros((numInstances, numRegisters), dtype=np.int64)
+		self.registerWriteValues = np.zeros((numInstances, numRegisters), dtype=np.int64)
+
+		# Values written to register 0, which testbench.v prints to the console.
+		self.outputBuffer = np.zeros((numInstances, 64), dtype=np.int64)
+		self.outputLength = np.zeros(numInstances, dtype=np.int64)
+
+		self.halted = np.zeros(numInstances, dtype=bool)
+		self.cycles = np.zeros(numInstances, dtype=np.int64)
+		self.stateCycles = np.zeros((numInstances, len(STATE_NAMES)), dtype=np.int64)
+		self.instructionCount = np.zeros(numInstances, dtype=np.int64)
+
+	def getOutput(self, instance):
+		values = self.outputBuffer[instance, :self.outputLength[instance]]
+		return ''.join([ chr(value & 0xff) for value in values ])
+
+	#
+	# Run until every instance has halted or run for at least maxCycles.
+	# Returns the halted flags.
+	#
+	def run(self, maxCycles=DEFAULT_MAX_CYCLES):
+		while self.step(maxCycles):
+			pass
+
+		return self.halted
+
+	#
+	# Execute one instruction in every instance that is still running.
+	# Returns False if there were none.
+	#
+	def step(self, maxCycles=DEFAULT_MAX_CYCLES):
+		active = np.nonzero(~self.halted & (self.cycles < maxCycles))[0]
+		if len(active) == 0:
+			return False
+
+		ips = self.ip[active]
+		words = self.rom[ips]
+		opcodes = words >> 16
+		params = words & 0xffff
+		for op in np.unique(opcodes):
+			group = opcodes == op
+			self.execute(int(op), active[group], params[group], ips[group])
+
+		return True
+
+	def execute(self, op, instances, param, ip):
+		if op == OP_GOTO:
+			# A branch to itself is the halt loop at the end of main
+			halting = param == ip
+			self.halted[instances[halting]] = True
+			instances = instances[~halting]
+			param = param[~halting]
+			ip = ip[~halting]
+
+		mem = self.memory
+		mask = self.addressMask
+		sp = self.sp[instances]
+		bp = self.bp[instances]
+		tos = self.tos[instances]
+		nextIp = (ip + 1) & 0xffff
+
+		if op == OP_PUSH:
+			sp = (sp - 1) & 0xffff
+			mem[instances, sp & mask] = tos
+			tos = param
+		elif op == OP_GETLOCAL:
+			sp = (sp - 1) & 0xffff
+			mem[instances, sp & mask] = tos
+			tos = mem[instances, (bp + param) & mask]
+		elif op == OP_SETLOCAL:
+			mem[instances, (bp + param) & mask] = tos
+		elif op == OP_POP:
+			tos = mem[instances, sp & mask]
+			sp = (sp + 1) & 0xffff
+		elif op == OP_BFALSE:
+			nextIp = np.where((tos & 0xffff) == 0, param, nextIp)
+			tos = mem[instances, sp & mask]
+			sp = (sp + 1) & 0xffff
+		elif op == OP_GOTO:
+			nextIp = param
+		elif op == OP_LOAD:
+			tos = self.readMemory(instances, tos & 0xffff)
+		elif op == OP_REST:
+			tos = self.readMemory(instances, (tos + 1) & 0xffff)
+		elif op == OP_STORE:
+			value = mem[instances, sp & mask]
+			self.writeMemory(instances, tos & 0xffff, value)
+			tos = value
+			sp = (sp + 1) & 0xffff
+		elif op == OP_CALL:
+			sp = (sp - 1) & 0xffff
+			mem[instances, sp & mask] = bp
+			nextIp = tos & 0xffff
+			tos = (ip + 1) & 0xffff
+			bp = sp
+		elif op == OP_RETURN:
+			nextIp = mem[instances, (bp - 1) & mask] & 0xffff
+			sp = (bp + 1) & 0xffff
+			bp = mem[instances, bp & mask] & 0xffff
+		elif op == OP_RESERVE:
+			reserving = param != 0
+			mem[instances[reserving], (sp[reserving] - 1) & mask] = tos[reserving]
+			sp = (sp - param) & 0xffff
+		elif op == OP_CLEANUP:
+			sp = (sp + param) & 0xffff
+		elif op == OP_DUP:
+			sp = (sp - 1) & 0xffff
+			mem[instances, sp & mask] = tos
+		elif op == OP_GETTAG:
+			tos = (tos >> 16) & 7
+		elif op == OP_SETTAG:
+			tos = ((mem[instances, sp & mask] & 7) << 16) | (tos & 0xffff)
+			sp = (sp + 1) & 0xffff
+		elif op == OP_GETBP:
+			sp = (sp - 1) & 0xffff
+			mem[instances, sp & mask] = tos
+			tos = bp
+		elif op in ALU_OPS:
+			tos = (tos & 0x70000) | self.aluOp(op, tos & 0xffff,
+				mem[instances, sp & mask] & 0xffff)
+			sp = (sp + 1) & 0xffff
+
+		# else: NOP or unknown instruction
+
+		self.ip[instances] = nextIp
+		self.sp[instances] = sp
+		self.bp[instances] = bp
+		self.tos[instances] = tos
+		self.cycles[instances] += OPCODE_CYCLES[op]
+		self.stateCycles[instances] += OPCODE_STATE_CYCLES[op]
+		self.instructionCount[instances] += 1
+
+	def aluOp(self, op, op0, op1):
+		diff = (op0 - op1) & 0xffff
+		if op == OP_ADD:
+			return (op0 + op1) & 0xffff
+		elif op == OP_SUB:
+			return diff
+		elif op == OP_GTR:
+			return (((diff & 0x8000) == 0) & (diff != 0)).astype(np.int64)
+		elif op == OP_GTE:
+			return ((diff & 0x8000) == 0).astype(np.int64)
+		elif op == OP_EQ:
+			return (diff == 0).astype(np.int64)
+		elif op == OP_NEQ:
+			return (diff != 0).astype(np.int64)
+		elif op == OP_AND:
+			return op0 & op1
+		elif op == OP_OR:
+			return op0 | op1
+		elif op == OP_XOR:
+			return op0 ^ op1
+		elif op == OP_LSHIFT:
+			return np.where(op1 < 16, (op0 << np.minimum(op1, 15)) & 0xffff, 0)
+		elif op == OP_RSHIFT:
+			return np.where(op1 < 16, op0 >> np.minimum(op1, 15), 0)
+
+	def readMemory(self, instances, address):
+		value = self.memory[instances, address & self.addressMask]
+		isRegister = (address & REGISTER_BASE) == REGISTER_BASE
+		if isRegister.any():
+			index = address[isRegister] & 0xfff
+			valid = index < self.numRegisters
+			registerValue = np.zeros(len(index), dtype=np.int64)
+			registerValue[valid] = self.registerReadValues[instances[isRegister][valid],
+				index[valid]] & 0xffff
+			value[isRegister] = registerValue
+
+		return value
+
+	def writeMemory(self, instances, address, value):
+		isRegister = (address & REGISTER_BASE) == REGISTER_BASE
+		isMemory = ~isRegister
+		self.memory[instances[isMemory], address[isMemory] & self.addressMask] = value[isMemory]
+		if isRegister.any():
+			instances = instances[isRegister]
+			index = address[isRegister] & 0xfff
+			value = value[isRegister] & 0xffff
+			valid = index < self.numRegisters
+			self.registerWriteValues[instances[valid], index[valid]] = value[valid]
+
+			printing = index == 0
+			self.appendOutput(instances[printing], value[printing])
+
+	def appendOutput(self, instances, value):
+		if len(instances) == 0:
+			return
+
+		if self.outputLength[instances].max() >= self.outputBuffer.shape[1]:
+			self.outputBuffer = np.concatenate((self.outputBuffer,
+				np.zeros_like(self.outputBuffer)), axis=1)
+
+		self.outputBuffer[instances, self.outputLength[instances]] = value
+		self.outputLength[instances] += 1
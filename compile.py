@@ -15,11 +15,22 @@
 # limitations under the License.
 # 
 
-import sys, shlex, copy, math
+import sys, os, shlex, copy, math, time, argparse, json, StringIO
 
 TAG_INTEGER = 0		# Make this zero because types default to this when pushed
 TAG_CONS = 1
 TAG_FUNCTION = 2
+TAG_VECTOR = 3
+
+OBJECT_VERSION = 8
+OBJECT_EXTENSION = '.obj'
+
+# Variables the compiler creates and sets at the start of main, in order
+BUILTIN_VARIABLES = ( '$heapstart', '$datastart', '$stackdepth' )
+
+# Stack space added to $stackdepth for programs with recursion, since the
+# depth of that can't be determined by the compiler.
+RECURSION_STACK_WORDS = 1024
 
 OP_NOP = 0
 OP_CALL = 1
@@ -69,17 +80,99 @@ class Label:
 		self.defined = False
 		self.address = 0
 
+#
+# Constant cons cells for quoted lists and string literals.  These are placed
+# in data memory after the global variables and are loaded along with the
+# program, so no code runs to create them.  Each word is a ( tag, value )
+# tuple.  If the tag is TAG_CONS or TAG_VECTOR, value is the offset of a cell
+# or vector in the segment.  Identical lists share cells, as do the common
+# tails of different lists.  Vectors have the same layout as ones allocated
+# by make-vector in runtime.lisp (which never frees these).
+#
+class DataSegment:
+	def __init__(self):
+		self.words = []
+		self.cells = {}			# ( first, rest ) -> offset of cons cell
+		self.vectors = {}		# tuple of elements -> offset of vector
+		self.pointers = {}		# offset of cons cell or vector -> offset of word that points to it
+
+	def addCell(self, first, rest):
+		key = ( first, rest )
+		if key not in self.cells:
+			self.cells[key] = len(self.words)
+			self.words += [ first, rest ]
+
+		return ( TAG_CONS, self.cells[key] )
+
+	# Length, link to the next vector (unused), then the elements
+	def addVector(self, elements):
+		key = tuple(elements)
+		if key not in self.vectors:
+			self.vectors[key] = len(self.words)
+			self.words += [ ( TAG_INTEGER, len(elements) ), ( TAG_INTEGER, 0 ) ] + elements
+
+		return ( TAG_VECTOR, self.vectors[key] )
+
+	# Offset of a word that contains a pointer to the cell or vector.  Loading this
+	# puts the pointer on the stack with its tag.
+	def getPointer(self, cell):
+		offset = cell[1]
+		if offset not in self.pointers:
+			self.pointers[offset] = len(self.words)
+			self.words += [ cell ]
+
+		return self.pointers[offset]
+
+	def getImage(self, baseAddress):
+		image = []
+		for tag, value in self.words:
+			if tag == TAG_CONS or tag == TAG_VECTOR:
+				value += baseAddress
+
+			image += [ (tag << 16) | (value & 0xffff) ]
+
+		return image
+
+	def save(self):
+		return {
+			'words' : self.words,
+			'cells' : [ ( first, rest, offset ) for ( first, rest ), offset in self.cells.items() ],
+			'vectors' : self.vectors.items(),
+			'pointers' : self.pointers.items()
+		}
+
+	def load(self, info):
+		self.words = [ tuple(word) for word in info['words'] ]
+		self.cells = dict([ ( ( tuple(first), tuple(rest) ), offset )
+			for first, rest, offset in info['cells'] ])
+		self.vectors = dict([ ( tuple([ tuple(element) for element in elements ]), offset )
+			for elements, offset in info['vectors'] ])
+		self.pointers = dict(info['pointers'])
+
+# A global fixup target for the address of a word in the data segment
+class DataAddress:
+	def __init__(self, offset):
+		self.offset = offset
+
 class Function:
 	def __init__(self):
 		self.name = None
 		self.localFixups = []
 		self.baseAddress = 0
-		self.referenced = False		# Used to strip dead functions
-		self.numLocalVariables = 0
+		self.instructionsRemoved = 0	# By the peephole optimizer
+		self.cyclesRemoved = 0
+		self.controlFlowRemoved = 0		# Instructions removed by optimizeControlFlow
+		self.numLocalVariables = 0		# Slots in the frame
+		self.nextLocalVariable = 0		# Next free slot
 		self.instructions = []		# Each entry is a word
 		self.environment = [{}]		# Stack of scopes
+		self.scopeStarts = []		# nextLocalVariable when each scope was entered
 		self.closureVars = []
 		self.enclosingFunction = None
+		self.numParams = 0
+		self.parameters = []		# Symbols, in order
+		self.frameCleanups = []		# ( offset, extra ), see emitFrameCleanup
+		self.tailCallSlots = None
 
 		# Save a spot for an initial 'reserve' instruction
 		self.emitInstruction(OP_RESERVE, 0)
@@ -96,9 +189,13 @@ class Function:
 
 	def enterScope(self):
 		self.environment += [{}]
+		self.scopeStarts += [ self.nextLocalVariable ]
 
+	# Variables declared in the scope can't be referenced after this, so
+	# variables declared later can use their slots.
 	def exitScope(self):
 		self.environment.pop()
+		self.nextLocalVariable = self.scopeStarts.pop()
 		
 	def lookupLocalVariable(self, name):
 		for scope in reversed(self.environment):
@@ -110,14 +207,40 @@ class Function:
 	def reserveLocalVariable(self, name):
 		sym = Symbol(Symbol.LOCAL_VARIABLE)
 		self.environment[-1][name] = sym
-		sym.index = -(self.numLocalVariables + 2)	# Skip return address and base pointer
-		self.numLocalVariables += 1
+		sym.index = -(self.nextLocalVariable + 2)	# Skip return address and base pointer
+		self.nextLocalVariable += 1
+		self.numLocalVariables = max(self.numLocalVariables, self.nextLocalVariable)
 		return sym
 
+	# Allocates a slot after all of the ones used so far.  A variable declared
+	# later may share it.
+	def reserveTemporary(self):
+		index = -(self.numLocalVariables + 2)
+		self.numLocalVariables += 1
+		return index
+
+	#
+	# Local variable slots used by tail calls through function pointers (see
+	# Compiler.compileTailCall).  Neither may be the first local variable slot,
+	# and the second may not be the second slot either, since the code that
+	# reads them pushes into those locations first.  Variables declared later
+	# may share these slots.  That's safe, since they are only written by a
+	# tail call, after which nothing else in the function runs.
+	#
+	def getTailCallSlots(self):
+		if not self.tailCallSlots:
+			if self.numLocalVariables == 0:
+				self.reserveTemporary()		# Padding
+
+			self.tailCallSlots = ( self.reserveTemporary(), self.reserveTemporary() )
+
+		return self.tailCallSlots
+
 	def reserveParameter(self, name, index):
 		sym = Symbol(Symbol.LOCAL_VARIABLE)
 		self.environment[-1][name] = sym
 		sym.index = index + 1
+		self.parameters += [ sym ]
 
 	def getProgramAddress(self):
 		return len(self.instructions)
@@ -141,6 +264,20 @@ class Function:
 
 		self.instructions += [ (op << 16) | param]
 
+	#
+	# Emit a cleanup that removes this function's local variables, plus
+	# 'extra' more stack slots.  The number of local variables isn't known
+	# until the whole function is compiled, so it is patched afterward by
+	# performFrameFixups.
+	#
+	def emitFrameCleanup(self, extra):
+		self.emitInstruction(OP_CLEANUP, 0)
+		self.frameCleanups += [ ( self.getProgramAddress() - 1, extra ) ]
+
+	def performFrameFixups(self):
+		for offset, extra in self.frameCleanups:
+			self.patch(offset, self.numLocalVariables + extra)
+
 	def patch(self, offset, value):
 		self.instructions[offset] &= ~0xffff
 		self.instructions[offset] |= (value & 0xffff)
@@ -162,10 +299,18 @@ class Parser:
 		self.lexer = None
 		self.program = []
 		self.filename = None
+		self.warnings = []
 
 	def parseFile(self, filename):
-		self.filename = filename
 		stream = open(filename, 'r')
+		self.parseStream(stream, filename)
+		stream.close()
+
+	def parseString(self, text, filename='<string>'):
+		self.parseStream(StringIO.StringIO(text), filename)
+
+	def parseStream(self, stream, filename):
+		self.filename = filename
 		self.lexer = shlex.shlex(stream)
 		self.lexer.commenters = ';'
 		self.lexer.quotes = '"'
@@ -177,15 +322,13 @@ class Parser:
 				break
 				
 			self.program += [ expr ]
-			
-		stream.close()
 
 	def parseParenList(self):
 		list = []
 		while True:
 			lookahead = self.lexer.get_token()
 			if lookahead == '':
-				print 'missing )'
+				self.warnings += [ 'missing ), ' + self.filename + ':' + str(self.lexer.lineno) ]
 				break
 			elif lookahead == ')':
 				break
@@ -208,6 +351,14 @@ class Parser:
 			return [ 'unquote', self.parseExpr() ]
 		elif token == '(':
 			return self.parseParenList()
+		elif token == '#':
+			# #"text" is a string stored in a vector
+			string = self.lexer.get_token()
+			if string[:1] != '"':
+				raise Exception('expected string after #, ' + self.filename + ':'
+					+ str(self.lexer.lineno))
+
+			return '#' + string
 		elif token.isdigit() or (token[0] == '-' and len(token) > 1):
 			return int(token)
 		elif token == ')':
@@ -219,17 +370,50 @@ class Parser:
 		return self.program
 
 class Compiler:
-	def __init__(self):
+	def __init__(self, inlineCons=False):
 		self.globals = {}
-		self.currentFunction = Function()
-		self.functionList = [ 0 ]		# We reserve a spot for 'main'
 		self.breakStack = []
+		self.warnings = []
+		self.inlineCons = inlineCons	# Expand calls to cons, see compileConsIntrinsic
 
 		# Can be a fixup for:
 		#   - A global variable 
 		#   - A function pointer
 		# Each stores ( function, functionOffset, target )
 		self.globalFixups = []	
+		self.dataSegment = DataSegment()
+
+		# Set by removeUnreachable when the program is linked
+		self.removedFunctions = []
+		self.removedGlobals = []
+		self.romWordsSaved = 0
+		self.dataWordsSaved = 0
+		self.functionSlotsSaved = 0
+
+		# Set by findStackDepth when the program is linked
+		self.stackDepths = {}		# Function -> words of stack used, including callees
+		self.recursiveFunctions = []
+		self.stackDepth = 0			# Words used below main's frame
+		self.stackLimit = 0			# Value of $stackdepth
+
+		# All code not in function blocks will be emitted into an implicitly
+		# created dummy function 'main'.  It is the first code emitted, since
+		# that's where execution will start.
+		self.currentFunction = Function()
+		self.currentFunction.name = '<main>'
+		self.functionList = [ self.currentFunction ]
+
+		# create built-in variables that indicate where the heap and the
+		# constant data segment start, and how much memory below the top of
+		# the stack the program may use (will be patched at the end of
+		# compilation with the proper values)
+		for name in BUILTIN_VARIABLES:
+			variable = self.lookupSymbol(name)
+			variable.initialized = True
+			self.currentFunction.emitInstruction(OP_PUSH, 0)
+			self.currentFunction.emitInstruction(OP_PUSH, variable.index)
+			self.currentFunction.emitInstruction(OP_STORE);
+			self.currentFunction.emitInstruction(OP_POP);
 
 	# 
 	# Lookup a symbol, starting in the current scope and working backward
@@ -298,23 +482,34 @@ class Compiler:
 		return sym
 
 	#
-	# Top level compile function.  All code not in function blocks will be 
-	# emitted into an implicitly created dummy function 'main'
+	# True if name refers to a function defined at the top level.  Unlike
+	# lookupSymbol, this does not create a global variable if the name is not
+	# defined yet.
 	#
-	def compile(self, program):
-		self.currentFunction = Function()
-		self.currentFunction.referenced = True
-		self.currentFunction.name = '<main>'
+	def isGlobalFunction(self, name):
+		func = self.currentFunction
+		while func != None:
+			if func.lookupLocalVariable(name) != None:
+				return False
 
-		# create a built-in variable that indicates where the heap starts
-		# (will be patched at the end of compilation with the proper address)
-		heapstart = self.lookupSymbol('$heapstart')
-		heapstart.initialized = True
-		self.currentFunction.emitInstruction(OP_PUSH, 0)
-		self.currentFunction.emitInstruction(OP_PUSH, 0)
-		self.currentFunction.emitInstruction(OP_STORE);
-		self.currentFunction.emitInstruction(OP_POP);
+			func = func.enclosingFunction
+
+		return name in self.globals and self.globals[name].type == Symbol.FUNCTION
+
+	#
+	# Top level compile function.  Compiles the program and links it into a
+	# list of instruction words.
+	#
+	def compile(self, program):
+		self.compileModule(program)
+		return self.link()
 
+	#
+	# Compile top level expressions and functions.  This may be called after
+	# loadObject, in which case the program can reference anything defined
+	# in the object.
+	#
+	def compileModule(self, program):
 		for expr in program:
 			if expr[0] == 'function':
 				self.compileFunction(expr)
@@ -322,17 +517,30 @@ class Compiler:
 				self.compileExpression(expr)
 				self.currentFunction.emitInstruction(OP_POP) # Clean up stack
 
+	#
+	# Lay out functions in program memory, resolve references between them,
+	# and return the program image.  Nothing more can be compiled afterward.
+	#
+	def link(self):
+		main = self.functionList[0]
+
 		# Put an infinite loop at the end 
-		forever = self.currentFunction.generateLabel()
-		self.currentFunction.emitLabel(forever)
-		self.currentFunction.emitBranchInstruction(OP_GOTO, forever)
-		
-		# The top level code (which looks like a function) is the first code
-		# emitted, since that's where execution will start
-		self.functionList[0] = self.currentFunction
+		forever = main.generateLabel()
+		main.emitLabel(forever)
+		main.emitBranchInstruction(OP_GOTO, forever)
 
-		# Strip out functions that aren't called
-		self.functionList = filter(lambda x: x.referenced, self.functionList)
+		self.removeUnreachable()
+		self.findStackDepth()
+
+		# Fix up the built-in variables (we know $heapstart is set by the push
+		# right after reserve, and each of the others four instructions after
+		# the previous one).  The data segment follows the global variables,
+		# and the heap follows the data segment.
+		main.patch(1, self.dataStart + len(self.dataSegment.words))
+		main.patch(5, self.dataStart)
+		main.patch(9, self.stackLimit)
+
+		self.optimizeFunctions()
 
 		# Need to determine where functions are in memory
 		self.codeLength = 0
@@ -346,29 +554,6 @@ class Compiler:
 
 		self.performGlobalFixups()
 
-		# Fix up the global variable size table (we know it is the push right
-		# after reserve)
-		self.functionList[0].patch(1, len(self.globals))
-
-		# For debugging: create a listing of the instructions used.
-		listfile = open('program.lst', 'wb')
-
-		# Write out table of global variables
-		listfile.write('Globals:\n')
-		for var in self.globals:
-			sym = self.globals[var]
-			if sym.type != Symbol.FUNCTION:
-				listfile.write(' ' + var + ' var@' + str(sym.index) + '\n')
-
-		for func in self.functionList:
-			listfile.write('\nfunction ' + str(func.name) + '\n')
-			disassemble(listfile, func.instructions, func.baseAddress)
-
-		# Write out expanded expressions
-		prettyPrintSExpr(listfile, program, 0)
-
-		listfile.close()
-		
 		# Now consolidate the functions
 		instructions = []
 		for func in self.functionList:
@@ -376,6 +561,347 @@ class Compiler:
 		
 		return instructions
 
+	#
+	# Remove functions that can't be called from main, either directly or
+	# through other functions that can, and global variables that none of
+	# the remaining functions use.  Code that references a function may be
+	# in a function that is never called, so this follows the references
+	# from main rather than removing only functions with no references.
+	# A global that is only assigned is also unused, and the stores to it
+	# are removed.  The remaining global variables are renumbered, which also
+	# removes the gaps left by the names of functions (which don't need
+	# storage).
+	#
+	def removeUnreachable(self):
+		references = {}
+		for function, functionOffset, target in self.globalFixups:
+			references.setdefault(function, []).append(target)
+
+		reachable = set()
+		usedGlobals = set()
+		toVisit = [ self.functionList[0] ]
+		while toVisit:
+			function = toVisit.pop()
+			if function in reachable:
+				continue
+
+			reachable.add(function)
+			for target in references.get(function, []):
+				if isinstance(target, Symbol) and target.type == Symbol.FUNCTION:
+					target = target.function
+
+				if isinstance(target, Function):
+					toVisit += [ target ]
+				elif isinstance(target, Symbol):
+					usedGlobals.add(target)
+
+		self.removedFunctions = [ function for function in self.functionList
+			if function not in reachable ]
+		self.romWordsSaved = sum([ len(function.instructions) for function in self.removedFunctions ])
+		self.functionList = [ function for function in self.functionList if function in reachable ]
+		self.globalFixups = [ fixup for fixup in self.globalFixups if fixup[0] in reachable ]
+		usedGlobals -= self.removeWriteOnlyGlobals()
+
+		# The built in variables are set by code that refers to them by
+		# index, so they must keep the first slots.
+		variables = sorted([ ( sym.index, name ) for name, sym in self.globals.items()
+			if sym.type == Symbol.GLOBAL_VARIABLE ])
+		self.removedGlobals = []
+		numGlobals = 0
+		for index, name in variables:
+			sym = self.globals[name]
+			if sym in usedGlobals or name in BUILTIN_VARIABLES:
+				sym.index = numGlobals
+				numGlobals += 1
+			else:
+				self.removedGlobals += [ name ]
+
+		self.dataWordsSaved = len(self.removedGlobals)
+		self.functionSlotsSaved = len(self.globals) - len(variables)
+		self.dataStart = numGlobals
+
+	#
+	# Find global variables (other than the built in ones) that are only
+	# stored to and never read, and remove the stores.  Code that assigns a
+	# global pushes its address and stores the value, which leaves the value
+	# on the stack as it was before the push, so the two instructions can be
+	# deleted.  Computing the value is left to the peephole optimizer, which
+	# removes it if it has no side effects.  Returns the set of globals.
+	#
+	def removeWriteOnlyGlobals(self):
+		builtins = set([ self.globals[name] for name in BUILTIN_VARIABLES ])
+		def isGlobal(instr):
+			return isinstance(instr.fixupTarget, Symbol) \
+				and instr.fixupTarget.type == Symbol.GLOBAL_VARIABLE
+
+		fixupsByFunction = {}
+		for function, functionOffset, target in self.globalFixups:
+			fixupsByFunction.setdefault(function, []).append(( functionOffset, target ))
+
+		codes = {}
+		stored = set()
+		read = set()
+		for function in self.functionList:
+			code = decodeFunction(function, fixupsByFunction.get(function, []))
+			codes[function] = code
+			for offset, instr in enumerate(code):
+				if isGlobal(instr):
+					if instr.op == OP_PUSH and code[offset + 1].op == OP_STORE \
+						and not code[offset + 1].labels:
+						stored.add(instr.fixupTarget)
+					else:
+						read.add(instr.fixupTarget)
+
+		writeOnly = stored - read - builtins
+		if not writeOnly:
+			return writeOnly
+
+		self.globalFixups = []
+		for function in self.functionList:
+			code = codes[function]
+			if [ instr for instr in code if instr.fixupTarget in writeOnly ]:
+				newCode = []
+				labels = []
+				offset = 0
+				while offset < len(code):
+					instr = code[offset]
+					if instr.fixupTarget in writeOnly:
+						labels += instr.labels		# Move to the instruction after the store
+						offset += 2
+					else:
+						instr.labels = labels + instr.labels
+						labels = []
+						newCode += [ instr ]
+						offset += 1
+
+				fixups = encodeFunction(function, newCode)
+			else:
+				fixups = fixupsByFunction.get(function, [])
+
+			self.globalFixups += [ ( function, functionOffset, target )
+				for functionOffset, target in fixups ]
+
+		return writeOnly
+
+	#
+	# Determine the most stack space the program can use, from the code of
+	# each function and the functions it calls.  A function that is called
+	# before it is defined is called through a global variable, which the
+	# function's address is stored into.  Calls through globals that are only
+	# ever assigned functions can only go to those functions.  Any other call
+	# through a function pointer may go to any function whose address is used
+	# other than to call it or assign it to one of these globals.  The depth
+	# of recursion can't be determined, so functions that are part of a cycle
+	# in the call graph are only counted once, and RECURSION_STACK_WORDS more
+	# are allowed for them.  Sets stackLimit, the number of words below the
+	# top of the stack that the heap must stay clear of.  This runs before the
+	# optimizer, which never makes the stack deeper.
+	#
+	def findStackDepth(self):
+		fixupsByFunction = {}
+		for function, functionOffset, target in self.globalFixups:
+			fixupsByFunction.setdefault(function, []).append(( functionOffset, target ))
+
+		codes = [ ( function, decodeFunction(function, fixupsByFunction.get(function, [])) )
+			for function in self.functionList ]
+
+		# Find the functions each global may hold
+		def isGlobalAddress(instr):
+			return instr.op == OP_PUSH and isinstance(instr.fixupTarget, Symbol) \
+				and instr.fixupTarget.type == Symbol.GLOBAL_VARIABLE
+
+		globalFunctions = {}
+		otherGlobals = set()		# Assigned something other than a function
+		assignments = set()			# Pushes of functions that are stored to a global
+		for function, code in codes:
+			for offset, instr in enumerate(code):
+				if instr.op == OP_STORE and isGlobalAddress(code[offset - 1]):
+					variable = code[offset - 1].fixupTarget
+					value = code[offset - 2]
+					callee = resolveFunction(value.fixupTarget) if value.op == OP_PUSH else None
+					if callee and not instr.labels and not code[offset - 1].labels \
+						and code[offset + 1].op == OP_POP:
+						globalFunctions.setdefault(variable, set()).add(callee)
+						assignments.add(value)
+					else:
+						otherGlobals.add(variable)
+
+		def isFunctionGlobal(instr):
+			return isGlobalAddress(instr) and instr.fixupTarget in globalFunctions \
+				and instr.fixupTarget not in otherGlobals
+
+		# Find functions whose addresses may be passed around
+		addressTaken = set()
+		for function, code in codes:
+			for offset, instr in enumerate(code):
+				callee = resolveFunction(instr.fixupTarget)
+				if callee and instr not in assignments and not (instr.op == OP_GOTO
+					or (instr.op == OP_PUSH and code[offset + 1].op == OP_CALL)):
+					addressTaken.add(callee)
+				elif isGlobalAddress(instr) and code[offset + 1].op == OP_LOAD \
+					and (code[offset + 2].op != OP_CALL or not isFunctionGlobal(instr)):
+					addressTaken.update(globalFunctions.get(instr.fixupTarget, []))
+
+		def getCallees(code, offset):
+			instr = code[offset]
+			if instr.op == OP_GOTO:
+				callee = resolveFunction(instr.fixupTarget)
+			elif code[offset - 1].op == OP_PUSH:
+				callee = resolveFunction(code[offset - 1].fixupTarget)
+			elif code[offset - 1].op == OP_LOAD and isFunctionGlobal(code[offset - 2]):
+				return globalFunctions[code[offset - 2].fixupTarget]
+			else:
+				callee = None
+
+			return [ callee ] if callee else addressTaken
+
+		# The return address is in the top of stack register when a function
+		# is called.  At reset, the stack pointer is four words below the base
+		# pointer (see lisp_core.v).
+		stackUse = {}
+		for function, code in codes:
+			depth, calls = findStackUse(function, code, 5 if function == self.functionList[0] else 1)
+			stackUse[function] = depth, [ ( callDepth, getCallees(code, offset) )
+				for callDepth, offset in calls ]
+
+		self.stackDepths = {}
+		recursive = set()
+		active = []
+		def visit(function):
+			if function in self.stackDepths:
+				return self.stackDepths[function]
+
+			if function in active:
+				recursive.update(active[active.index(function):])
+				return 0
+
+			active.append(function)
+			depth, calls = stackUse[function]
+			for callDepth, callees in calls:
+				for callee in callees:
+					depth = max(depth, callDepth + visit(callee))
+
+			active.pop()
+			self.stackDepths[function] = depth
+			return depth
+
+		self.stackDepth = visit(self.functionList[0])
+		self.recursiveFunctions = [ function for function in self.functionList
+			if function in recursive ]
+
+		# The heap must end below the lowest word of the stack, and a cons
+		# cell is allocated if its first word is below the limit.
+		self.stackLimit = self.stackDepth + 1
+		if self.recursiveFunctions:
+			self.stackLimit += RECURSION_STACK_WORDS
+
+	#
+	# Initial contents of data memory, from address zero to the start of the
+	# heap.  Must be called after link.
+	#
+	def getDataImage(self):
+		return [ 0 for x in range(self.dataStart) ] + self.dataSegment.getImage(self.dataStart)
+
+	#
+	# Save the state of the compiler after compileModule, before linking.
+	# Functions are stored with their labels and references to globals and
+	# other functions unresolved, so this can be loaded into another Compiler
+	# with loadObject and more code compiled against it.
+	#
+	def saveObject(self):
+		functionIndices = {}
+		for index, function in enumerate(self.functionList):
+			functionIndices[function] = index
+
+		globalNames = {}
+		globalSymbols = {}
+		for name, sym in self.globals.items():
+			globalNames[sym] = name
+			globalSymbols[name] = {
+				'type' : sym.type,
+				'index' : sym.index,
+				'initialized' : sym.initialized,
+				'function' : functionIndices[sym.function] if sym.function else None
+			}
+
+		functions = []
+		for function in self.functionList:
+			for ip, label in function.localFixups:
+				if not label.defined:
+					raise Exception('undefined label')
+
+			functions += [ {
+				'name' : function.name,
+				'instructions' : function.instructions,
+				'numLocalVariables' : function.numLocalVariables,
+				'labels' : [ ( ip, label.address ) for ip, label in function.localFixups ]
+			} ]
+
+		fixups = []
+		for function, functionOffset, target in self.globalFixups:
+			if isinstance(target, Function):
+				targetRef = ( 'function', functionIndices[target] )
+			elif isinstance(target, DataAddress):
+				targetRef = ( 'data', target.offset )
+			else:
+				targetRef = ( 'symbol', globalNames[target] )
+
+			fixups += [ ( functionIndices[function], functionOffset, targetRef ) ]
+
+		return {
+			'version' : OBJECT_VERSION,
+			'functions' : functions,
+			'globals' : globalSymbols,
+			'fixups' : fixups,
+			'data' : self.dataSegment.save()
+		}
+
+	#
+	# Restore state saved by saveObject.  This must be called before anything
+	# else is compiled.
+	#
+	def loadObject(self, obj):
+		if obj['version'] != OBJECT_VERSION:
+			raise Exception('object file has unsupported version')
+
+		self.functionList = []
+		for info in obj['functions']:
+			function = Function()
+			function.name = info['name']
+			function.instructions = list(info['instructions'])
+			function.numLocalVariables = info['numLocalVariables']
+			for ip, address in info['labels']:
+				label = function.generateLabel()
+				label.defined = True
+				label.address = address
+				function.localFixups += [ ( ip, label ) ]
+
+			self.functionList += [ function ]
+
+		self.currentFunction = self.functionList[0]
+		self.globals = {}
+		for name, info in obj['globals'].items():
+			sym = Symbol(info['type'])
+			sym.index = info['index']
+			sym.initialized = info['initialized']
+			if info['function'] != None:
+				sym.function = self.functionList[info['function']]
+
+			self.globals[name] = sym
+
+		self.globalFixups = []
+		for functionIndex, functionOffset, ( targetType, target ) in obj['fixups']:
+			if targetType == 'function':
+				target = self.functionList[target]
+			elif targetType == 'data':
+				target = DataAddress(target)
+			else:
+				target = self.globals[target]
+
+			self.globalFixups += [ ( self.functionList[functionIndex], functionOffset, target ) ]
+
+		self.dataSegment.load(obj['data'])
+
 	#
 	# Compile named function definition (function name (param param...) body)
 	#
@@ -404,7 +930,6 @@ class Compiler:
 			self.currentFunction.emitInstruction(OP_STORE);
 			self.currentFunction.emitInstruction(OP_POP);
 			sym.initialized = True
-			function.referenced = True
 		else:
 			sym = Symbol(Symbol.FUNCTION)
 			sym.initialized = True
@@ -434,6 +959,8 @@ class Compiler:
 			self.compileIntegerLiteral(expr)
 		elif expr[0] == '"':
 			self.compileString(expr[1:-1])
+		elif expr[:2] == '#"':
+			self.compileConstant(self.vectorStringConstant(expr[2:-1]))
 		elif expr == 'nil' or expr == 'false':
 			self.currentFunction.emitInstruction(OP_PUSH, 0)
 		elif expr == 'true':
@@ -460,7 +987,6 @@ class Compiler:
 				self.currentFunction.getProgramAddress() - 1, variable ) ]
 			self.currentFunction.emitInstruction(OP_LOAD);
 		elif variable.type == Symbol.FUNCTION:
-			variable.function.referenced = True
 			self.currentFunction.emitInstruction(OP_PUSH, 0)
 			self.globalFixups += [ ( self.currentFunction,
 				self.currentFunction.getProgramAddress() - 1, variable ) ]
@@ -497,6 +1023,9 @@ class Compiler:
 				self.currentFunction.emitInstruction(OP_GETBP)
 			elif functionName == 'and' or functionName == 'or' or functionName == 'not':
 				self.compileBooleanExpression(expr)	
+			elif functionName == 'cons' and self.inlineCons and len(expr) == 3 \
+				and self.isGlobalFunction('cons'):
+				self.compileConsIntrinsic(expr[1], expr[2])
 			else:
 				# Anything that isn't a built in form falls through to here.
 				# (call to a user defined function)
@@ -504,6 +1033,29 @@ class Compiler:
 		else:
 			self.compileFunctionCall(expr)
 
+	#
+	# Allocate a cell without calling cons.  This does the same thing as cons
+	# in runtime.lisp when there is a cell on the free list or room to expand
+	# the heap, and otherwise calls $cons-slow to garbage collect.  This is
+	# faster, but uses more program memory than a call.  The values are kept
+	# in local variables, so the garbage collector will find them on the
+	# stack.
+	#
+	def compileConsIntrinsic(self, first, rest):
+		self.compileLet([ 'let', [ [ '$cons-rest', rest ], [ '$cons-first', first ],
+				[ '$cons-cell', '$freelist' ] ],
+			[ 'if', '$cons-cell',
+				[ 'assign', '$freelist', [ 'rest', '$cons-cell' ] ],
+				[ 'if', [ '<', '$wilderness-start', '$max-heap' ],
+					[ 'begin',
+						[ 'assign', '$cons-cell', '$wilderness-start' ],
+						[ 'assign', '$wilderness-start', [ '+', '$wilderness-start', 2 ] ] ],
+					[ 'assign', '$cons-cell', [ '$cons-slow' ] ] ] ],
+			[ 'store', '$cons-cell', [ 'settag', '$cons-first',
+				[ 'bitwise-and', [ 'gettag', '$cons-first' ], 3 ] ] ],
+			[ 'store', [ '+', '$cons-cell', 1 ], '$cons-rest' ],
+			[ 'settag', '$cons-cell', 1 ] ])
+
 	def compileBasePointer(self, expr):
 		self.currentFunction.emitInstruction(OP_GETLOCAL, 0)
 
@@ -512,59 +1064,63 @@ class Compiler:
 	# calls.
 	#
 	def compileQuote(self, expr):
+		self.compileConstant(self.quoteConstant(expr))
+
+	#
+	# Strings just compile down to lists of characters, since there is not
+	# a native string type.
+	#
+	def compileString(self, string):
+		self.compileConstant(self.stringConstant(string))
+
+	#
+	# Put the cons cells for a quoted expression in the data segment.  Returns
+	# the value of the expression as a data segment word.
+	#
+	def quoteConstant(self, expr):
 		if isinstance(expr, list):
 			if len(expr) == 3 and expr[1] == '.':
 				# This is a pair of the for ( expr . expr )
 				# Create a single cons cell for it.
-				self.compileQuote(expr[2])
-				self.compileQuote(expr[0])
-
-				# Cons is not an instruction.  Emit a call to the 
-				# library function
-				self.compileIdentifier('cons')
-				self.currentFunction.emitInstruction(OP_CALL)
-				self.currentFunction.emitInstruction(OP_CLEANUP, 2)
-			elif len(expr) == 0:
-				# Empty list
-				self.compileIntegerLiteral(0)
+				return self.dataSegment.addCell(self.quoteConstant(expr[0]),
+					self.quoteConstant(expr[2]))
 			else:
-				# List, create a chain of cons calls
-				self.compileQuotedList(expr)
+				# List, create a chain of cells ending with the empty list
+				value = ( TAG_INTEGER, 0 )
+				for element in reversed(expr):
+					value = self.dataSegment.addCell(self.quoteConstant(element), value)
+
+				return value
 		elif isinstance(expr, int):
-			self.compileIntegerLiteral(expr)
+			return ( TAG_INTEGER, expr )
+		elif expr[:2] == '#"':
+			return self.vectorStringConstant(expr[2:-1])
 		else:
-			self.compileString(expr)
+			return self.stringConstant(expr)
 
-	def compileQuotedList(self, tail):
-		if len(tail) == 1:
-			self.compileIntegerLiteral(0)
-		else:
-			# Do the tail first to avoid allocating too many temporaries
-			self.compileQuotedList(tail[1:])
+	def stringConstant(self, string):
+		value = ( TAG_INTEGER, 0 )
+		for char in reversed(string):
+			value = self.dataSegment.addCell(( TAG_INTEGER, ord(char) ), value)
 
-		self.compileQuote(tail[0])
+		return value
 
-		# Cons is not an instruction.  Emit a call to the library function
-		self.compileIdentifier('cons')
-		self.currentFunction.emitInstruction(OP_CALL)
-		self.currentFunction.emitInstruction(OP_CLEANUP, 2)
+	# A string in a vector takes one word per character instead of two
+	def vectorStringConstant(self, string):
+		return self.dataSegment.addVector([ ( TAG_INTEGER, ord(char) ) for char in string ])
 
-	#
-	# Strings just compile down to lists of characters, since there is not
-	# a native string type.
-	#
-	def compileString(self, string):
-		if len(string) == 1:
-			self.compileIntegerLiteral(0)
+	def compileConstant(self, value):
+		tag, param = value
+		if tag == TAG_INTEGER:
+			self.compileIntegerLiteral(param)
 		else:
-			self.compileString(string[1:])
-
-		self.compileIntegerLiteral(ord(string[0]))
-
-		# Cons is not an instruction.  Emit a call to the library function
-		self.compileIdentifier('cons')
-		self.currentFunction.emitInstruction(OP_CALL)
-		self.currentFunction.emitInstruction(OP_CLEANUP, 2)
+			# Load the pointer from the data segment, since a push can't set
+			# the tag.
+			self.currentFunction.emitInstruction(OP_PUSH, 0)
+			self.globalFixups += [ ( self.currentFunction,
+				self.currentFunction.getProgramAddress() - 1,
+				DataAddress(self.dataSegment.getPointer(value)) ) ]
+			self.currentFunction.emitInstruction(OP_LOAD)
 
 	# 
 	# Set a variable (assign variable value)
@@ -754,24 +1310,101 @@ class Compiler:
 		if isinstance(expr[0], int):
 			raise Exception('Cannot use integer as function')
 
-		# Push arguments
-		for paramExpr in reversed(expr[1:]):
-			self.compileExpression(paramExpr)
-
-		if self.currentFunction.name == expr[0] and isTailCall:
+		numArgs = len(expr) - 1
+		if self.currentFunction.name == expr[0] and isTailCall \
+			and numArgs <= self.currentFunction.numParams:
 			# This is a recursive call.  Copy parameters back into frame and
-			# then jump to entry
-			for x in range(len(expr) - 1):
-				self.currentFunction.emitInstruction(OP_SETLOCAL, x + 1)
-				self.currentFunction.emitInstruction(OP_POP)
-			
+			# then jump to entry.  Extra arguments have nowhere to go, so a
+			# call with them is compiled as a normal call.
+			self.moveArgumentsIntoFrame(self.compileTailArguments(expr[1:]))
 			self.currentFunction.emitBranchInstruction(OP_GOTO, self.currentFunction.getEntryLabel())
+		elif isTailCall and numArgs <= self.currentFunction.numParams:
+			self.compileTailCall(expr[0], expr[1:])
 		else:
+			# Push arguments
+			for paramExpr in reversed(expr[1:]):
+				self.compileExpression(paramExpr)
+
 			self.compileExpression(expr[0])
 			self.currentFunction.emitInstruction(OP_CALL)
 			if len(expr) > 1:
 				self.currentFunction.emitInstruction(OP_CLEANUP, len(expr) - 1)
 
+	#
+	# Evaluate the arguments for a tail call and copy them into this
+	# function's parameters.  All arguments are evaluated before any are
+	# copied, since they may reference the parameters.  An argument that is
+	# just the parameter in the same position is already in place.
+	#
+	def compileTailArguments(self, args):
+		toCopy = []
+		for index, paramExpr in enumerate(args):
+			if not isinstance(paramExpr, str) \
+				or self.currentFunction.lookupLocalVariable(paramExpr) != \
+				self.currentFunction.parameters[index]:
+				toCopy += [ index ]
+
+		for index in reversed(toCopy):
+			self.compileExpression(args[index])
+
+		return toCopy
+
+	def moveArgumentsIntoFrame(self, toCopy):
+		for index in toCopy:
+			self.currentFunction.emitInstruction(OP_SETLOCAL, index + 1)
+			self.currentFunction.emitInstruction(OP_POP)
+
+	#
+	# A call in tail position reuses the current function's stack frame:
+	# the arguments replace this function's parameters, then control
+	# transfers to the callee in the same state a call instruction would
+	# leave: the stack pointer and base pointer at this function's frame
+	# and the return address (this function's) in the top of stack register.
+	# The caller of this function removes its parameters after the callee
+	# returns, so this can only be done if there are no more arguments than
+	# this function has parameters.  At a tail position, the only things on
+	# the stack are local variables and the arguments that were just pushed.
+	#
+	def compileTailCall(self, functionExpr, args):
+		function = self.currentFunction
+		toCopy = self.compileTailArguments(args)
+		if isinstance(functionExpr, str):
+			callee = self.lookupSymbol(functionExpr)
+			if callee.type == Symbol.FUNCTION:
+				# Put return address into the top of stack, remove the
+				# frame, then jump directly to the function.
+				self.moveArgumentsIntoFrame(toCopy)
+				function.emitInstruction(OP_GETLOCAL, -1)
+				function.emitFrameCleanup(1)
+				function.emitInstruction(OP_GOTO, 0)
+				self.globalFixups += [ ( function, function.getProgramAddress() - 1, callee ) ]
+				return
+
+		# The only way to jump to a computed address is with call or return.
+		# Save the callee and the return address in local variables, then
+		# call the next instruction from the caller's base pointer (restored
+		# from the frame).  That leaves the base pointer one slot below this
+		# frame's with this frame's base pointer stored in it.  Put the
+		# callee address below that, then return to it, which sets the stack
+		# and base pointers to this frame's.
+		calleeSlot, returnSlot = function.getTailCallSlots()
+		self.compileExpression(functionExpr)
+		function.emitInstruction(OP_SETLOCAL, calleeSlot)
+		function.emitInstruction(OP_POP)
+		self.moveArgumentsIntoFrame(toCopy)
+		function.emitInstruction(OP_GETLOCAL, -1)
+		function.emitInstruction(OP_SETLOCAL, returnSlot)
+		function.emitInstruction(OP_GETLOCAL, 0)	# Caller's base pointer
+		function.emitFrameCleanup(3)
+		trampoline = function.generateLabel()
+		function.emitBranchInstruction(OP_PUSH, trampoline)
+		function.emitInstruction(OP_CALL)
+		function.emitLabel(trampoline)
+		function.emitInstruction(OP_GETLOCAL, calleeSlot + 1)
+		function.emitInstruction(OP_SETLOCAL, -1)
+		function.emitInstruction(OP_GETLOCAL, returnSlot + 1)
+		function.emitInstruction(OP_RETURN)
+
 	#
 	# Common code to compile body of the function definition (either anonymous or named)
 	# ((param param...) body)
@@ -791,6 +1424,7 @@ class Compiler:
 		# Compile top level expression.
 		self.compileSequence(body, isTailCall=True)
 		self.currentFunction.emitInstruction(OP_RETURN)
+		self.currentFunction.performFrameFixups()
 		self.currentFunction = oldFunc
 
 		return newFunction
@@ -805,7 +1439,6 @@ class Compiler:
 		# represent free variables while compiling. See lookupSymbol for more information.
 		self.currentFunction.enterScope()
 		newFunction = self.compileFunctionBody(None, expr[1], expr[2:])
-		newFunction.referenced = True
 		self.currentFunction.exitScope()
 
 		newFunction.name = '<anonymous function>'
@@ -845,10 +1478,14 @@ class Compiler:
 		self.currentFunction.enterScope()
 
 		# Walk through each variable, define in scope, evaluate the initial value,
-		# and assign.
-		for variable, value in expr[1]:
-			symbol = self.currentFunction.reserveLocalVariable(variable)
-			self.compileExpression(value)
+		# and assign.  Temporaries created by SubexpressionEliminator don't
+		# have an initial value.
+		for binding in expr[1]:
+			symbol = self.currentFunction.reserveLocalVariable(binding[0])
+			if len(binding) == 1:
+				continue
+
+			self.compileExpression(binding[1])
 			self.currentFunction.emitInstruction(OP_SETLOCAL, symbol.index)
 			self.currentFunction.emitInstruction(OP_POP) # setlocal leaves on stack, remove it
 
@@ -856,15 +1493,92 @@ class Compiler:
 		self.compileSequence(expr[2:], isTailCall)
 		self.currentFunction.exitScope()
 
+	#
+	# For debugging: create a listing of the instructions used.  Must be 
+	# called after compile.
+	#
+	def writeListing(self, listfile, program):
+		# Write out table of global variables
+		listfile.write('Globals:\n')
+		for var in self.globals:
+			sym = self.globals[var]
+			if sym.type != Symbol.FUNCTION and var not in self.removedGlobals:
+				listfile.write(' ' + var + ' var@' + str(sym.index) + '\n')
+
+		if self.removedFunctions or self.removedGlobals:
+			listfile.write('\nRemoved %d unreachable functions (%d words of code), ' \
+				% (len(self.removedFunctions), self.romWordsSaved))
+			listfile.write('%d unused globals (%d words of data):\n' % (len(self.removedGlobals),
+				self.dataWordsSaved))
+			for function in self.removedFunctions:
+				listfile.write(' function ' + str(function.name) + '\n')
+
+			for var in sorted(self.removedGlobals):
+				listfile.write(' ' + var + '\n')
+
+		if self.functionSlotsSaved:
+			listfile.write('\nFunction names take no data (%d words saved)\n'
+				% self.functionSlotsSaved)
+
+		if self.dataSegment.words:
+			listfile.write('\nData segment: %d words at %d\n' % (len(self.dataSegment.words),
+				self.dataStart))
+
+		listfile.write('\nStack: %d words' % self.stackDepth)
+		if self.recursiveFunctions:
+			listfile.write(', plus %d for unbounded recursion through:\n' % RECURSION_STACK_WORDS)
+			for function in self.recursiveFunctions:
+				listfile.write(' function ' + str(function.name) + '\n')
+		else:
+			listfile.write('\n')
+
+		for func in self.functionList:
+			listfile.write('\nfunction ' + str(func.name) + '\n')
+			if func in self.stackDepths:
+				listfile.write('; stack %d words%s\n' % (self.stackDepths[func],
+					' (recursive)' if func in self.recursiveFunctions else ''))
+			if func.instructionsRemoved:
+				listfile.write('; peephole removed %d instructions, %d cycles\n'
+					% (func.instructionsRemoved, func.cyclesRemoved))
+
+			if func.controlFlowRemoved:
+				listfile.write('; control flow optimization removed %d instructions\n'
+					% func.controlFlowRemoved)
+
+			disassemble(listfile, func.instructions, func.baseAddress)
+
+		# Write out expanded expressions
+		prettyPrintSExpr(listfile, program, 0)
+
+	def getGlobalVariables(self):
+		variables = {}
+		for name, sym in self.globals.items():
+			if sym.type == Symbol.GLOBAL_VARIABLE and name not in self.removedGlobals:
+				variables[name] = sym.index
+
+		return variables
+
+	def optimizeFunctions(self):
+		fixupsByFunction = {}
+		for function, functionOffset, target in self.globalFixups:
+			fixupsByFunction.setdefault(function, []).append(( functionOffset, target ))
+
+		self.globalFixups = []
+		for function in self.functionList:
+			fixups = optimizeFunction(function, fixupsByFunction.get(function, []))
+			self.globalFixups += [ ( function, offset, target ) for offset, target in fixups ]
+
 	def performGlobalFixups(self):
 		# Check if there are uninitialized globals
 		for varName in self.globals:
 			if not self.globals[varName].initialized:
-				print 'unknown variable %s' % varName
+				self.warnings += [ 'unknown variable %s' % varName ]
 
 		for function, functionOffset, target in self.globalFixups:
 			if isinstance(target, Function):
 				function.patch(functionOffset, target.baseAddress)
+			elif isinstance(target, DataAddress):
+				function.patch(functionOffset, self.dataStart + target.offset)
 			elif isinstance(target, Symbol):
 				if target.type == Symbol.GLOBAL_VARIABLE:
 					function.patch(functionOffset, target.index)
@@ -968,12 +1682,9 @@ def optimize(expr):
 				else:
 					return 0	# Did not have an else, this is an empty expression
 
-			# Strength reduction for power of two multiplies and divides
-			if len(optimizedParams) > 1 and isinstance(optimizedParams[1], int) \
-				and isPowerOfTwo(optimizedParams[1]) and optimizedParams[1] > 0  \
-				and (expr[0] == '*' or expr[0] == '/'):
-				return [ 'lshift' if expr[0] == '*' else 'rshift', optimizedParams[0], 
-					int(math.log(int(optimizedParams[1]), 2)) ]
+			# Algebraic simplification and strength reduction
+			if not isinstance(expr[0], list):
+				return simplifyArithmetic([ expr[0] ] + optimizedParams)
 
 			# Nothing to optimize, return the expression as is
 			return [ expr[0] ] + optimizedParams
@@ -981,84 +1692,1925 @@ def optimize(expr):
 		return expr
 
 #
-# For debugging
+# Algebraic simplification and strength reduction.  These are applied by
+# optimize to arithmetic expressions that could not be folded into a
+# constant.  An operand is only dropped if evaluating it has no side
+# effects.  The rules treat operands as integers: if one is a pointer, its
+# tag may not be preserved unless it is the value that is returned.
 #
 
-# name, hasparam
-disasmTable = {
-	OP_NOP			: ('nop', False),
-	OP_CALL 		: ('call', False),
-	OP_RETURN 		: ('return', False),
-	OP_CLEANUP 		: ('cleanup', True),
-	OP_POP 			: ('pop', False),
-	OP_ADD 			: ('add', False),
-	OP_SUB 			: ('sub', False),
-	OP_PUSH 		: ('push', True),
-	OP_LOAD 		: ('load', False),
-	OP_STORE 		: ('store', False),
-	OP_GETLOCAL 	: ('getlocal', True),
-	OP_SETLOCAL 	: ('setlocal', True),
-	OP_GOTO 		: ('goto', True),
-	OP_BFALSE 		: ('bfalse', True),
-	OP_REST 		: ('rest', False),
-	OP_RESERVE 		: ('reserve', True),
-	OP_GTR			: ('gtr', False),
-	OP_GTE			: ('gte', False),
-	OP_EQ			: ('eq', False),
-	OP_NEQ			: ('neq', False),
-	OP_DUP			: ('dup', False),
-	OP_GETTAG		: ('gettag', False),
-	OP_SETTAG		: ('settag', False),
-	OP_AND			: ('and', False),
-	OP_OR			: ('or', False),
-	OP_XOR			: ('xor', False),
-	OP_LSHIFT		: ('lshift', False),
-	OP_RSHIFT		: ('rshift', False),
-	OP_GETBP		: ('getbp', False)
-}
-
-def disassemble(outfile, instructions, baseAddress):
-	for pc, word in enumerate(instructions):
-		outfile.write('' + str(baseAddress + pc))
-		opcode = (word >> 16)
-		name, hasParam = disasmTable[opcode]
-		if hasParam:
-			paramValue = word & 0xffff
-			if paramValue & 0x8000:
-				paramValue = -(((paramValue ^ 0xffff) + 1) & 0xffff)
+MAX_MULTIPLY_TERMS = 4		# Shifted copies of the multiplicand to replace a multiply with
 
-			outfile.write('\t' + name + ' ' + str(paramValue) + '\n')
-		else:
-			outfile.write('\t' + name + '\n')
+def simplifyArithmetic(expr):
+	if len(expr) != 3:
+		return expr
 
-def prettyPrintSExpr(listfile, expr, indent = 0):
-	if isinstance(expr, list):
-		if len(expr) > 0 and expr[0] == 'function':
-			listfile.write('\n')
+	op, x, y = expr
+	if op in ( '+', '-' ):
+		return reassociate(expr)
+	elif op == '*':
+		if isinstance(x, int):
+			x, y = y, x
+
+		if isinstance(y, int):
+			return reduceMultiply(x, y)
+	elif op in ( '/', 'mod' ) and isinstance(y, int):
+		return reduceDivide(op, x, y)
+	elif op in ( 'bitwise-and', 'bitwise-or', 'bitwise-xor' ):
+		# The identity is the value that leaves the other operand unchanged.
+		# The bitwise and of anything with zero is zero, and the bitwise or
+		# with all ones is all ones.  The result has the tag of the first
+		# operand, so if that is the identity, the other operand can only
+		# replace it if it is not a pointer.
+		identity = -1 if op == 'bitwise-and' else 0
+		absorbing = { 'bitwise-and' : 0, 'bitwise-or' : -1 }.get(op)
+		for value, other in ( ( x, y ), ( y, x ) ):
+			if isinstance(value, int):
+				if makeLegalConstant(value) == identity and (value is y or not mayBePointer(other)):
+					return other
+				elif makeLegalConstant(value) == absorbing and not hasSideEffects(other):
+					return absorbing
+	elif op in ( 'lshift', 'rshift' ) and isinstance(y, int):
+		if y == 0:
+			return x
+		elif (y < 0 or y >= 16) and not hasSideEffects(x):
+			return 0	# Shift amounts are unsigned, everything is shifted out
+
+	return expr
 
-		listfile.write('\n')
-		for x in range(indent):
-			listfile.write('  ')
-		
-		listfile.write('(')
-		for elem in expr:
-			if elem != expr[0]:
-				listfile.write(' ')
+#
+# Collect the operands of a chain of nested adds and subtracts into terms,
+# which are ( sign, expression ) tuples, in order.  The compiler evaluates
+# the second operand of an add or subtract before the first, so the terms
+# are evaluated in reverse order regardless of how they are nested.
+#
+def flattenSum(expr, sign, terms):
+	if isinstance(expr, list) and len(expr) == 3 and expr[0] in ( '+', '-' ):
+		flattenSum(expr[1], sign, terms)
+		flattenSum(expr[2], sign if expr[0] == '+' else -sign, terms)
+	else:
+		terms += [ ( sign, expr ) ]
 
-			prettyPrintSExpr(listfile, elem, indent + 1)
-			
-		listfile.write(')')
+#
+# Combine the constants in an add/subtract chain and cancel x - x.  The
+# result of an add or subtract has the tag of its first operand, so the first
+# term of the chain can't be replaced by one that may be a pointer, or the
+# other way around.
+#
+def reassociate(expr):
+	terms = []
+	flattenSum(expr, 1, terms)
+	first = terms[0][1]
+	constant = 0
+	numConstants = 0
+	others = []
+	for sign, term in terms:
+		if isinstance(term, int):
+			constant += sign * term
+			numConstants += 1
+		else:
+			others += [ ( sign, term ) ]
+
+	# Terms can only be cancelled if nothing in the chain could change
+	# their values.
+	numCancelled = 0
+	if not [ term for sign, term in others if hasSideEffects(term) ]:
+		for sign, term in list(others):
+			if sign < 0 and ( -1, term ) in others and ( 1, term ) in others:
+				others.remove(( 1, term ))
+				others.remove(( -1, term ))
+				numCancelled += 1
+
+	constant = makeLegalConstant(constant)
+	if numConstants < 2 and constant != 0 and numCancelled == 0:
+		return expr		# Already as simple as it can be
+
+	if not others:
+		return constant
+
+	if others[0][0] < 0 or (isinstance(first, int) and mayBePointer(others[0][1])):
+		# Start with the constant (in the original chain, the first
+		# operand of the innermost expression must have been a constant).
+		result = constant
+		constant = 0
+	elif others[0][1] != first and (mayBePointer(first) or mayBePointer(others[0][1])):
+		return expr		# The first term was cancelled
 	else:
-		listfile.write(str(expr))
+		result = others[0][1]
+		others = others[1:]
+
+	for sign, term in others:
+		result = [ '+' if sign > 0 else '-', result, term ]
+
+	if constant > 0:
+		result = [ '+', result, constant ]
+	elif constant < 0:
+		result = [ '-', result, makeLegalConstant(-constant) ]
 
+	return result
 
 #
-# The macro processor is actually a small lisp interpreter
-# When we see macro, we evaluate its expression with the arguments as parameters.
+# Non-adjacent form of a positive integer: a list of ( sign, shift ) tuples,
+# from lowest to highest shift, where the sum of sign << shift is the value.
+# This has the fewest terms of any signed binary representation.
 #
-class MacroProcessor:
-	def __init__(self):
+def nonAdjacentForm(value):
+	digits = []
+	shift = 0
+	while value:
+		if value & 1:
+			sign = 2 - (value & 3)
+			value -= sign
+			digits += [ ( sign, shift ) ]
+
+		value >>= 1
+		shift += 1
+
+	return digits
+
+#
+# Replace a multiply by a constant with shifts and adds.  The multiply
+# function in runtime.lisp returns the low 16 bits of the product, which
+# this computes as well.
+#
+def reduceMultiply(x, multiplier):
+	if multiplier == 0 and not hasSideEffects(x):
+		return 0
+	elif multiplier == 1:
+		return x
+	elif multiplier == -1:
+		return [ '-', 0, x ]
+
+	terms = nonAdjacentForm(abs(multiplier))
+	if len(terms) > MAX_MULTIPLY_TERMS or multiplier == 0:
+		return [ '*', x, multiplier ]
+
+	if multiplier < 0:
+		terms = [ ( -sign, shift ) for sign, shift in terms ]
+
+	# The multiplicand is evaluated once, into a temporary if it is used more
+	# than once.
+	if len(terms) > 1 and not isinstance(x, str):
+		temp = '$multiplicand'
+	else:
+		temp = x
+
+	# Put added terms first, so nothing needs to be subtracted from zero
+	# unless all terms are negative.
+	terms.sort(key=lambda term : ( -term[0], -term[1] ))
+	result = None
+	for sign, shift in terms:
+		term = [ 'lshift', temp, shift ] if shift else temp
+		if result == None:
+			result = term if sign > 0 else [ '-', 0, term ]
+		else:
+			result = [ '+' if sign > 0 else '-', result, term ]
+
+	if temp != x:
+		return [ 'let', [ [ temp, x ] ], result ]
+	else:
+		return result
+
+#
+# Replace a divide or modulus by a power of two with a shift or mask.  The
+# functions in runtime.lisp divide the absolute values.  The quotient is
+# negative if the signs of the operands differ and the remainder has the
+# sign of the divisor.  If the dividend may be negative, this is only done
+# when it is a variable, which can be tested for the sign without
+# evaluating it again.
+#
+def reduceDivide(op, x, divisor):
+	if divisor in ( 1, -1 ):
+		if op == 'mod':
+			return [ 'mod', x, divisor ] if hasSideEffects(x) else 0
+		else:
+			return x if divisor == 1 else [ '-', 0, x ]
+
+	if divisor <= 0 or not isPowerOfTwo(divisor):
+		return [ op, x, divisor ]
+
+	shift = int(math.log(divisor, 2))
+	if isNonNegative(x):
+		if op == '/':
+			return [ 'rshift', x, shift ]
+		else:
+			return [ 'bitwise-and', x, divisor - 1 ]
+	elif isinstance(x, str):
+		negated = [ '-', 0, x ]
+		if op == '/':
+			return [ 'if', [ '<', x, 0 ], [ '-', 0, [ 'rshift', negated, shift ] ],
+				[ 'rshift', x, shift ] ]
+		else:
+			return [ 'bitwise-and', [ 'if', [ '<', x, 0 ], negated, x ], divisor - 1 ]
+	else:
+		return [ op, x, divisor ]
+
+COMPARISONS = set([ '>', '>=', '<', '<=', '=', '<>' ])
+
+# True if the value of expr is known to be between 0 and 32767
+def isNonNegative(expr):
+	if isinstance(expr, int):
+		return expr >= 0
+	elif not isinstance(expr, list) or len(expr) == 0:
+		return False
+
+	op = expr[0]
+	if op in COMPARISONS or op in ( 'and', 'or', 'not', 'gettag' ):
+		return True
+	elif op == 'bitwise-and' and len(expr) == 3:
+		return isNonNegative(expr[1]) or isNonNegative(expr[2])
+	elif op == 'rshift' and len(expr) == 3:
+		return isinstance(expr[2], int) and expr[2] > 0
+	elif op == 'mod' and len(expr) == 3:
+		return isinstance(expr[2], int) and expr[2] > 0
+	elif op == 'if' and len(expr) in ( 3, 4 ):
+		return isNonNegative(expr[2]) and (len(expr) == 3 or isNonNegative(expr[3]))
+	else:
+		return False
+
+# Conservative: anything other than arithmetic on variables and constants
+def hasSideEffects(expr):
+	if isinstance(expr, int):
+		return False
+	elif isinstance(expr, str):
+		return False	# Variable or string constant
+	elif not isinstance(expr, list) or len(expr) == 0 or not isinstance(expr[0], str):
+		return True
+	elif expr[0] not in EVALUATE_PRIMITIVES and expr[0] not in ( 'and', 'or', 'not', 'gettag' ):
+		return True
+
+	for sub in expr[1:]:
+		if hasSideEffects(sub):
+			return True
+
+	return False
+
+# True if the value of expr may be a pointer.  The result of arithmetic has
+# the tag of its first operand (the one the compiler evaluates last).
+def mayBePointer(expr):
+	if isinstance(expr, int):
+		return False
+	elif isinstance(expr, list) and len(expr) > 0:
+		if expr[0] in COMPARISONS or expr[0] in ( 'and', 'or', 'not', 'gettag' ):
+			return False
+		elif expr[0] in EVALUATE_PRIMITIVES and len(expr) == 3:
+			return mayBePointer(expr[1])
+
+	return True
+
+#
+# True if expr may compute an address inside an object on the heap, like
+# the address of a vector element.  The garbage collector only recognizes
+# pointers to the start of an object, and the copying collector moves
+# objects, so a value like this can't be kept in a local variable across a
+# call that may allocate memory.
+#
+def mayBeDerivedPointer(expr):
+	return isinstance(expr, list) and len(expr) == 3 \
+		and (expr[0] in EVALUATE_PRIMITIVES or expr[0] == 'settag') \
+		and expr[0] not in COMPARISONS and mayBePointer(expr[1])
+
+#
+# Function inlining.  This runs on the optimized S-Expressions for the whole
+# program.  Calls to small named functions are replaced with the body of the
+# function, where the parameters are local variables in a let.  Only calls
+# to functions that were defined earlier in the program are replaced, since
+# the compiler treats a name that is referenced before it is defined as a
+# global variable.
+#
+
+SPECIAL_FORMS = set([ 'function', 'begin', 'while', 'break', 'if', 'assign', 'quote',
+	'let', 'getbp', 'and', 'or', 'not', 'nil', 'false', 'true' ])
+
+#
+# Rough number of instructions the compiler will generate for an expression.
+#
+def estimateCodeSize(expr):
+	if isinstance(expr, list):
+		if len(expr) == 0:
+			return 1
+		elif expr[0] == 'quote':
+			return 1 if isinstance(expr[1], int) or expr[1] == [] else 2
+		elif expr[0] == 'let':
+			return sum([ estimateCodeSize(value) + 2 for var, value in expr[1] ]) \
+				+ estimateSequenceSize(expr[2:])
+		elif expr[0] in ( 'begin', 'while', 'function' ):
+			return estimateSequenceSize(expr[1:]) + 2
+		elif expr[0] in Compiler.PRIMITIVES or expr[0] in SPECIAL_FORMS:
+			return sum([ estimateCodeSize(sub) for sub in expr[1:] ]) + 1 \
+				+ (1 if expr[0] == 'if' else 0)
+		else:
+			# Function call: push function, call, cleanup
+			return sum([ estimateCodeSize(sub) for sub in expr ]) + 2
+	elif isStringLiteral(expr):
+		return 2
+	else:
+		return 1
+
+def isStringLiteral(expr):
+	return isinstance(expr, str) and (expr[0] == '"' or expr[:2] == '#"')
+
+# A sequence pops the results of all but the last expression
+def estimateSequenceSize(sequence):
+	return sum([ estimateCodeSize(expr) + 1 for expr in sequence ])
+
+#
+# Call fn(expr) for every sub-expression of expr that isn't quoted.
+#
+def walkExpression(expr, fn):
+	fn(expr)
+	if isinstance(expr, list) and len(expr) > 0 and expr[0] != 'quote':
+		for sub in expr:
+			walkExpression(sub, fn)
+
+def findIdentifiers(expr):
+	names = set()
+	def visit(sub):
+		if isinstance(sub, str) and not isStringLiteral(sub):
+			names.add(sub)
+
+	walkExpression(expr, visit)
+	return names
+
+# Names bound by let forms within expr
+def findBoundNames(expr):
+	names = set()
+	def visit(sub):
+		if isinstance(sub, list) and len(sub) > 1 and sub[0] == 'let':
+			names.update([ var for var, value in sub[1] ])
+
+	walkExpression(expr, visit)
+	return names
+
+class InlineCandidate:
+	def __init__(self, name, params, body):
+		self.name = name
+		self.params = params
+		self.body = body
+		self.size = estimateSequenceSize(body)
+		self.boundNames = findBoundNames(body)
+
+		# Identifiers that don't refer to parameters or local variables of
+		# the function.  These must not be hidden by local variables where the
+		# body is substituted.
+		self.freeNames = findIdentifiers(body) - self.boundNames - set(params)
+		self.assignedNames = set()
+		def visit(sub):
+			if isinstance(sub, list) and len(sub) > 2 and sub[0] == 'assign':
+				self.assignedNames.add(sub[1])
+
+		walkExpression(body, visit)
+
+class Inliner:
+	MAX_FUNCTION_SIZE = 16		# Estimated instructions
+
+	def __init__(self, budget):
+		self.budget = budget		# Estimated instructions of code growth allowed
+		self.candidates = {}		# name -> InlineCandidate
+		self.numInlined = {}		# name -> number of call sites replaced
+		self.nextTemporary = 0
+
+	# An object file (see Compiler.saveObject) stores candidates from the
+	# code that was compiled into it, so calls to them can be inlined too.
+	def saveState(self, obj):
+		obj['inline'] = dict([ ( name, ( c.params, c.body ) ) for name, c in self.candidates.items() ])
+		obj['inlineBudget'] = self.budget
+
+	def loadState(self, obj):
+		for name, ( params, body ) in obj['inline'].items():
+			self.candidates[name] = InlineCandidate(name, params, body)
+
+		self.budget = min(self.budget, obj['inlineBudget'])
+
+	def inlineProgram(self, program):
+		# A function can't be inlined if it is assigned anywhere, since the
+		# variable may not refer to it any more.
+		self.assigned = set()
+		for expr in program:
+			walkExpression(expr, self.findAssignments)
+
+		for name in self.assigned:
+			self.candidates.pop(name, None)
+
+		newProgram = []
+		for expr in program:
+			if isinstance(expr, list) and len(expr) > 3 and expr[0] == 'function' \
+				and isinstance(expr[1], str):
+				body = [ self.inlineExpression(sub, set(expr[2])) for sub in expr[3:] ]
+				newProgram += [ expr[:3] + body ]
+				self.considerCandidate(expr[1], expr[2], body)
+			else:
+				newProgram += [ self.inlineExpression(expr, set()) ]
+
+		return newProgram
+
+	def findAssignments(self, expr):
+		if isinstance(expr, list) and len(expr) > 2 and expr[0] == 'assign':
+			self.assigned.add(expr[1])
+
+	def considerCandidate(self, name, params, body):
+		if name in self.assigned or name in self.candidates:
+			return
+
+		names = findIdentifiers(body)
+		if name in names or 'getbp' in names or 'break' in names or 'function' in names:
+			return
+
+		candidate = InlineCandidate(name, params, body)
+		if candidate.size <= self.MAX_FUNCTION_SIZE:
+			self.candidates[name] = candidate
+
+	#
+	# Replace calls in expr.  locals is the set of local variable names in
+	# scope.
+	#
+	def inlineExpression(self, expr, locals):
+		if not isinstance(expr, list) or len(expr) == 0:
+			return expr
+
+		head = expr[0]
+		if head == 'quote':
+			return expr
+		elif head == 'let':
+			# Each variable is in scope for its own initializer and the ones
+			# after it (see Compiler.compileLet).
+			innerLocals = set(locals)
+			bindings = []
+			for var, value in expr[1]:
+				innerLocals.add(var)
+				bindings += [ [ var, self.inlineExpression(value, innerLocals) ] ]
+
+			return [ 'let', bindings ] + [ self.inlineExpression(sub, innerLocals) for sub in expr[2:] ]
+		elif head == 'function':
+			# Anonymous function
+			innerLocals = locals | set(expr[1])
+			return expr[:2] + [ self.inlineExpression(sub, innerLocals) for sub in expr[2:] ]
+
+		expr = [ head ] + [ self.inlineExpression(sub, locals) for sub in expr[1:] ]
+		if not isinstance(head, str) or head in locals or head not in self.candidates:
+			return expr
+
+		candidate = self.candidates[head]
+		args = expr[1:]
+		if len(args) != len(candidate.params) or candidate.freeNames & locals:
+			return expr
+
+		growth = candidate.size + 2 * len(args) - (3 if args else 2)
+		if growth > self.budget:
+			return expr
+
+		self.budget -= max(growth, 0)
+		self.numInlined[head] = self.numInlined.get(head, 0) + 1
+		return self.substitute(candidate, args, locals)
+
+	def substitute(self, candidate, args, locals):
+		# Constants and local variables can be used directly, as long as the
+		# body doesn't change the parameter or declare a variable with the
+		# same name, and no other argument assigns a variable.  Other
+		# arguments are evaluated once into a new local variable.  These are
+		# bound in reverse order, since arguments are normally evaluated right
+		# to left.
+		argsAssign = 'assign' in findIdentifiers(args)
+		renames = {}
+		bindings = []
+		for param, arg in reversed(zip(candidate.params, args)):
+			if param not in candidate.assignedNames and (isinstance(arg, int) \
+				or (not argsAssign and isinstance(arg, str) and arg in locals
+				and arg not in candidate.boundNames)):
+				renames[param] = arg
+			else:
+				temp = '%s$%d' % (param, self.nextTemporary)
+				self.nextTemporary += 1
+				renames[param] = temp
+				bindings += [ [ temp, arg ] ]
+
+		body = [ self.rename(sub, renames) for sub in candidate.body ]
+		if bindings:
+			return [ 'let', bindings ] + body
+		elif len(body) == 1:
+			return body[0]
+		else:
+			return [ 'begin' ] + body
+
+	# Replace references to variables in renames, respecting scopes
+	def rename(self, expr, renames):
+		if isinstance(expr, str):
+			return renames.get(expr, expr)
+		elif not isinstance(expr, list) or len(expr) == 0 or expr[0] == 'quote':
+			return expr
+		elif expr[0] == 'let':
+			renames = dict(renames)
+			bindings = []
+			for var, value in expr[1]:
+				renames.pop(var, None)
+				bindings += [ [ var, self.rename(value, renames) ] ]
+
+			return [ 'let', bindings ] + [ self.rename(sub, renames) for sub in expr[2:] ]
+		else:
+			return [ self.rename(sub, renames) for sub in expr ]
+
+#
+# Partial evaluation.  Calls to functions that have no side effects, where
+# every argument is a constant, are evaluated when the program is compiled
+# and replaced with the result.  A function qualifies if it only uses
+# arithmetic and comparison primitives, control flow, its own parameters and
+# local variables, and calls to other functions that qualify.  Anything that
+# accesses memory, global variables or function pointers disqualifies it,
+# which includes calls to cons.  Values are 16 bits and the primitives
+# behave like the ALU (see aluOp in simulator.py), so the result is the same
+# as if the call was made when the program runs.  Each evaluation is limited
+# to a number of steps, and calls that exceed it are left in the program.
+#
+
+EVALUATE_PRIMITIVES = {
+	'+' : (lambda x, y : (x + y) & 0xffff),
+	'-' : (lambda x, y : (x - y) & 0xffff),
+	'>' : (lambda x, y : 1 if 0 < ((x - y) & 0xffff) < 0x8000 else 0),
+	'>=' : (lambda x, y : 1 if ((x - y) & 0xffff) < 0x8000 else 0),
+	'<' : (lambda x, y : 1 if 0 < ((y - x) & 0xffff) < 0x8000 else 0),
+	'<=' : (lambda x, y : 1 if ((y - x) & 0xffff) < 0x8000 else 0),
+	'=' : (lambda x, y : 1 if x == y else 0),
+	'<>' : (lambda x, y : 1 if x != y else 0),
+	'bitwise-and' : (lambda x, y : x & y),
+	'bitwise-or' : (lambda x, y : x | y),
+	'bitwise-xor' : (lambda x, y : x ^ y),
+	'lshift' : (lambda x, y : (x << y) & 0xffff if y < 16 else 0),
+	'rshift' : (lambda x, y : x >> y if y < 16 else 0)
+}
+
+EVALUATE_FORMS = set([ 'if', 'begin', 'while', 'break', 'let', 'assign', 'and', 'or', 'not' ])
+
+class EvaluationFailed(Exception):
+	pass
+
+class LoopBreak(Exception):
+	def __init__(self, value):
+		Exception.__init__(self)
+		self.value = value
+
+class PartialEvaluator:
+	MAX_CALL_DEPTH = 48		# Keeps python's stack from overflowing
+
+	def __init__(self, maxSteps):
+		self.maxSteps = maxSteps	# Expressions evaluated per call replaced
+		self.functions = {}			# name -> (params, body) of functions without side effects
+		self.numEvaluated = {}		# name -> number of calls replaced
+		self.results = {}			# (name, args) -> result, None if it could not be evaluated
+		self.steps = 0
+
+	# Like Inliner, an object file stores the functions from the code that was
+	# compiled into it.
+	def saveState(self, obj):
+		obj['pure'] = dict(self.functions)
+
+	def loadState(self, obj):
+		for name, ( params, body ) in obj['pure'].items():
+			self.functions[name] = ( params, body )
+
+	def evaluateProgram(self, program):
+		assigned = set()
+		def findAssignments(expr):
+			if isinstance(expr, list) and len(expr) > 2 and expr[0] == 'assign':
+				assigned.add(expr[1])
+
+		for expr in program:
+			walkExpression(expr, findAssignments)
+			if isinstance(expr, list) and len(expr) > 3 and expr[0] == 'function' \
+				and isinstance(expr[1], str):
+				self.functions[expr[1]] = ( expr[2], expr[3:] )
+
+		for name in assigned:
+			self.functions.pop(name, None)
+
+		# Removing a function may disqualify the functions that call it, so
+		# repeat until nothing changes.
+		changed = True
+		while changed:
+			changed = False
+			for name, ( params, body ) in self.functions.items():
+				if not self.isSequencePure(body, set(params)):
+					del self.functions[name]
+					changed = True
+
+		newProgram = []
+		for expr in program:
+			numEvaluated = sum(self.numEvaluated.values())
+			if isinstance(expr, list) and len(expr) > 3 and expr[0] == 'function' \
+				and isinstance(expr[1], str):
+				newExpr = expr[:3] + [ self.evaluateExpression(sub, set(expr[2])) for sub in expr[3:] ]
+			else:
+				newExpr = self.evaluateExpression(expr, set())
+
+			# Constants that replaced calls may allow more folding
+			if sum(self.numEvaluated.values()) != numEvaluated:
+				newExpr = optimize(newExpr)
+
+			newProgram += [ newExpr ]
+
+		return newProgram
+
+	#
+	# Check if expr has no side effects.  locals is the set of local variable
+	# names in scope.
+	#
+	def isPure(self, expr, locals):
+		if isinstance(expr, int):
+			return True
+		elif isinstance(expr, str):
+			return expr in locals or expr in ( 'nil', 'false', 'true' )
+		elif not isinstance(expr, list) or len(expr) == 0:
+			return False
+
+		head = expr[0]
+		if head == 'let':
+			innerLocals = set(locals)
+			for var, value in expr[1]:
+				innerLocals.add(var)
+				if not self.isPure(value, innerLocals):
+					return False
+
+			return self.isSequencePure(expr[2:], innerLocals)
+		elif head == 'assign':
+			return expr[1] in locals and self.isPure(expr[2], locals)
+		elif not isinstance(head, str) or head in locals:
+			return False
+		elif head not in EVALUATE_PRIMITIVES and head not in EVALUATE_FORMS \
+			and head not in self.functions:
+			return False
+
+		return self.isSequencePure(expr[1:], locals)
+
+	def isSequencePure(self, sequence, locals):
+		for expr in sequence:
+			if not self.isPure(expr, locals):
+				return False
+
+		return True
+
+	#
+	# Replace calls in expr.  locals is the set of local variable names in
+	# scope.
+	#
+	def evaluateExpression(self, expr, locals):
+		if not isinstance(expr, list) or len(expr) == 0:
+			return expr
+
+		head = expr[0]
+		if head == 'quote':
+			return expr
+		elif head == 'let':
+			innerLocals = set(locals)
+			bindings = []
+			for var, value in expr[1]:
+				innerLocals.add(var)
+				bindings += [ [ var, self.evaluateExpression(value, innerLocals) ] ]
+
+			return [ 'let', bindings ] + [ self.evaluateExpression(sub, innerLocals) for sub in expr[2:] ]
+		elif head == 'function':
+			innerLocals = locals | set(expr[1])
+			return expr[:2] + [ self.evaluateExpression(sub, innerLocals) for sub in expr[2:] ]
+
+		expr = [ head ] + [ self.evaluateExpression(sub, locals) for sub in expr[1:] ]
+		if not isinstance(head, str) or head in locals or head not in self.functions:
+			return expr
+
+		args = expr[1:]
+		for arg in args:
+			if not isinstance(arg, int):
+				return expr
+
+		result = self.evaluateCall(head, [ arg & 0xffff for arg in args ])
+		if result == None:
+			return expr
+
+		self.numEvaluated[head] = self.numEvaluated.get(head, 0) + 1
+		return makeLegalConstant(result)
+
+	def evaluateCall(self, name, args):
+		key = ( name, tuple(args) )
+		if key not in self.results:
+			self.steps = 0
+			try:
+				self.results[key] = self.callFunction(name, args, 0)
+			except EvaluationFailed:
+				self.results[key] = None
+
+		return self.results[key]
+
+	def callFunction(self, name, args, depth):
+		params, body = self.functions[name]
+		if len(args) != len(params) or depth > self.MAX_CALL_DEPTH:
+			raise EvaluationFailed()
+
+		# Each variable is a list, so assignments are visible in all scopes
+		# that share it.
+		env = dict([ ( param, [ arg ] ) for param, arg in zip(params, args) ])
+		try:
+			return self.evaluateSequence(body, env, depth)
+		except LoopBreak:
+			raise EvaluationFailed()	# break outside a loop
+
+	def evaluateSequence(self, sequence, env, depth):
+		value = 0
+		for expr in sequence:
+			value = self.evaluate(expr, env, depth)
+
+		return value
+
+	def evaluate(self, expr, env, depth):
+		self.steps += 1
+		if self.steps > self.maxSteps:
+			raise EvaluationFailed()
+
+		if isinstance(expr, int):
+			return expr & 0xffff
+		elif isinstance(expr, str):
+			if expr in env:
+				if env[expr][0] == None:
+					raise EvaluationFailed()	# Used before it is initialized
+
+				return env[expr][0]
+			else:
+				return 1 if expr == 'true' else 0
+
+		head = expr[0]
+		if head == 'if':
+			if self.evaluate(expr[1], env, depth):
+				return self.evaluate(expr[2], env, depth)
+			elif len(expr) > 3:
+				return self.evaluate(expr[3], env, depth)
+			else:
+				return 0
+		elif head == 'begin':
+			return self.evaluateSequence(expr[1:], env, depth)
+		elif head == 'while':
+			try:
+				while self.evaluate(expr[1], env, depth):
+					self.evaluateSequence(expr[2:], env, depth)
+			except LoopBreak as exc:
+				return exc.value
+
+			return 0
+		elif head == 'break':
+			raise LoopBreak(self.evaluate(expr[1], env, depth) if len(expr) > 1 else 0)
+		elif head == 'let':
+			env = dict(env)
+			for var, value in expr[1]:
+				env[var] = [ None ]
+				env[var][0] = self.evaluate(value, env, depth)
+
+			return self.evaluateSequence(expr[2:], env, depth)
+		elif head == 'assign':
+			value = self.evaluate(expr[2], env, depth)
+			env[expr[1]][0] = value
+			return value
+		elif head == 'and':
+			for sub in expr[1:]:
+				if not self.evaluate(sub, env, depth):
+					return 0
+
+			return 1
+		elif head == 'or':
+			for sub in expr[1:]:
+				if self.evaluate(sub, env, depth):
+					return 1
+
+			return 0
+		elif head == 'not':
+			return 0 if self.evaluate(expr[1], env, depth) else 1
+		elif head in EVALUATE_PRIMITIVES:
+			if len(expr) != 3:
+				raise EvaluationFailed()
+
+			# Operands are evaluated in the same order as the compiled code
+			# (see Compiler.compilePrimitive), since they may assign locals.
+			if head in ( '<', '<=' ):
+				x = self.evaluate(expr[1], env, depth)
+				y = self.evaluate(expr[2], env, depth)
+			else:
+				y = self.evaluate(expr[2], env, depth)
+				x = self.evaluate(expr[1], env, depth)
+
+			return EVALUATE_PRIMITIVES[head](x, y)
+		else:
+			# Arguments are pushed from right to left
+			args = [ self.evaluate(arg, env, depth) for arg in reversed(expr[1:]) ]
+			return self.callFunction(head, list(reversed(args)), depth + 1)
+
+#
+# Loop invariant code motion.  This runs on the S-Expressions for the whole
+# program after inlining.  Arithmetic in a while loop (including the ones the
+# for and foreach macros expand to) whose operands don't change while the
+# loop runs is computed once before the loop into a local variable, which the
+# loop reads instead.  Global variables that are read in many places in a
+# loop are copied into a local variable the same way.  Reading a local takes
+# as many cycles as reading a global, but is one instruction instead of two.
+#
+# A global can only be treated this way if neither the loop nor any function
+# it calls assigns it.  Each named function has the set of globals it may
+# assign, including ones assigned by functions it calls.  A call through a
+# function pointer could call anything, so it is assumed to assign every
+# global, as is a store to a constant address below the hardware registers.
+# Stores to computed addresses are assumed to refer to the heap, since a
+# program can't get the address of a global variable.
+#
+# Arithmetic that may compute an address inside a heap object isn't moved
+# out of a loop that calls a function, since the call may garbage collect
+# (see mayBeDerivedPointer).
+#
+
+REGISTER_BASE = 0xf000
+
+class SideEffects:
+	def __init__(self):
+		self.assigned = set()		# Names of variables assigned
+		self.callees = set()		# Named functions called
+		self.unknown = False		# Calls through a function pointer or stores to globals
+
+class LoopOptimizer:
+	MIN_PROMOTED_READS = 5		# Copying a global into a local takes four instructions
+	INVARIANT_OPERATORS = set(EVALUATE_PRIMITIVES) | set([ 'and', 'or', 'not', 'gettag' ])
+
+	def __init__(self):
+		self.globalWrites = {}		# Function name -> set of globals it may assign, None if any
+		self.numHoisted = {}		# Function name -> number of values moved out of loops
+		self.nextTemporary = 0
+
+	# Like Inliner, an object file stores the results for the functions that
+	# were compiled into it.
+	def saveState(self, obj):
+		obj['globalWrites'] = dict([ ( name, None if writes == None else sorted(writes) )
+			for name, writes in self.globalWrites.items() ])
+
+	def loadState(self, obj):
+		for name, writes in obj['globalWrites'].items():
+			self.globalWrites[name] = None if writes == None else set(writes)
+
+	def optimizeProgram(self, program):
+		# A call to a function that is assigned anywhere may not call that
+		# function, so it is treated like a call through a function pointer.
+		assigned = set()
+		functions = {}
+		def findAssignments(expr):
+			if isinstance(expr, list) and len(expr) > 2 and expr[0] == 'assign':
+				assigned.add(expr[1])
+
+		for expr in program:
+			walkExpression(expr, findAssignments)
+			if isinstance(expr, list) and len(expr) > 3 and expr[0] == 'function' \
+				and isinstance(expr[1], str):
+				functions[expr[1]] = expr
+
+		self.functionNames = (set(self.globalWrites) | set(functions)) - assigned
+		effects = {}
+		for name, expr in functions.items():
+			effects[name] = SideEffects()
+			for sub in expr[3:]:
+				self.findEffects(sub, set(expr[2]), effects[name])
+
+			if effects[name].unknown:
+				self.globalWrites[name] = None
+			else:
+				self.globalWrites[name] = effects[name].assigned - set(expr[2])
+
+		# Add globals assigned by the functions each one calls, which may
+		# change the functions that call it, so repeat until nothing changes.
+		changed = True
+		while changed:
+			changed = False
+			for name, effect in effects.items():
+				if self.globalWrites[name] != None:
+					writes = self.addCalleeWrites(self.globalWrites[name], effect.callees)
+					if writes != self.globalWrites[name]:
+						self.globalWrites[name] = writes
+						changed = True
+
+		newProgram = []
+		for expr in program:
+			if isinstance(expr, list) and len(expr) > 3 and expr[0] == 'function' \
+				and isinstance(expr[1], str):
+				self.currentFunction = expr[1]
+				newProgram += [ expr[:3] + [ self.optimizeExpression(sub, set(expr[2]))
+					for sub in expr[3:] ] ]
+			else:
+				self.currentFunction = 'main'
+				newProgram += [ self.optimizeExpression(expr, set()) ]
+
+		return newProgram
+
+	# Returns None if any of the callees may assign any global
+	def addCalleeWrites(self, writes, callees):
+		writes = set(writes)
+		for callee in callees:
+			if self.globalWrites[callee] == None:
+				return None
+
+			writes |= self.globalWrites[callee]
+
+		return writes
+
+	#
+	# Record the variables expr assigns and the functions it calls in
+	# effects.  locals is the set of local variable names in scope.
+	#
+	def findEffects(self, expr, locals, effects):
+		if not isinstance(expr, list) or len(expr) == 0:
+			return
+
+		head = expr[0]
+		if head in ( 'quote', 'function' ):
+			# An anonymous function only runs if it is called through a pointer
+			return
+		elif head == 'let':
+			innerLocals = set(locals)
+			for var, value in expr[1]:
+				innerLocals.add(var)
+				self.findEffects(value, innerLocals, effects)
+
+			for sub in expr[2:]:
+				self.findEffects(sub, innerLocals, effects)
+
+			return
+		elif head == 'assign':
+			effects.assigned.add(expr[1])
+		elif head == 'store':
+			if isinstance(expr[1], int) and (expr[1] & 0xffff) < REGISTER_BASE:
+				effects.unknown = True
+		elif not isinstance(head, str) or head in locals:
+			effects.unknown = True
+		elif head not in SPECIAL_FORMS and head not in Compiler.PRIMITIVES:
+			if head in self.functionNames:
+				effects.callees.add(head)
+			else:
+				effects.unknown = True
+
+		for sub in expr:
+			self.findEffects(sub, locals, effects)
+
+	#
+	# Move invariant values out of loops in expr.  locals is the set of local
+	# variable names in scope.
+	#
+	def optimizeExpression(self, expr, locals):
+		if not isinstance(expr, list) or len(expr) == 0:
+			return expr
+
+		head = expr[0]
+		if head == 'quote':
+			return expr
+		elif head == 'let':
+			innerLocals = set(locals)
+			bindings = []
+			for var, value in expr[1]:
+				innerLocals.add(var)
+				bindings += [ [ var, self.optimizeExpression(value, innerLocals) ] ]
+
+			return [ 'let', bindings ] + [ self.optimizeExpression(sub, innerLocals) for sub in expr[2:] ]
+		elif head == 'function':
+			# Anonymous functions can't use variables from the enclosing function
+			return expr[:2] + [ self.optimizeExpression(sub, set(expr[1])) for sub in expr[2:] ]
+
+		# Inner loops are done first, so values they move out can be moved
+		# out of the enclosing loop as well.
+		expr = [ self.optimizeExpression(sub, locals) for sub in expr ]
+		if head == 'while' and len(expr) > 1:
+			return self.optimizeLoop(expr, locals)
+
+		return expr
+
+	def optimizeLoop(self, loop, locals):
+		effects = SideEffects()
+		self.findEffects(loop, locals, effects)
+		self.loopLocals = locals
+		self.varying = effects.assigned | findBoundNames(loop)
+		self.loopCalls = effects.unknown or len(effects.callees) > 0
+		if effects.unknown:
+			self.written = None
+		else:
+			self.written = self.addCalleeWrites(effects.assigned, effects.callees)
+
+		self.hoisted = []
+		loop = [ 'while' ] + [ self.hoistInvariants(sub) for sub in loop[1:] ]
+
+		reads = {}
+		def countRead(name):
+			reads[name] = reads.get(name, 0) + 1
+			return name
+
+		self.mapReads(loop, countRead)
+		renames = {}
+		for name, count in sorted(reads.items()):
+			if count >= self.MIN_PROMOTED_READS and name not in locals \
+				and name not in SPECIAL_FORMS and name not in Compiler.PRIMITIVES \
+				and self.isInvariant(name):
+				renames[name] = self.newTemporary()
+				self.hoisted += [ [ renames[name], name ] ]
+
+		if not self.hoisted:
+			return loop
+
+		self.numHoisted[self.currentFunction] = self.numHoisted.get(self.currentFunction, 0) \
+			+ len(self.hoisted)
+		return [ 'let', self.hoisted, self.mapReads(loop, lambda name : renames.get(name, name)) ]
+
+	def newTemporary(self):
+		temp = '$loop%d' % self.nextTemporary
+		self.nextTemporary += 1
+		return temp
+
+	# Check if expr has the same value on every iteration of the current loop
+	def isInvariant(self, expr):
+		if isinstance(expr, int):
+			return True
+		elif isinstance(expr, str):
+			if isStringLiteral(expr) or expr in self.varying:
+				return False
+			elif expr in self.loopLocals or expr in ( 'nil', 'false', 'true' ):
+				return True
+			else:
+				# Global variable
+				return self.written != None and expr not in self.written \
+					and expr not in self.functionNames
+		elif isinstance(expr, list) and len(expr) > 1 and expr[0] in self.INVARIANT_OPERATORS:
+			for sub in expr[1:]:
+				if not self.isInvariant(sub):
+					return False
+
+			return True
+
+		return False
+
+	# Replace the largest invariant sub-expressions with temporaries
+	def hoistInvariants(self, expr):
+		if not isinstance(expr, list) or len(expr) == 0 or expr[0] in ( 'quote', 'function' ):
+			return expr
+		elif self.isInvariant(expr) and not (self.loopCalls and mayBeDerivedPointer(expr)):
+			for temp, value in self.hoisted:
+				if value == expr:
+					return temp
+
+			temp = self.newTemporary()
+			self.hoisted += [ [ temp, expr ] ]
+			return temp
+		elif expr[0] in ( '+', '-' ) and len(expr) == 3:
+			# Add the invariant terms of a sum together outside the loop.
+			# Other terms stay in the same order.
+			terms = []
+			flattenSum(expr, 1, terms)
+			invariant = [ ( sign, term ) for sign, term in terms if self.isInvariant(term) ]
+			if 1 < len(invariant) < len(terms):
+				invariant.sort(key=lambda term : -term[0])	# Positive terms first
+				return self.makeSum([ ( 1, self.hoistInvariants(self.makeSum(invariant)) ) ]
+					+ [ ( sign, self.hoistInvariants(term) ) for sign, term in terms
+					if not self.isInvariant(term) ])
+
+			return [ self.hoistInvariants(sub) for sub in expr ]
+		elif expr[0] == 'let':
+			return [ 'let', [ [ var, self.hoistInvariants(value) ] for var, value in expr[1] ] ] \
+				+ [ self.hoistInvariants(sub) for sub in expr[2:] ]
+		else:
+			return [ self.hoistInvariants(sub) for sub in expr ]
+
+	# Build an add/subtract chain from a list of (sign, term)
+	def makeSum(self, terms):
+		sign, result = terms[0]
+		if sign < 0:
+			result = [ '-', 0, result ]
+
+		for sign, term in terms[1:]:
+			result = [ '+' if sign > 0 else '-', result, term ]
+
+		return result
+
+	#
+	# Replace each variable read in expr (outside of anonymous functions) with
+	# fn(name).  Names of forms and functions that are called are included.
+	#
+	def mapReads(self, expr, fn):
+		if isinstance(expr, str):
+			return expr if isStringLiteral(expr) else fn(expr)
+		elif not isinstance(expr, list) or len(expr) == 0 or expr[0] in ( 'quote', 'function' ):
+			return expr
+		elif expr[0] == 'let':
+			return [ 'let', [ [ var, self.mapReads(value, fn) ] for var, value in expr[1] ] ] \
+				+ [ self.mapReads(sub, fn) for sub in expr[2:] ]
+		elif expr[0] == 'assign':
+			return expr[:2] + [ self.mapReads(sub, fn) for sub in expr[2:] ]
+		else:
+			return [ self.mapReads(sub, fn) for sub in expr ]
+
+#
+# Common subexpression elimination.  This runs on the S-Expressions for each
+# function just before code is generated.  When an expression made of
+# primitives with no side effects is evaluated again in straight line code,
+# the first evaluation also stores the value into a temporary local variable
+# (with assign, which leaves the value on the stack) and the later ones read
+# the variable.  If the value is needed again right after it is computed,
+# for example when both operands of a primitive are the same, the peephole
+# optimizer replaces the read with a dup instruction and removes the store if
+# nothing else reads the variable.  The temporaries are declared without an
+# initial value at the start of the function.
+#
+# A value can't be reused after something assigns a variable it depends on.
+# Memory reads (load, first, rest) also can't be reused after a store, and
+# neither can memory or global variable reads after a function call.  Nor
+# can arithmetic that may compute an address inside a heap object, since the
+# call may garbage collect (see mayBeDerivedPointer).  Reads of hardware
+# registers are never reused.  Values computed in if branches, in the
+# operands of and/or after the first, or in loops may not have been computed
+# afterward, so they are only reused within them.
+#
+
+class AvailableValue:
+	def __init__(self, expr, names, readsMemory, readsGlobals, derivedPointer):
+		self.expr = expr				# With common subexpressions replaced
+		self.names = names				# Variables the value depends on
+		self.readsMemory = readsMemory
+		self.readsGlobals = readsGlobals
+		self.derivedPointer = derivedPointer
+		self.temp = None				# Set when the value is reused
+
+class ReusedValue:
+	def __init__(self, value):
+		self.value = value
+
+#
+# Values that have been computed on every path to the current point in the
+# code.  Values computed in an inner block of code (parent is the enclosing
+# one) are only available there, but anything the inner code invalidates is
+# invalid in the enclosing code as well.
+#
+class AvailableValues:
+	def __init__(self, parent=None, inherit=True):
+		self.parent = parent
+		self.values = dict(parent.values) if parent and inherit else {}
+
+	def kill(self, isInvalid):
+		for key, value in self.values.items():
+			if isInvalid(value):
+				del self.values[key]
+
+		if self.parent:
+			self.parent.kill(isInvalid)
+
+class SubexpressionEliminator:
+	MIN_CYCLES = 5		# Cheaper values don't save anything when read from a local
+
+	def __init__(self):
+		self.numReused = {}		# Function name -> number of evaluations replaced
+		self.nextTemporary = 0
+
+	def eliminateProgram(self, program):
+		newProgram = []
+		for expr in program:
+			if isinstance(expr, list) and len(expr) > 3 and expr[0] == 'function' \
+				and isinstance(expr[1], str):
+				newProgram += [ expr[:3] + self.eliminateFunction(expr[1], expr[2], expr[3:]) ]
+			else:
+				newProgram += self.eliminateFunction('main', [], [ expr ])
+
+		return newProgram
+
+	# Returns the new body
+	def eliminateFunction(self, name, params, body):
+		if 'getbp' in findIdentifiers(body):
+			return body		# May read the stack frame directly
+
+		self.currentFunction = name
+		self.temps = []
+		available = AvailableValues()
+		body = [ self.eliminateExpression(sub, available, set(params)) for sub in body ]
+		body = [ self.materialize(sub) for sub in body ]
+		if self.temps:
+			return [ [ 'let', [ [ temp ] for temp in self.temps ] ] + body ]
+
+		return body
+
+	#
+	# Find common subexpressions in expr, which is evaluated after the values
+	# in available have been computed.  locals is the set of local variable
+	# names in scope.  Returns the expression with AvailableValue and
+	# ReusedValue objects in place of the values that may be reused.
+	#
+	def eliminateExpression(self, expr, available, locals):
+		if not isinstance(expr, list) or len(expr) == 0:
+			return expr
+
+		key = None
+		if self.isCandidate(expr, locals):
+			key = str(expr)
+			if key in available.values:
+				value = available.values[key]
+				if value.temp == None:
+					value.temp = '$cse%d' % self.nextTemporary
+					self.nextTemporary += 1
+					self.temps += [ value.temp ]
+
+				self.numReused[self.currentFunction] = self.numReused.get(
+					self.currentFunction, 0) + 1
+				return ReusedValue(value)
+
+		head = expr[0]
+		if head == 'quote':
+			return expr
+		elif head == 'function':
+			# Anonymous functions have their own temporaries
+			outerFunction, outerTemps = self.currentFunction, self.temps
+			body = self.eliminateFunction(outerFunction, expr[1], expr[2:])
+			self.currentFunction, self.temps = outerFunction, outerTemps
+			return expr[:2] + body
+		elif head == 'let':
+			innerLocals = set(locals)
+			bindings = []
+			for var, value in expr[1]:
+				innerLocals.add(var)
+				value = self.eliminateExpression(value, available, innerLocals)
+				available.kill(lambda entry : var in entry.names)
+				bindings += [ [ var, value ] ]
+
+			body = [ self.eliminateExpression(sub, available, innerLocals) for sub in expr[2:] ]
+
+			# Values using these variables are not valid outside the let
+			for var, value in expr[1]:
+				available.kill(lambda entry : var in entry.names)
+
+			return [ 'let', bindings ] + body
+		elif head == 'assign':
+			value = self.eliminateExpression(expr[2], available, locals)
+			available.kill(lambda entry : expr[1] in entry.names)
+			return [ 'assign', expr[1], value ]
+		elif head == 'if':
+			cond = self.eliminateExpression(expr[1], available, locals)
+			return [ 'if', cond ] + [ self.eliminateExpression(sub, AvailableValues(available), locals)
+				for sub in expr[2:] ]
+		elif head in ( 'and', 'or' ):
+			first = self.eliminateExpression(expr[1], available, locals)
+			conditional = AvailableValues(available)
+			return [ head, first ] + [ self.eliminateExpression(sub, conditional, locals)
+				for sub in expr[2:] ]
+		elif head == 'while':
+			# Starts with nothing available, since the values from before the
+			# loop may have been invalidated by an earlier iteration.
+			loop = AvailableValues(available, inherit=False)
+			return [ 'while' ] + [ self.eliminateExpression(sub, loop, locals) for sub in expr[1:] ]
+		elif head in ( 'begin', 'break', 'not' ):
+			return [ head ] + [ self.eliminateExpression(sub, available, locals) for sub in expr[1:] ]
+		elif isinstance(head, str) and head in Compiler.PRIMITIVES:
+			# Same order as Compiler.compilePrimitive
+			if head in ( '<', '<=' ):
+				order = range(1, len(expr))
+			else:
+				order = range(len(expr) - 1, 0, -1)
+
+			newExpr = list(expr)
+			for index in order:
+				newExpr[index] = self.eliminateExpression(expr[index], available, locals)
+
+			if head == 'store':
+				available.kill(lambda entry : entry.readsMemory)
+			elif key:
+				names = self.findVariables(expr)
+				value = AvailableValue(newExpr, names, self.readsMemory(expr), bool(names - locals),
+					mayBeDerivedPointer(expr))
+				available.values[key] = value
+				return value
+
+			return newExpr
+		else:
+			# Function call.  Arguments are evaluated from right to left,
+			# then the function.
+			newExpr = list(expr)
+			for index in range(len(expr) - 1, -1, -1):
+				newExpr[index] = self.eliminateExpression(expr[index], available, locals)
+
+			available.kill(lambda entry : entry.readsMemory or entry.readsGlobals
+				or entry.derivedPointer)
+			return newExpr
+
+	# Check if expr is a primitive without side effects that is expensive
+	# enough to be worth reusing.
+	def isCandidate(self, expr, locals):
+		return self.isPrimitiveValue(expr) and self.estimateCycles(expr, locals) >= self.MIN_CYCLES
+
+	def isPrimitiveValue(self, expr):
+		if isinstance(expr, int) or isinstance(expr, str):
+			return True
+		elif not isinstance(expr, list) or len(expr) < 2 or not isinstance(expr[0], str) \
+			or expr[0] not in Compiler.PRIMITIVES or expr[0] == 'store' \
+			or len(expr) - 1 != Compiler.PRIMITIVES[expr[0]][1] or self.readsRegister(expr):
+			return False
+
+		for sub in expr[1:]:
+			if not self.isPrimitiveValue(sub):
+				return False
+
+		return True
+
+	def estimateCycles(self, expr, locals):
+		if isinstance(expr, int):
+			return 1	# push
+		elif isinstance(expr, str):
+			return 3	# getlocal, or push and load
+
+		opcode = Compiler.PRIMITIVES[expr[0]][0]
+		return sum([ self.estimateCycles(sub, locals) for sub in expr[1:] ]) \
+			+ (2 if opcode == -1 else instructionCycles(opcode))
+
+	# Variables and constants a primitive value uses
+	def findVariables(self, expr):
+		if isinstance(expr, list):
+			names = set()
+			for sub in expr[1:]:
+				names |= self.findVariables(sub)
+
+			return names
+		elif isinstance(expr, str) and not isStringLiteral(expr) \
+			and expr not in ( 'nil', 'false', 'true' ):
+			return set([ expr ])
+		else:
+			return set()
+
+	# Reading a hardware register may have side effects, such as removing a
+	# value from a FIFO, so every read must be made.  Computed addresses are
+	# assumed to refer to the heap, as in LoopOptimizer.
+	def readsRegister(self, expr):
+		if expr[0] in ( 'load', 'first' ):
+			offset = 0
+		elif expr[0] in ( 'rest', 'second' ):
+			offset = 1
+		else:
+			return False
+
+		return isinstance(expr[1], int) and ((expr[1] + offset) & 0xffff) >= REGISTER_BASE
+
+	def readsMemory(self, expr):
+		if not isinstance(expr, list):
+			return False
+		elif expr[0] in ( 'load', 'first', 'rest', 'second' ):
+			return True
+
+		for sub in expr[1:]:
+			if self.readsMemory(sub):
+				return True
+
+		return False
+
+	# Convert the result of eliminateExpression back into an S-Expression
+	def materialize(self, expr):
+		if isinstance(expr, AvailableValue):
+			if expr.temp:
+				return [ 'assign', expr.temp, self.materialize(expr.expr) ]
+
+			return self.materialize(expr.expr)
+		elif isinstance(expr, ReusedValue):
+			return expr.value.temp
+		elif isinstance(expr, list) and len(expr) > 0 and expr[0] not in ( 'quote', 'function' ):
+			if expr[0] == 'let':
+				return [ 'let', [ [ var, self.materialize(value) ] for var, value in expr[1] ] ] \
+					+ [ self.materialize(sub) for sub in expr[2:] ]
+
+			return [ self.materialize(sub) for sub in expr ]
+
+		return expr
+
+#
+# Peephole optimizer.  This runs on the generated code for each function
+# after all code has been emitted, but before labels and references to
+# globals are converted to addresses.
+#
+
+# Clock cycles each instruction takes on the core, used to estimate savings.
+# Anything not listed takes one cycle.
+INSTRUCTION_CYCLES = {
+	OP_RETURN : 3,
+	OP_GETLOCAL : 3,
+	OP_POP : 2,
+	OP_LOAD : 2,
+	OP_REST : 2,
+	OP_STORE : 2,
+	OP_SETTAG : 2,
+	OP_BFALSE : 2,
+	OP_ADD : 2,
+	OP_SUB : 2,
+	OP_GTR : 2,
+	OP_GTE : 2,
+	OP_EQ : 2,
+	OP_NEQ : 2,
+	OP_AND : 2,
+	OP_OR : 2,
+	OP_XOR : 2,
+	OP_LSHIFT : 2,
+	OP_RSHIFT : 2
+}
+
+def instructionCycles(op):
+	return INSTRUCTION_CYCLES.get(op, 1)
+
+class PeepholeInstruction:
+	def __init__(self, op, param=0):
+		self.op = op
+		self.param = param
+		self.branchTarget = None	# Label this branches to
+		self.fixupTarget = None		# Global fixup for the parameter
+		self.labels = []			# Labels that refer to this instruction
+
+def removeSequence(match, following):
+	return []
+
+# setlocal N, getlocal N reads back the value that is already on the stack
+def duplicateStored(match, following):
+	if match[0].param == match[1].param:
+		return [ match[0], PeepholeInstruction(OP_DUP) ]
+
+	return None
+
+# setlocal N, pop, getlocal N (an assignment followed by a read of the same
+# variable) leaves the value on the stack, so only the setlocal is needed.
+def removeReload(match, following):
+	if match[0].param == match[2].param:
+		return [ match[0] ]
+
+	return None
+
+# A branch on a constant is either always or never taken
+def foldConstantBranch(match, following):
+	push, bfalse = match
+	if push.fixupTarget:
+		return None
+
+	if push.param != 0:
+		return []
+
+	goto = PeepholeInstruction(OP_GOTO)
+	goto.branchTarget = bfalse.branchTarget
+	return [ goto ]
+
+def removeGotoNext(match, following):
+	if following and match[0].branchTarget in following.labels:
+		return []
+
+	return None
+
+#
+# Each entry is a sequence of opcodes and a function that is called with the
+# matching instructions and the instruction after them (or None).  If it
+# returns a list of instructions, they replace the sequence.  If it returns
+# None, the code is left alone.
+#
+PEEPHOLE_PATTERNS = [
+	( ( OP_PUSH, OP_POP ), removeSequence ),
+	( ( OP_GETLOCAL, OP_POP ), removeSequence ),
+	( ( OP_DUP, OP_POP ), removeSequence ),
+	( ( OP_GETBP, OP_POP ), removeSequence ),
+	( ( OP_SETLOCAL, OP_POP, OP_GETLOCAL ), removeReload ),
+	( ( OP_SETLOCAL, OP_GETLOCAL ), duplicateStored ),
+	( ( OP_PUSH, OP_BFALSE ), foldConstantBranch ),
+	( ( OP_GOTO, ), removeGotoNext )
+]
+
+#
+# Apply PEEPHOLE_PATTERNS to code (a list of PeepholeInstructions) until none
+# match.  A sequence only matches if no label refers to any instruction but
+# its first, since something may branch into the middle of it.  Returns the
+# estimated number of cycles saved.
+#
+def peepholeOptimize(code):
+	cyclesSaved = 0
+	changed = True
+	while changed:
+		changed = False
+		index = 1	# Skip the reserve at the beginning
+		while index < len(code) - 1:
+			for pattern, transform in PEEPHOLE_PATTERNS:
+				end = index + len(pattern)
+				if end >= len(code):
+					continue
+
+				match = code[index:end]
+				if tuple([ instr.op for instr in match ]) != pattern:
+					continue
+
+				if [ instr for instr in match[1:] if instr.labels ]:
+					continue
+
+				replacement = transform(match, code[end] if end < len(code) - 1 else None)
+				if replacement == None:
+					continue
+
+				# Labels move to the start of the replacement, or the next
+				# instruction if the sequence was removed.
+				labels = match[0].labels
+				match[0].labels = []
+				if replacement:
+					replacement[0].labels = labels
+				else:
+					code[end].labels = labels + code[end].labels
+
+				cyclesSaved += sum([ instructionCycles(instr.op) for instr in match ])
+				cyclesSaved -= sum([ instructionCycles(instr.op) for instr in replacement ])
+				code[index:end] = replacement
+				changed = True
+				break
+			else:
+				index += 1
+
+	return cyclesSaved
+
+#
+# Remove setlocal instructions for local variables (not parameters, which
+# are also used to pass arguments to tail calls) that are never read.
+# setlocal leaves the value on the stack, so removing it doesn't change
+# anything else.  A function that uses getbp may read its frame directly, so
+# it is left alone.  This must not be used for a function that makes tail
+# calls through a pointer, which reads some locals at different offsets
+# after moving the frame (see Compiler.compileTailCall).  Returns the
+# estimated number of cycles saved.
+#
+def removeDeadStores(code):
+	read = set()
+	for instr in code:
+		if instr.op == OP_GETBP:
+			return 0
+		elif instr.op == OP_GETLOCAL:
+			read.add(instr.param)
+
+	cyclesSaved = 0
+	index = 1
+	while index < len(code) - 1:
+		instr = code[index]
+		if instr.op == OP_SETLOCAL and instr.param >= 0x8000 and instr.param not in read:
+			code[index + 1].labels = instr.labels + code[index + 1].labels
+			del code[index]
+			cyclesSaved += instructionCycles(OP_SETLOCAL)
+		else:
+			index += 1
+
+	return cyclesSaved
+
+#
+# A straight line sequence of instructions that is only entered at the top.
+# If the last instruction is not a goto or return, execution falls through
+# to the block after it in the original order.
+#
+class BasicBlock:
+	def __init__(self, instructions):
+		self.instructions = instructions
+		self.fallThrough = None		# Next block, if execution can fall into it
+
+	def getTerminator(self):
+		return self.instructions[-1]
+
+	def isOnly(self, op):
+		return len(self.instructions) == 1 and self.instructions[0].op == op
+
+def splitBasicBlocks(code):
+	blocks = []
+	start = 0
+	for index, instr in enumerate(code):
+		if index > start and instr.labels:
+			blocks += [ BasicBlock(code[start:index]) ]
+			start = index
+
+		if instr.op in ( OP_GOTO, OP_BFALSE, OP_RETURN ):
+			blocks += [ BasicBlock(code[start:index + 1]) ]
+			start = index + 1
+
+	if start < len(code):
+		blocks += [ BasicBlock(code[start:]) ]
+
+	for block, nextBlock in zip(blocks, blocks[1:]):
+		if block.getTerminator().op not in ( OP_GOTO, OP_RETURN ):
+			block.fallThrough = nextBlock
+
+	return blocks
+
+#
+# Build a control flow graph for code (excluding the placeholder at the end)
+# and simplify it:
+#   - Branches to a block that only contains a goto go directly to the
+#     final destination (jump threading).
+#   - A goto to a block that only contains a return becomes a return.
+#   - Blocks that can't be reached from the entry point are removed.
+#   - Blocks are reordered so that, where possible, the target of a goto
+#     comes right after it, so the goto can be removed.
+# Returns the new list of instructions.
+#
+def optimizeControlFlow(code):
+	blocks = splitBasicBlocks(code)
+	labelBlocks = {}
+	for block in blocks:
+		for label in block.instructions[0].labels:
+			labelBlocks[label] = block
+
+	def branchTarget(block):
+		instr = block.getTerminator()
+		if instr.op in ( OP_GOTO, OP_BFALSE ) and instr.branchTarget:
+			return labelBlocks[instr.branchTarget]
+
+		return None
+
+	# Jump threading
+	for block in blocks:
+		target = branchTarget(block)
+		if not target:
+			continue
+
+		instr = block.getTerminator()
+		visited = set([ block ])
+		while target.isOnly(OP_GOTO) and branchTarget(target) and target not in visited:
+			visited.add(target)
+			instr.branchTarget = target.instructions[0].branchTarget
+			target = labelBlocks[instr.branchTarget]
+
+		if instr.op == OP_GOTO and target.isOnly(OP_RETURN):
+			instr.op = OP_RETURN
+			instr.branchTarget = None
+
+	# Find reachable blocks
+	reachable = set()
+	worklist = [ blocks[0] ]
+	while worklist:
+		block = worklist.pop()
+		if block in reachable:
+			continue
+
+		reachable.add(block)
+		for successor in ( block.fallThrough, branchTarget(block) ):
+			if successor:
+				worklist += [ successor ]
+
+	blocks = [ block for block in blocks if block in reachable ]
+
+	# Blocks that fall through into each other must stay together, so group
+	# them into chains.  The first chain always contains the entry point.
+	fallThroughTargets = set([ block.fallThrough for block in blocks ])
+	chains = []
+	chainStarts = {}
+	for block in blocks:
+		if block in fallThroughTargets:
+			continue
+
+		chain = [ block ]
+		while chain[-1].fallThrough:
+			chain += [ chain[-1].fallThrough ]
+
+		chainStarts[block] = len(chains)
+		chains += [ chain ]
+
+	# Lay out chains, following gotos where possible
+	placed = [ False for chain in chains ]
+	layout = []
+	chainIndex = 0
+	while chainIndex != None:
+		placed[chainIndex] = True
+		layout += chains[chainIndex]
+		chainIndex = None
+		last = layout[-1]
+		if last.getTerminator().op == OP_GOTO:
+			target = chainStarts.get(branchTarget(last))
+			if target != None and not placed[target]:
+				chainIndex = target
+
+		if chainIndex == None and False in placed:
+			chainIndex = placed.index(False)
+
+	newCode = []
+	for block, nextBlock in zip(layout, layout[1:] + [ None ]):
+		newCode += block.instructions
+		if nextBlock and block.getTerminator().op == OP_GOTO and branchTarget(block) == nextBlock:
+			# Execution will fall through into the target.  Keep any labels
+			# on the goto.
+			goto = newCode.pop()
+			nextBlock.instructions[0].labels += goto.labels
+
+	return newCode
+
+def decodeFunction(function, globalFixups):
+	code = [ PeepholeInstruction(word >> 16, word & 0xffff) for word in function.instructions ]
+	code += [ PeepholeInstruction(None) ]	# Placeholder for labels at the end
+	for offset, label in function.localFixups:
+		code[offset].branchTarget = label
+		code[label.address].labels += [ label ]
+
+	for offset, target in globalFixups:
+		code[offset].fixupTarget = target
+
+	return code
+
+# Returns a list of (offset, target) global fixups
+def encodeFunction(function, code):
+	for address, instr in enumerate(code):
+		for label in instr.labels:
+			label.address = address
+
+	code = code[:-1]
+	function.instructions = [ (instr.op << 16) | instr.param for instr in code ]
+	function.localFixups = []
+	globalFixups = []
+	for offset, instr in enumerate(code):
+		if instr.branchTarget:
+			function.localFixups += [ ( offset, instr.branchTarget ) ]
+
+		if instr.fixupTarget:
+			globalFixups += [ ( offset, instr.fixupTarget ) ]
+
+	return globalFixups
+
+#
+# Change in the number of words on the stack for instructions that don't
+# branch, call, or reserve stack space.
+#
+STACK_EFFECTS = {
+	OP_PUSH : 1,
+	OP_GETLOCAL : 1,
+	OP_DUP : 1,
+	OP_GETBP : 1,
+	OP_POP : -1,
+	OP_BFALSE : -1,
+	OP_STORE : -1,
+	OP_SETTAG : -1,
+	OP_ADD : -1,
+	OP_SUB : -1,
+	OP_GTR : -1,
+	OP_GTE : -1,
+	OP_EQ : -1,
+	OP_NEQ : -1,
+	OP_AND : -1,
+	OP_OR : -1,
+	OP_XOR : -1,
+	OP_LSHIFT : -1,
+	OP_RSHIFT : -1
+}
+
+def resolveFunction(target):
+	if isinstance(target, Symbol) and target.type == Symbol.FUNCTION:
+		return target.function
+	elif isinstance(target, Function):
+		return target
+	else:
+		return None
+
+#
+# Follow all paths through a function's code (from decodeFunction), tracking
+# the number of words on the stack below the base pointer, counting the top
+# of stack register, which is written to memory when something is pushed.
+# entryDepth is the number when the function starts.  Returns the most words
+# the function itself uses and a list of (depth, offset) for its calls, where
+# depth is the number of words below the frame where the callee's frame
+# starts and offset is the call instruction, or the goto for a tail call.
+#
+def findStackUse(function, code, entryDepth):
+	calls = []
+	depths = { 0 : entryDepth }
+	maxDepth = entryDepth
+	worklist = [ 0 ]
+	while worklist:
+		offset = worklist.pop()
+		depth = depths[offset]
+		instr = code[offset]
+		successors = [ offset + 1 ]
+		if instr.op == OP_RESERVE:
+			# The reserve at the start of the function is filled in later
+			depth += function.numLocalVariables if offset == 0 else instr.param
+		elif instr.op == OP_CLEANUP:
+			depth -= instr.param
+		elif instr.op == OP_CALL:
+			# A tail call through a function pointer calls a label in this
+			# function, which then jumps to the callee (see
+			# Compiler.compileTailCall), so it is counted like any other call.
+			calls += [ ( depth, offset ) ]
+		elif instr.op == OP_RETURN:
+			successors = []
+		elif instr.op == OP_GOTO:
+			if instr.branchTarget:
+				successors = [ instr.branchTarget.address ]
+			else:
+				# Tail call, which reuses this function's frame
+				calls += [ ( 0, offset ) ]
+				successors = []
+		elif instr.op == OP_BFALSE:
+			depth -= 1
+			successors += [ instr.branchTarget.address ]
+		else:
+			depth += STACK_EFFECTS.get(instr.op, 0)
+
+		maxDepth = max(maxDepth, depth)
+		for successor in successors:
+			if depths.get(successor, -0x10000) < depth:
+				depths[successor] = depth
+				worklist += [ successor ]
+
+	return maxDepth, calls
+
+#
+# Run the peephole and control flow optimizations on a function.
+# globalFixups is the list of (offset, target) tuples for this function.
+# Returns the updated list and records the number of instructions and
+# cycles saved in the function.
+#
+def optimizeFunction(function, globalFixups):
+	code = decodeFunction(function, globalFixups)
+	originalLength = len(code)
+	cyclesSaved = peepholeOptimize(code)
+	if not function.tailCallSlots:
+		cyclesSaved += removeDeadStores(code)
+
+	peepholeLength = len(code)
+
+	# Labels past the last instruction aren't part of any block.  That
+	# can't happen with code from the compiler, since a function always ends
+	# with a return or goto.
+	if not code[-1].labels:
+		code = optimizeControlFlow(code[:-1]) + [ code[-1] ]
+
+	controlFlowLength = len(code)
+	cyclesSaved += peepholeOptimize(code)
+
+	function.instructionsRemoved = originalLength - peepholeLength + controlFlowLength - len(code)
+	function.cyclesRemoved = cyclesSaved
+	function.controlFlowRemoved = peepholeLength - controlFlowLength
+	return encodeFunction(function, code)
+
+#
+# For debugging
+#
+
+# name, hasparam
+disasmTable = {
+	OP_NOP			: ('nop', False),
+	OP_CALL 		: ('call', False),
+	OP_RETURN 		: ('return', False),
+	OP_CLEANUP 		: ('cleanup', True),
+	OP_POP 			: ('pop', False),
+	OP_ADD 			: ('add', False),
+	OP_SUB 			: ('sub', False),
+	OP_PUSH 		: ('push', True),
+	OP_LOAD 		: ('load', False),
+	OP_STORE 		: ('store', False),
+	OP_GETLOCAL 	: ('getlocal', True),
+	OP_SETLOCAL 	: ('setlocal', True),
+	OP_GOTO 		: ('goto', True),
+	OP_BFALSE 		: ('bfalse', True),
+	OP_REST 		: ('rest', False),
+	OP_RESERVE 		: ('reserve', True),
+	OP_GTR			: ('gtr', False),
+	OP_GTE			: ('gte', False),
+	OP_EQ			: ('eq', False),
+	OP_NEQ			: ('neq', False),
+	OP_DUP			: ('dup', False),
+	OP_GETTAG		: ('gettag', False),
+	OP_SETTAG		: ('settag', False),
+	OP_AND			: ('and', False),
+	OP_OR			: ('or', False),
+	OP_XOR			: ('xor', False),
+	OP_LSHIFT		: ('lshift', False),
+	OP_RSHIFT		: ('rshift', False),
+	OP_GETBP		: ('getbp', False)
+}
+
+def disassemble(outfile, instructions, baseAddress):
+	for pc, word in enumerate(instructions):
+		outfile.write('' + str(baseAddress + pc))
+		opcode = (word >> 16)
+		name, hasParam = disasmTable[opcode]
+		if hasParam:
+			paramValue = word & 0xffff
+			if paramValue & 0x8000:
+				paramValue = -(((paramValue ^ 0xffff) + 1) & 0xffff)
+
+			outfile.write('\t' + name + ' ' + str(paramValue) + '\n')
+		else:
+			outfile.write('\t' + name + '\n')
+
+def prettyPrintSExpr(listfile, expr, indent = 0):
+	if isinstance(expr, list):
+		if len(expr) > 0 and expr[0] == 'function':
+			listfile.write('\n')
+
+		listfile.write('\n')
+		for x in range(indent):
+			listfile.write('  ')
+		
+		listfile.write('(')
+		for elem in expr:
+			if elem != expr[0]:
+				listfile.write(' ')
+
+			prettyPrintSExpr(listfile, elem, indent + 1)
+			
+		listfile.write(')')
+	else:
+		listfile.write(str(expr))
+
+
+#
+# The macro processor is actually a small lisp interpreter
+# When we see macro, we evaluate its expression with the arguments as parameters.
+#
+class MacroProcessor:
+	def __init__(self):
 		self.macroList = {}
+		self.warnings = []
 
 	def expandBackquote(self, expr, env):
 		if isinstance(expr, list):
@@ -1136,10 +3688,9 @@ class MacroProcessor:
 				# the result.
 				argNames, body = self.macroList[statement[0]]
 				if len(argNames) != len(statement) - 1:
-					print 'warning: macro expansion of %s has the wrong number of arguments' % statement[0]
-					print 'expected %d got %d:' % (len(argNames), len(statement) - 1)
-					for arg in statement[1:]:
-						print arg
+					self.warnings += [ 'macro expansion of %s has the wrong number of arguments\n' % statement[0]
+						+ 'expected %d got %d:\n' % (len(argNames), len(statement) - 1)
+						+ ''.join([ str(arg) + '\n' for arg in statement[1:] ]) ]
 
 				env = {}
 				for name, value in zip(argNames, statement[1:]):
@@ -1151,21 +3702,410 @@ class MacroProcessor:
 		else:
 			return statement
 
-parser = Parser()
-parser.parseFile('runtime.lisp')
-for filename in sys.argv[1:]:
-	parser.parseFile(filename)
+RUNTIME_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'runtime.lisp')
 
-macro = MacroProcessor()
-expanded = macro.macroPreProcess(parser.getProgram())
+# Garbage collectors that can be compiled along with the runtime.  Each is in
+# a file named gc-<name>.lisp next to runtime.lisp.
+COLLECTORS = ( 'mark-sweep', 'copying' )
 
-optimized = [ optimize(sub) for sub in expanded ]
+def getCollectorFile(collector):
+	if collector not in COLLECTORS:
+		raise Exception('unknown garbage collector ' + collector)
 
-compiler = Compiler()
-code = compiler.compile(optimized)
+	return os.path.join(os.path.dirname(RUNTIME_FILE), 'gc-' + collector + '.lisp')
 
-outfile = open('program.hex', 'w')
-for instr in code:
-	outfile.write('%06x\n' % instr)
-		
-outfile.close()
+class CompileOptions:
+	def __init__(self):
+		self.runtimeFile = RUNTIME_FILE		# Source or object file, None for no runtime
+		self.generateListing = False
+		self.hexFilename = None				# If set, write program image here
+		self.dataFilename = None			# If set, write initial data memory contents here
+		self.listFilename = None			# If set, write listing here
+		self.objectFilename = None			# If set, write an object file instead of linking
+		self.inlineBudget = 256				# Instructions of growth allowed by inlining
+		self.evaluateSteps = 10000			# Step limit for each call evaluated while compiling
+		self.inlineCons = False				# Allocate cells inline rather than calling cons
+		self.collector = 'mark-sweep'		# Garbage collector compiled with a runtime source file
+
+class CompiledProgram:
+	def __init__(self):
+		self.instructions = []		# Each entry is a 21 bit instruction word
+		self.data = []				# Initial data memory contents, 19 bit words
+		self.globals = {}			# Global variable name -> data memory address
+		self.listing = None			# Listing text, if requested
+		self.warnings = []
+		self.filesWritten = []		# Output files whose contents changed
+		self.inlined = {}			# Function name -> number of calls inlined
+		self.evaluated = {}			# Function name -> number of calls replaced with results
+		self.hoisted = {}			# Function name -> number of values moved out of loops
+		self.reused = {}			# Function name -> number of common subexpressions replaced
+		self.stackDepth = 0			# Most words of stack used, not counting recursion
+		self.recursiveFunctions = []	# Names of functions that may recurse without bound
+
+#
+# One source file, along with the results of parsing, macro expanding, and
+# optimizing it.  These are kept so they can be reused if the file has not
+# changed since the last compile.
+#
+class SourceUnit:
+	def __init__(self, source):
+		self.source = source		# Filename or (name, text) tuple
+		self.stamp = None			# Identifies the version that was parsed
+		self.program = None			# Parsed S-Expressions
+		self.optimized = None		# After macro expansion and optimization
+		self.macros = None			# Macros defined after this file is processed
+		self.warnings = []
+
+	def getStamp(self):
+		if isinstance(self.source, tuple):
+			return self.source[1]
+		else:
+			info = os.stat(self.source)
+			return (info.st_mtime, info.st_size)
+
+	def parse(self, stamp):
+		parser = Parser()
+		if isinstance(self.source, tuple):
+			parser.parseString(self.source[1], self.source[0])
+		else:
+			parser.parseFile(self.source)
+
+		self.program = parser.getProgram()
+		self.parseWarnings = parser.warnings
+		self.stamp = stamp
+
+	def expand(self, macros):
+		macro = MacroProcessor()
+		macro.macroList = dict(macros)
+		expanded = macro.macroPreProcess(self.program)
+		self.optimized = [ optimize(sub) for sub in expanded ]
+		self.macros = macro.macroList
+		self.warnings = self.parseWarnings + macro.warnings
+
+#
+# A precompiled object file (see Compiler.saveObject) used in place of the
+# runtime source.  It contains the compiled functions and globals, as well as
+# the macros that were defined, so code compiled against it can use them.
+#
+class ObjectUnit(SourceUnit):
+	def parse(self, stamp):
+		self.object = readObjectFile(self.source)
+		self.parseWarnings = []
+		self.stamp = stamp
+
+	def expand(self, macros):
+		self.optimized = []
+		self.macros = self.object['macros']
+		self.warnings = []
+
+#
+# Compiles a set of source files, keeping the intermediate results for each
+# file in memory.  When compile is called again, only files that have changed
+# (and files that come after them, since they may use their macros) are
+# parsed and expanded again.  The runtime and collector sources are also
+# optimized and compiled on their own and kept in the same form as an object
+# file (see compileRuntime), so while they are unchanged only the program's
+# own sources go through the optimizers and code generation.  Linking is
+# always redone for the whole program.
+#
+class IncrementalCompiler:
+	def __init__(self, sources, options=None):
+		if options == None:
+			options = CompileOptions()
+
+		self.options = options
+		self.units = []
+		self.numRuntimeUnits = 0		# Leading units compiled by compileRuntime
+		self.runtime = None				# Object built from them, None if out of date
+		self.runtimeProgram = []		# Their optimized code, for the listing
+		self.runtimeCounts = [ {}, {}, {}, {} ]	# Evaluated, inlined, hoisted, reused
+		if options.runtimeFile and options.runtimeFile.endswith(OBJECT_EXTENSION):
+			self.units += [ ObjectUnit(options.runtimeFile) ]
+		elif options.runtimeFile:
+			self.units += [ SourceUnit(options.runtimeFile),
+				SourceUnit(getCollectorFile(options.collector)) ]
+			self.numRuntimeUnits = 2
+
+		self.units += [ SourceUnit(source) for source in sources ]
+
+	def getWatchedFiles(self):
+		return [ unit.source for unit in self.units if not isinstance(unit.source, tuple) ]
+
+	def getStamps(self):
+		return [ unit.getStamp() for unit in self.units ]
+
+	#
+	# Optimize and compile the runtime source units by themselves, returning
+	# the same thing Compiler.saveObject would write to an object file.  This
+	# is passed through JSON so later compiles load it exactly as they would
+	# an object file, and nothing they do can modify the cached copy.
+	#
+	def compileRuntime(self, program, macros):
+		options = self.options
+		compiler = Compiler(options.inlineCons)
+		evaluator = PartialEvaluator(options.evaluateSteps)
+		inliner = Inliner(options.inlineBudget)
+		loopOptimizer = LoopOptimizer()
+		eliminator = SubexpressionEliminator()
+		program = evaluator.evaluateProgram(program)
+		program = inliner.inlineProgram(program)
+		program = loopOptimizer.optimizeProgram(program)
+		program = eliminator.eliminateProgram(program)
+		compiler.compileModule(program)
+
+		obj = compiler.saveObject()
+		obj['macros'] = macros
+		obj['collector'] = options.collector
+		evaluator.saveState(obj)
+		inliner.saveState(obj)
+		loopOptimizer.saveState(obj)
+		self.runtimeProgram = program
+		self.runtimeCounts = [ evaluator.numEvaluated, inliner.numInlined,
+			loopOptimizer.numHoisted, eliminator.numReused ]
+		return convertJsonStrings(json.loads(json.dumps(obj)))
+
+	def compile(self):
+		macros = {}
+		optimized = []
+		runtimeProgram = []
+		warnings = []
+		mustExpand = False
+		for index, unit in enumerate(self.units):
+			stamp = unit.getStamp()
+			if stamp != unit.stamp:
+				unit.parse(stamp)
+				mustExpand = True
+
+			if mustExpand or unit.optimized == None:
+				unit.expand(macros)
+				mustExpand = True
+				if index < self.numRuntimeUnits:
+					self.runtime = None
+
+			macros = unit.macros
+			if index < self.numRuntimeUnits:
+				runtimeProgram += unit.optimized
+			else:
+				optimized += unit.optimized
+
+			warnings += unit.warnings
+
+		if self.numRuntimeUnits and self.runtime == None:
+			self.runtime = self.compileRuntime(runtimeProgram,
+				self.units[self.numRuntimeUnits - 1].macros)
+
+		if self.units and isinstance(self.units[0], ObjectUnit):
+			runtime = self.units[0].object
+			if runtime['collector'] != self.options.collector:
+				raise Exception(self.units[0].source + ' was built with the '
+					+ runtime['collector'] + ' garbage collector')
+		else:
+			runtime = self.runtime
+
+		options = self.options
+		compiler = Compiler(options.inlineCons)
+		evaluator = PartialEvaluator(options.evaluateSteps)
+		inliner = Inliner(options.inlineBudget)
+		loopOptimizer = LoopOptimizer()
+		eliminator = SubexpressionEliminator()
+		if runtime:
+			compiler.loadObject(runtime)
+			evaluator.loadState(runtime)
+			inliner.loadState(runtime)
+			loopOptimizer.loadState(runtime)
+
+		optimized = evaluator.evaluateProgram(optimized)
+		optimized = inliner.inlineProgram(optimized)
+		optimized = loopOptimizer.optimizeProgram(optimized)
+		optimized = eliminator.eliminateProgram(optimized)
+		compiler.compileModule(optimized)
+
+		result = CompiledProgram()
+		result.evaluated, result.inlined, result.hoisted, result.reused = [
+			addCounts(runtimeCounts, counts) for runtimeCounts, counts
+			in zip(self.runtimeCounts, [ evaluator.numEvaluated, inliner.numInlined,
+			loopOptimizer.numHoisted, eliminator.numReused ]) ]
+		if options.objectFilename:
+			obj = compiler.saveObject()
+			obj['macros'] = macros
+			obj['collector'] = options.collector
+			evaluator.saveState(obj)
+			inliner.saveState(obj)
+			loopOptimizer.saveState(obj)
+			result.globals = compiler.getGlobalVariables()
+			result.warnings = warnings
+			if writeObjectFile(options.objectFilename, obj):
+				result.filesWritten += [ options.objectFilename ]
+
+			return result
+
+		result.instructions = compiler.link()
+		result.data = compiler.getDataImage()
+		result.globals = compiler.getGlobalVariables()
+		result.warnings = warnings + compiler.warnings
+		result.stackDepth = compiler.stackDepth
+		result.recursiveFunctions = [ function.name for function in compiler.recursiveFunctions ]
+
+		if options.generateListing or options.listFilename:
+			listing = StringIO.StringIO()
+			if result.evaluated:
+				listing.write('Evaluated:\n')
+				for name, count in sorted(result.evaluated.items()):
+					listing.write(' %s %d call sites\n' % (name, count))
+
+			if result.inlined:
+				listing.write('Inlined:\n')
+				for name, count in sorted(result.inlined.items()):
+					listing.write(' %s %d call sites\n' % (name, count))
+
+			if result.hoisted:
+				listing.write('Moved out of loops:\n')
+				for name, count in sorted(result.hoisted.items()):
+					listing.write(' %s %d values\n' % (name, count))
+
+			if result.reused:
+				listing.write('Common subexpressions:\n')
+				for name, count in sorted(result.reused.items()):
+					listing.write(' %s %d reused\n' % (name, count))
+
+			compiler.writeListing(listing, self.runtimeProgram + optimized)
+			result.listing = listing.getvalue()
+			if options.listFilename and writeFileIfChanged(options.listFilename, result.listing):
+				result.filesWritten += [ options.listFilename ]
+
+		if options.hexFilename and writeHexFile(options.hexFilename, result.instructions):
+			result.filesWritten += [ options.hexFilename ]
+
+		if options.dataFilename and writeDataFile(options.dataFilename, result.data):
+			result.filesWritten += [ options.dataFilename ]
+
+		return result
+
+# Combine two dictionaries of name -> count
+def addCounts(a, b):
+	total = dict(a)
+	for name, count in b.items():
+		total[name] = total.get(name, 0) + count
+
+	return total
+
+#
+# Compile a program and return a CompiledProgram.  Each entry in sources is
+# either a filename or a tuple of (name, source text).  Sources are compiled
+# in order after the runtime library.
+#
+def compileProgram(sources, options=None):
+	return IncrementalCompiler(sources, options).compile()
+
+#
+# Output files are only written if their contents change.  The FPGA tools
+# resynthesize the design whenever the program image is touched.
+#
+def writeFileIfChanged(filename, contents):
+	try:
+		with open(filename, 'r') as f:
+			if f.read() == contents:
+				return False
+	except IOError:
+		pass
+
+	with open(filename, 'w') as f:
+		f.write(contents)
+
+	return True
+
+def writeHexFile(filename, instructions):
+	return writeFileIfChanged(filename, ''.join([ '%06x\n' % instr for instr in instructions ]))
+
+def writeDataFile(filename, data):
+	return writeFileIfChanged(filename, ''.join([ '%05x\n' % word for word in data ]))
+
+def writeObjectFile(filename, obj):
+	return writeFileIfChanged(filename, json.dumps(obj, sort_keys=True))
+
+# The JSON decoder returns unicode strings, but the compiler expects str
+def convertJsonStrings(value):
+	if isinstance(value, unicode):
+		return str(value)
+	elif isinstance(value, list):
+		return [ convertJsonStrings(element) for element in value ]
+	elif isinstance(value, dict):
+		return dict([ ( str(key), convertJsonStrings(element) ) for key, element in value.items() ])
+	else:
+		return value
+
+def readObjectFile(filename):
+	with open(filename, 'r') as f:
+		return convertJsonStrings(json.load(f))
+
+#
+# Recompile whenever one of the source files changes.  Runs until interrupted.
+#
+def watch(compiler, interval):
+	print 'watching ' + ', '.join(compiler.getWatchedFiles())
+	lastStamps = None
+	while True:
+		try:
+			stamps = compiler.getStamps()
+		except OSError:
+			stamps = None	# File is being replaced by the editor, try again
+
+		if stamps != None and stamps != lastStamps:
+			lastStamps = stamps
+			startTime = time.time()
+			try:
+				result = compiler.compile()
+				for warning in result.warnings:
+					print warning
+
+				print '%s compiled %d instructions in %d ms, %s' % (time.strftime('%H:%M:%S'),
+					len(result.instructions), (time.time() - startTime) * 1000,
+					'wrote ' + ', '.join(result.filesWritten) if result.filesWritten else 'output unchanged')
+			except Exception as exc:
+				print 'error: ' + str(exc)
+
+			sys.stdout.flush()
+
+		time.sleep(interval)
+
+def main():
+	argParser = argparse.ArgumentParser(description='Compile LISP sources into program.hex')
+	argParser.add_argument('sources', nargs='*')
+	argParser.add_argument('--watch', action='store_true',
+		help='keep running and recompile whenever a source file changes')
+	argParser.add_argument('--interval', type=float, default=0.2,
+		help='seconds between checks for changed files in watch mode')
+	argParser.add_argument('--runtime', default=RUNTIME_FILE,
+		help='runtime library, either LISP source or an object file')
+	argParser.add_argument('--object', metavar='FILE',
+		help='write an object file containing the runtime and sources instead of program.hex')
+	argParser.add_argument('--inline-cons', action='store_true',
+		help='allocate cells inline, which is faster but makes the program larger')
+	argParser.add_argument('--gc', choices=COLLECTORS, default='mark-sweep',
+		help='garbage collector to compile with the runtime')
+	args = argParser.parse_args()
+
+	options = CompileOptions()
+	options.runtimeFile = args.runtime
+	options.inlineCons = args.inline_cons
+	options.collector = args.gc
+	if args.object:
+		options.objectFilename = args.object
+	else:
+		options.hexFilename = 'program.hex'
+		options.dataFilename = 'data.hex'
+		options.listFilename = 'program.lst'
+
+	compiler = IncrementalCompiler(args.sources, options)
+	if args.watch:
+		try:
+			watch(compiler, args.interval)
+		except KeyboardInterrupt:
+			pass
+	else:
+		result = compiler.compile()
+		for warning in result.warnings:
+			print warning
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,187 @@
+; 
+; Copyright 2011-2012 Jeff Bush
+; 
+; Licensed under the Apache License, Version 2.0 (the "License");
+; you may not use this file except in compliance with the License.
+; You may obtain a copy of the License at
+; 
+;     http://www.apache.org/licenses/LICENSE-2.0
+; 
+; Unless required by applicable law or agreed to in writing, software
+; distributed under the License is distributed on an "AS IS" BASIS,
+; WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+; See the License for the specific language governing permissions and
+; limitations under the License.
+; 
+
+;
+; Copying garbage collector.  The heap is split into two halves.  Cells and
+; vectors are allocated from one by advancing $wilderness-start, and when it
+; is full, the ones that are still used are copied to the other half, which
+; then becomes the one that is allocated from.  Garbage is never touched, so
+; collecting takes time in proportion to the amount of live data rather than
+; the size of the heap, but only half of the heap can be used.  The free list
+; is always empty.  As with the mark-sweep collector, the vectors are linked
+; together in order of address, starting at $vectors.  While garbage
+; collecting, the ones in from space start at $from-vectors.
+;
+
+(assign $semispace-size (bitwise-and (rshift (- $max-heap $heapstart) 1) -2))
+(assign $from-space $heapstart)
+(assign $to-space (+ $heapstart $semispace-size))
+(assign $from-end $heapstart)
+(assign $wilderness-start $from-space)
+(assign $max-heap $to-space)
+(assign $vectors nil)
+(assign $last-vector nil)
+(assign $from-vectors nil)
+
+; Add a vector to the end of the list of vectors
+(function $link-vector (ptr)
+	(store (+ ptr 1) nil)
+	(if $last-vector
+		(store (+ $last-vector 1) ptr)
+		(assign $vectors ptr))
+
+	(assign $last-vector ptr))
+
+; Length of a vector in from space, which may have been copied already
+(function $from-length (vector)
+	(let ((header (load vector)))
+		(if (rshift (gettag header) 2)
+			(load header)
+			header)))
+
+;
+; Check if a value from a global variable, a constant or the stack points to
+; the start of a cell or vector in the part of from space that was allocated.
+; It may instead be the address of something inside one, like a vector
+; element, which still has the tag of the pointer it was computed from.
+;
+(function $heap-object? (ptr)
+	(let ((tag (bitwise-and (gettag ptr) 3)) (vector $from-vectors))
+		(if (and (bitwise-and tag 1) (>= ptr $from-space) (< ptr $from-end)
+			(not (bitwise-and (- ptr $from-space) 1)))
+			(begin
+				(while (and vector (<= (+ vector ($vector-size ($from-length vector))) ptr))
+					(assign vector (rest vector)))
+
+				(if (and vector (>= ptr vector))
+					(and (= tag 3) (= ptr vector))	; Inside a vector
+					(= tag 1))))))
+
+;
+; Replace each pointer to a cell or vector in from space within a range of
+; addresses with a pointer to its copy in to space, copying it if it hasn't
+; been already.  When an object is copied, its first word is replaced with
+; the new address, with the tag bit 4 set to show that it has moved.  Copied
+; vectors also have that bit set in their lengths until they are scanned, so
+; $gc can tell them apart from cells.  If roots is true, the range holds
+; global variables, constants or the stack, where values are only treated as
+; pointers if $heap-object? says they are.  Otherwise pointers are only
+; checked for being in the part of from space that was allocated.
+;
+(function $forward-range (start end roots)
+	(for ptr start end 1
+		(let ((value (load ptr)) (type (bitwise-and (gettag value) 3)))
+			(if (and (bitwise-and type 1) (>= value $from-space) (< value $from-end)
+				(or (not roots) ($heap-object? value)))
+				(let ((header (load value)) (new $wilderness-start))
+					(if (rshift (gettag header) 2)
+						; Already copied
+						(store ptr (settag header type))
+
+						(if (= type 1)
+							(begin
+								; Copy a cell
+								(gclog 77 value)	; M
+								(store new header)
+								(store (+ new 1) (rest value))
+								(assign $wilderness-start (+ new 2))
+								(store value (settag new 4))
+								(store ptr (settag new 1)))
+
+							(let ((size ($vector-size header)))
+								(if (<= (+ value size) $from-end)
+									(begin
+										; Copy a vector
+										(gclog 86 value)	; V
+										(store new (settag header 4))
+										($link-vector new)
+										(for index 2 size 1
+											(store (+ new index) (load (+ value index))))
+
+										(assign $wilderness-start (+ new size))
+										(store value (settag new 4))
+										(store ptr (settag new 3))))))))))))
+
+;
+; Copy everything that can be reached from global variables, constants and
+; the stack into to space.  Copied objects are scanned in order of address,
+; which copies the objects they point to after them, until scanning reaches
+; the end of what has been copied.  Then switch halves.
+;
+(function $gc ()
+	(gclog 71 $wilderness-start)
+	(assign $from-end $wilderness-start)
+	(assign $wilderness-start $to-space)
+	(assign $from-vectors $vectors)
+	(assign $vectors nil)
+	(assign $last-vector nil)
+	($forward-range 0 $heapstart true)	; Global variables and constants
+	($forward-range (getbp) (+ $stacktop 1) true)	; Stack
+	(let ((scan $to-space))
+		(while (< scan $wilderness-start)
+			(let ((header (load scan)))
+				(if (rshift (gettag header) 2)
+					; A vector
+					(let ((length (settag header 0)))
+						(store scan length)
+						($forward-range (+ scan 2) (+ scan (+ length 2)) false)
+						(assign scan (+ scan ($vector-size length))))
+
+					; A cell
+					(begin
+						($forward-range scan (+ scan 2) false)
+						(assign scan (+ scan 2)))))))
+
+	(let ((old-space $from-space))
+		(assign $from-space $to-space)
+		(assign $to-space old-space))
+
+	(assign $max-heap (+ $from-space $semispace-size)))
+
+;
+; Called when there is no room left in the current half of the heap.  Garbage
+; collect and return a free cell.
+;
+(function $cons-slow ()
+	($gc)
+	(let ((ptr $wilderness-start))
+		(if (< ptr $max-heap)
+			(assign $wilderness-start (+ ptr 2))
+
+			; GC gave us nothing, give up.
+			($oom))
+
+		ptr))
+
+;
+; Allocate a vector with length elements, which are initially nil.
+;
+(function make-vector (length)
+	(let ((size ($vector-size length)) (ptr $wilderness-start))
+		(if (> (+ ptr size) $max-heap)
+			(begin
+				($gc)
+				(assign ptr $wilderness-start)
+				(if (> (+ ptr size) $max-heap)
+					($oom))))
+
+		(assign $wilderness-start (+ ptr size))
+		(store ptr (settag length 0))	; Clear the tag, which marks a copied vector
+		($link-vector ptr)
+		(for index 2 size 1
+			(store (+ ptr index) nil))
+
+		(settag ptr 3)))
@@ -0,0 +1,386 @@
+; 
+; Copyright 2011-2012 Jeff Bush
+; 
+; Licensed under the Apache License, Version 2.0 (the "License");
+; you may not use this file except in compliance with the License.
+; You may obtain a copy of the License at
+; 
+;     http://www.apache.org/licenses/LICENSE-2.0
+; 
+; Unless required by applicable law or agreed to in writing, software
+; distributed under the License is distributed on an "AS IS" BASIS,
+; WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+; See the License for the specific language governing permissions and
+; limitations under the License.
+; 
+
+;
+; Mark-sweep garbage collector, the default.  Cells that are freed are put on
+; a free list, and cons takes them from there before expanding the heap.
+;
+
+; Cells and vectors on the heap always take an even number of words, so the
+; garbage collector can step through it two words at a time.  The vectors are
+; linked together in order of address, starting at $vectors, so the garbage
+; collector can tell them apart from cells.
+; The mark stack is a fixed 32 word block below the heap.  It holds objects
+; that the garbage collector has marked but whose contents it has not scanned
+; yet.  If it fills up, $mark-overflow is set and the heap is rescanned later.
+; After marking, the heap is swept a little at a time as cells are allocated.
+; Everything below $sweep-ptr has been swept, up to $sweep-end, which is where
+; the wilderness started when the garbage collector ran.  The marks are kept
+; in a bitmap between the mark stack and the heap, with a bit for every two
+; words, rather than in the tags of the objects.  The program may store to a
+; live object before it is swept, which would clear a mark in its tag.  The
+; heap starts on a multiple of 32 words, so the bitmap word for an address is
+; at $mark-bits plus the address divided by 32.  The bitmap is cleared up to
+; $mark-bits-clear, and more of it is cleared as the heap grows.
+(assign $mark-stack $heapstart)
+(assign $mark-stack-top $heapstart)
+(assign $mark-stack-end (+ $heapstart 32))
+(assign $mark-bits-clear $mark-stack-end)
+(assign $heapstart (bitwise-and (+ (+ $mark-stack-end
+	(rshift (- $max-heap $mark-stack-end) 5)) 32) -32))
+(assign $mark-bits (- $mark-stack-end (rshift $heapstart 5)))
+
+(assign $mark-overflow false)
+(assign $wilderness-start $heapstart)
+(assign $sweep-ptr $heapstart)
+(assign $sweep-end $heapstart)
+(assign $sweep-vector nil)
+(assign $vectors nil)
+(assign $last-vector nil)
+
+; The parts of the collector that handle vectors are called through these,
+; which make-vector sets.  This leaves them out of programs that don't use
+; vectors, since nothing else refers to them.
+(assign $vector-root-hook nil)
+(assign $sweep-vector-hook nil)
+
+; The word in $mark-bits and the bit in it that mark an object on the heap
+(defmacro $mark-word (ptr)
+	`(+ $mark-bits (rshift ,ptr 5)))
+
+(defmacro $mark-bit (ptr)
+	`(lshift 1 (bitwise-and (rshift ,ptr 1) 15)))
+
+;
+; Scan the values in the words from ptr up to end, then the contents of the
+; objects on the mark stack until it is empty.  Each value that points to a
+; cell or vector on the heap that is not marked yet is marked and pushed on the
+; mark stack.  Constant cells and vectors are never freed, so they are skipped,
+; but they are scanned as roots because a program may change them to point to
+; the heap.
+;
+(function $mark-drain (ptr end)
+	(let ((more true))
+		(while more
+			(while (< ptr end)
+				(let ((object (load ptr)))
+					(if (and (bitwise-and (gettag object) 1) (>= object $heapstart))
+						(let ((word ($mark-word object)) (bit ($mark-bit object)) (bits (load word)))
+							(if (not (bitwise-and bits bit))
+								(begin
+									(store word (bitwise-or bits bit))
+									(if (= $mark-stack-top $mark-stack-end)
+										(assign $mark-overflow true)
+										(begin
+											(store $mark-stack-top object)
+											(assign $mark-stack-top (+ $mark-stack-top 1))))))))
+
+					(assign ptr (+ ptr 1))))
+
+			; Scan the next object on the mark stack
+			(if (= $mark-stack-top $mark-stack)
+				(assign more false)
+				(begin
+					(assign $mark-stack-top (- $mark-stack-top 1))
+					(assign ptr (load $mark-stack-top))
+					(gclog 77 ptr)	; M
+					(if (list? ptr)
+						(assign end (+ ptr 2))
+						(begin
+							(assign end (+ (+ ptr 2) (vector-length ptr)))
+							(assign ptr (+ ptr 2)))))))))
+
+;
+; Check if a value from a global variable, a constant or the stack points to
+; the start of a cell or vector on the heap.  It may instead be the address of
+; something inside one, like a vector element, which still has the tag of the
+; pointer it was computed from.
+;
+(function $heap-object? (ptr)
+	(let ((tag (bitwise-and (gettag ptr) 3)))
+		(if (and (bitwise-and tag 1) (>= ptr $heapstart) (< ptr $wilderness-start)
+			(not (bitwise-and (- ptr $heapstart) 1)))
+			(if $vectors
+				($vector-root-hook ptr tag)
+				(= tag 1)))))
+
+; $heap-object? for when there are vectors on the heap.  The list of vectors
+; is in order of address, so this stops at the first one that ends after ptr.
+(function $vector-root? (ptr tag)
+	(let ((vector $vectors))
+		(while (and vector (<= (+ vector ($vector-size (load vector))) ptr))
+			(assign vector (rest vector)))
+
+		(if (and vector (>= ptr vector))
+			(and (= tag 3) (= ptr vector))	; Inside a vector
+			(= tag 1))))
+
+; Mark the objects the values in a range of contiguous addresses point to,
+; including end.  Most values aren't pointers, so check the tag before
+; calling $heap-object?.
+(function $mark-range (start end)
+	(for ptr start (+ end 1) 1
+		(let ((value (load ptr)))
+			(if (and (bitwise-and (gettag value) 1) ($heap-object? value))
+				($mark-drain ptr (+ ptr 1))))))
+
+;
+; The mark stack filled up, so some objects were marked without their contents
+; being scanned.  Scan the contents of every marked object on the heap.
+;
+(function $mark-rescan ()
+	(assign $mark-overflow false)
+	(let ((ptr $heapstart) (next-vector $vectors))
+		(while (< ptr $wilderness-start)
+			(let ((start ptr) (end (+ ptr 2)))
+				(if (= ptr next-vector)
+					(begin
+						(assign next-vector (rest ptr))
+						(assign start end)
+						(assign end (+ end (load ptr)))))
+
+				(if (bitwise-and (load ($mark-word ptr)) ($mark-bit ptr))
+					($mark-drain start end))
+
+				; Objects take an even number of words
+				(assign ptr (bitwise-and (+ end 1) -2))))))
+
+;
+; Garbage collect, using mark-sweep algorithm
+;
+
+(function $gc ()
+	(gclog 71 $wilderness-start)
+
+	;;;;;;;;;;;;;;;;;;;;;;;;;;;
+	; Mark phase
+	;;;;;;;;;;;;;;;;;;;;;;;;;;;
+
+	; Finish sweeping from the last collection, which also clears the marks,
+	; and clear the bitmap for the part of the heap used since then.
+	($finish-sweep)
+	(let ((end ($mark-word $wilderness-start)))
+		(while (<= $mark-bits-clear end)
+			(store $mark-bits-clear 0)
+			(assign $mark-bits-clear (+ $mark-bits-clear 1))))
+
+	($mark-range 0 (- $mark-stack 1))	; Mark global variables and constants
+	($mark-range (getbp) $stacktop) ; Mark stack
+	(while $mark-overflow
+		($mark-rescan))
+	
+	;;;;;;;;;;;;;;;;;;;;;;;;;;;
+	; Sweep phase 
+	;;;;;;;;;;;;;;;;;;;;;;;;;;;
+
+	; This just starts the sweep, which is done later by $sweep.  The free
+	; cells it finds are added back to the free list.
+	(assign $freelist nil)
+	(assign $sweep-ptr $heapstart)
+	(assign $sweep-end $wilderness-start)
+	(assign $sweep-vector $vectors)
+	(assign $vectors nil)
+	(assign $last-vector nil))
+
+;
+; Sweep from $sweep-ptr until count words have been swept or reaching the
+; end.  Unmarked cells are put on the free list, and the marks are cleared on
+; the ones that are still used, so the bitmap is clear when the sweep is done.
+; The current word of the bitmap is kept in bits, and written back when the
+; sweep moves past it or stops.  The free list stays in order of decreasing
+; address, since cells are added in order of increasing address.
+;
+(function $sweep (count)
+	(let ((ptr $sweep-ptr) (stop (+ $sweep-ptr count)) (size 2)
+		(word ($mark-word ptr)) (bits (load word)) (bit ($mark-bit ptr)))
+		(if (> stop $sweep-end)
+			(assign stop $sweep-end))
+
+		(while (< ptr stop)
+			(let ((marked (bitwise-and bits bit)))
+				(assign bits (bitwise-xor bits marked))
+				(if (= ptr $sweep-vector)
+					(assign size ($sweep-vector-hook ptr marked))
+					(begin
+						(assign size 2)
+						(if (not marked)
+							; This is not used, stick it back in the free list.
+							(begin
+								(store (+ 1 ptr) $freelist)
+								(assign $freelist ptr)
+								(gclog 70 ptr)))))	; 'F'
+
+				(assign ptr (+ ptr size))
+				(assign bit (lshift bit (rshift size 1)))
+				(if (not bit)
+					(begin
+						; Moved past the end of this word of the bitmap
+						(store word bits)
+						(assign word ($mark-word ptr))
+						(assign bits (load word))
+						(assign bit ($mark-bit ptr))))))
+
+		(store word bits)
+		(assign $sweep-ptr ptr)
+		(if (>= ptr $sweep-end)
+			; Finished.  Return free cells at the top of the heap to the
+			; wilderness, so they can be used for vectors.
+			(while (= $freelist (- $wilderness-start 2))
+				(assign $freelist (rest $freelist))
+				(assign $wilderness-start (- $wilderness-start 2))))))
+
+;
+; Sweep the vector at ptr, which is the next one on the list.  If it is still
+; used, put it back on the list of vectors, otherwise split it into cells and
+; free them.  Returns the number of words it takes.
+;
+(function $sweep-one-vector (ptr marked)
+	(let ((size ($vector-size (load ptr))))
+		(assign $sweep-vector (rest ptr))
+		(if marked
+			(begin
+				(store (+ ptr 1) nil)
+				(if $last-vector
+					(store (+ $last-vector 1) ptr)
+					(assign $vectors ptr))
+
+				(assign $last-vector ptr))
+
+			(for cell ptr (+ ptr size) 2
+				(begin
+					(store (+ 1 cell) $freelist)
+					(assign $freelist cell)
+					(gclog 70 cell))))	; 'F'
+
+		size))
+
+(function $finish-sweep ()
+	(if (< $sweep-ptr $sweep-end)
+		($sweep (- $sweep-end $sweep-ptr))))
+
+;
+; Called when there are no free cells and no room to expand the heap.  Sweep
+; more of the heap, or garbage collect if the sweep is finished, and return a
+; free cell.  This is separate from cons because the compiler may put the rest
+; of cons inline (see Compiler.compileConsIntrinsic).
+;
+(function $cons-slow ()
+	($sweep-for-cell)
+	(if (not (or $freelist (< $wilderness-start $max-heap)))
+		(begin
+			($gc)
+			($sweep-for-cell)))
+
+	(let ((ptr $freelist))
+		(if ptr
+			; Got a block, take it off the freelist
+			(assign $freelist (rest ptr))
+
+			(if (< $wilderness-start $max-heap)
+				; The sweep returned space to the wilderness
+				(begin
+					(assign ptr $wilderness-start)
+					(assign $wilderness-start (+ ptr 2)))
+
+				; GC gave us nothing, give up.
+				($oom)))
+
+		ptr))
+
+; Sweep 32 words at a time until there is a free cell or the sweep is finished
+(function $sweep-for-cell ()
+	(while (and (not $freelist) (< $sweep-ptr $sweep-end))
+		($sweep 32)))
+
+;
+; Find size words of free memory, either from the wilderness or a run of cells
+; on the free list that are next to each other.  Returns nil if there is
+; none.  The free list is in order of decreasing address, so the cells in a
+; run are next to each other in the list.  The sweep must be finished first,
+; or some free cells will not be on the list yet.
+;
+(function $allocate-block (size)
+	(if (> (+ $wilderness-start size) $max-heap)
+		(let ((cell $freelist) (last nil) (run-end nil) (run-before nil) (block nil))
+			(while (and cell (not block))
+				(if (or (not last) (<> cell (- last 2)))
+					(begin
+						; Start of a new run
+						(assign run-before last)
+						(assign run-end cell)))
+
+				(if (>= (- (+ run-end 2) cell) size)
+					(begin
+						; Found a run that is big enough, remove it from the list
+						(assign block cell)
+						(if run-before
+							(store (+ run-before 1) (rest cell))
+							(assign $freelist (rest cell))))
+
+					(begin
+						(assign last cell)
+						(assign cell (rest cell)))))
+
+			block)
+
+		(let ((ptr $wilderness-start))
+			(assign $wilderness-start (+ ptr size))
+			ptr)))
+
+; Add a vector to the list of vectors, which is in order of address
+(function $link-vector (ptr)
+	(if (and $last-vector (< ptr $last-vector))
+		(let ((prev nil) (next $vectors))
+			(while (< next ptr)
+				(assign prev next)
+				(assign next (rest next)))
+
+			(store (+ ptr 1) next)
+			(if prev
+				(store (+ prev 1) ptr)
+				(assign $vectors ptr)))
+
+		(begin
+			(store (+ ptr 1) nil)
+			(if $last-vector
+				(store (+ $last-vector 1) ptr)
+				(assign $vectors ptr))
+
+			(assign $last-vector ptr))))
+
+;
+; Allocate a vector with length elements, which are initially nil.
+;
+(function make-vector (length)
+	(let ((size ($vector-size length)) (ptr nil))
+		($finish-sweep)
+		(assign ptr ($allocate-block size))
+		(if (not ptr)
+			(begin
+				($gc)
+				($finish-sweep)
+				(assign ptr ($allocate-block size))
+				(if (not ptr)
+					($oom))))
+
+		(store ptr length)
+		($link-vector ptr)
+		(assign $vector-root-hook $vector-root?)
+		(assign $sweep-vector-hook $sweep-one-vector)
+		(for index 2 size 1
+			(store (+ ptr index) nil))
+
+		(settag ptr 3)))
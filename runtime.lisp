@@ -62,68 +62,36 @@
 (defmacro function? (ptr)
 	`(= (bitwise-and (gettag ,ptr) 3) 2))
 
-; Note that $heapstart is a variable created automatically
-; by the compiler.  Wilderness is memory that has never been allocated and
-; that we can simply slice off from.
-(assign $wilderness-start $heapstart)
+(defmacro vector? (ptr)
+	`(= (bitwise-and (gettag ,ptr) 3) 3))
+
+; A vector is a block of memory that starts with the number of elements,
+; followed by a link to the next vector on the heap (see make-vector), then
+; the elements.  Indices are not checked.
+(defmacro vector-length (vec)
+	`(load ,vec))
+
+(defmacro vector-ref (vec index)
+	`(load (+ (+ ,vec 2) ,index)))
+
+(defmacro vector-set! (vec index value)
+	`(store (+ (+ ,vec 2) ,index) ,value))
+
+; Note that $heapstart, $datastart, and $stackdepth are variables created
+; automatically by the compiler.  The global variables are below $datastart.
+; Between that and $heapstart are the cons cells and vectors for constant
+; lists and strings, which are initialized when the program is loaded.
+; Wilderness is memory that has never been allocated and that we can simply
+; slice off from.  $stackdepth is the most stack the program can use, as
+; determined by the compiler, so the heap can grow until it reaches that.
+; The garbage collector is in a separate file, which the compiler adds after
+; this one (gc-mark-sweep.lisp or gc-copying.lisp).  It sets
+; $wilderness-start and may lower $max-heap.  cons takes cells from
+; $freelist, then the wilderness, then calls $cons-slow in the collector.
 (assign $stacktop (getbp))	; This is called from top level main, so BP will be top of stack
-(assign $max-heap (- $stacktop 1024)) 	
+(assign $max-heap (- $stacktop $stackdepth))
 (assign $freelist nil)
 
-; Mark a pointer, following links if it is a pair
-(function $mark-recursive (ptr)
-	(if (and ptr (list? ptr))	; Check if this is a cons and is not null
-		(begin
-			(let ((firstword (load ptr)) (tag (gettag firstword)))
-				(if (not (rshift tag 2))
-					(begin
-						; An unmarked cons cell, mark it and continue
-						(gclog 77 ptr)	; M
-						(store ptr (settag firstword (bitwise-or tag 4)))
-
-						; Check if we need to mark the first pointer
-						($mark-recursive (first ptr)))))
-
-			($mark-recursive (rest ptr)))))
-
-; Mark a range of contiguous addresses.
-(function $mark-range (start end)
-	($mark-recursive (load start))
-	(if (< start end)
-		($mark-range (+ start 1) end)))
-
-;
-; Garbage collect, using mark-sweep algorithm
-;
-
-(function $gc ()
-	(gclog 71 $wilderness-start)
-
-	;;;;;;;;;;;;;;;;;;;;;;;;;;;
-	; Mark phase
-	;;;;;;;;;;;;;;;;;;;;;;;;;;;
-
-	; Clear GC flags 
-	(for ptr $heapstart $wilderness-start 2
-		(let ((val (load ptr)) (tag (gettag val)))
-			(store ptr (settag val (bitwise-and tag 3)))))
-	
-	($mark-range 0 $heapstart)      ; Mark global variables
-	($mark-range (getbp) $stacktop) ; Mark stack
-	
-	;;;;;;;;;;;;;;;;;;;;;;;;;;;
-	; Sweep phase 
-	;;;;;;;;;;;;;;;;;;;;;;;;;;;
-
-	(assign $freelist nil)	; First clear the freelist so we don't double-add
-	(for ptr $heapstart $wilderness-start 2
-		(if (not (bitwise-and (gettag (load ptr)) 4))
-			(begin
-				; This is not used, stick it back in the free list.
-				(store (+ 1 ptr) $freelist)
-				(assign $freelist ptr)
-				(gclog 70 ptr))))) 	; 'F'
-
 (function $oom ()
 	($printchar 79)
 	($printchar 79)
@@ -131,40 +99,32 @@
 	($printchar 10)
 	(while 1 ()))
 
+; Words a vector with length elements takes on the heap, including the length
+; and link, rounded up to an even number.
+(function $vector-size (length)
+	(bitwise-and (+ length 3) -2))
+
 ;
 ; Allocate a new cell and return a pointer to it
 ;
 (function cons (_first _rest)
-	(let ((ptr nil))
-		(if $freelist
-
+	(let ((ptr $freelist))
+		(if ptr
 			; There are nodes on freelist, grab one.
-			(begin
-				(assign ptr $freelist)
-				(assign $freelist (rest ptr)))
+			(assign $freelist (rest ptr))
 
 			; Nothing on freelist, try to expand frontier
-			(begin
-				(if (< $wilderness-start $max-heap)
-					; Space is available in frontier, snag from there.
-					(begin
-						(assign ptr $wilderness-start)
-						(assign $wilderness-start (+ $wilderness-start 2)))
+			(if (< $wilderness-start $max-heap)
+				; Space is available in frontier, snag from there.
+				(begin
+					(assign ptr $wilderness-start)
+					(assign $wilderness-start (+ $wilderness-start 2)))
 
-					; No more space available, need to garbage collect
-					(begin
-						($gc)
-						(if $freelist
-							; Then: got a block, assign it
-							(begin
-								(assign ptr $freelist)
-								(assign $freelist (rest ptr)))
-
-							; Else: GC gave us nothing, give up.
-							($oom))))))
+				; No more space available, need to garbage collect
+				(assign ptr ($cons-slow))))
 
 		(gclog 65 ptr) 	; 'A' Debug: print cell that has been allocated
-		(store ptr _first)
+		(store ptr (settag _first (bitwise-and (gettag _first) 3)))	; Clear tag bit 4, which the garbage collector uses
 		(store (+ ptr 1) _rest)
 		(settag ptr 1)))	; Mark this as a cons cell and return
 
@@ -247,9 +207,13 @@
 (function $printchar (x)
 	(write-register 0 x))
 
+; Strings may be lists or vectors of characters
 (function $printstr (x)
-	(foreach ch x
-		($printchar ch)))
+	(if (vector? x)
+		(for index 0 (vector-length x) 1
+			($printchar (vector-ref x index)))
+		(foreach ch x
+			($printchar ch))))
 
 ; Print a number in decimal format
 (function $printdec (num)
@@ -302,7 +266,20 @@
 		;; This is a function
 		(begin
 			($printstr "function")
-			($printhex x))))
+			($printhex x)))
+
+	(if (vector? x)
+		;; This is a vector
+		(begin
+			($printchar 35)	; #
+			($printchar 40)	; Open paren
+			(for index 0 (vector-length x) 1
+				(begin
+					(if index
+						($printchar 32))
+					(print (vector-ref x index))))
+
+			($printchar 41))))		; Close paren
 
 (function nth (list index)
 	(if list
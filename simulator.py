@@ -0,0 +1,714 @@
+#!/usr/bin/python
+#
+# Copyright 2011-2015 Jeff Bush
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+#
+# Instruction set simulator for lisp_core.  This executes program.hex directly
+# rather than simulating the RTL, so it is much faster than running sim.vvp.
+# It models the externally visible behavior of ulisp.v (a 4096 word data
+# memory, with hardware registers mapped at 0xf000) and counts the number of
+# clock cycles the core would spend in each state of its state machine.
+#
+
+import sys, os, argparse
+
+OP_NOP = 0
+OP_CALL = 1
+OP_RETURN = 2
+OP_POP = 3
+OP_LOAD = 4
+OP_STORE = 5
+OP_ADD = 6
+OP_SUB = 7
+OP_REST = 8
+OP_GTR = 9
+OP_GTE = 10
+OP_EQ = 11
+OP_NEQ = 12
+OP_DUP = 13
+OP_GETTAG = 14
+OP_SETTAG = 15
+OP_AND = 16
+OP_OR = 17
+OP_XOR = 18
+OP_LSHIFT = 19
+OP_RSHIFT = 20
+OP_GETBP = 21
+OP_RESERVE = 24
+OP_PUSH = 25
+OP_GOTO = 26
+OP_BFALSE = 27
+OP_GETLOCAL = 29
+OP_SETLOCAL = 30
+OP_CLEANUP = 31
+
+# These match the localparams in lisp_core.v
+STATE_DECODE = 0
+STATE_GOT_NOS = 1
+STATE_PUSH_MEM_RESULT = 2
+STATE_GETLOCAL2 = 3
+STATE_RETURN2 = 4
+STATE_RETURN3 = 5
+STATE_GOT_STORE_VALUE = 6
+STATE_GOT_NEW_TAG = 7
+STATE_BFALSE2 = 8
+
+STATE_NAMES = [
+	'DECODE',
+	'GOT_NOS',
+	'PUSH_MEM_RESULT',
+	'GETLOCAL2',
+	'RETURN2',
+	'RETURN3',
+	'GOT_STORE_VALUE',
+	'GOT_NEW_TAG',
+	'BFALSE2'
+]
+
+MEM_SIZE = 4096
+REGISTER_BASE = 0xf000
+
+# testbench.v toggles the clock 400000 times
+DEFAULT_MAX_CYCLES = 200000
+
+#
+# Sequence of states each instruction passes through, starting with DECODE.
+# Instructions that are not in this table take a single cycle.  BFALSE always
+# takes two cycles whether the branch is taken or not.
+#
+INSTRUCTION_STATES = {
+	OP_RETURN : (STATE_DECODE, STATE_RETURN2, STATE_RETURN3),
+	OP_POP : (STATE_DECODE, STATE_PUSH_MEM_RESULT),
+	OP_LOAD : (STATE_DECODE, STATE_PUSH_MEM_RESULT),
+	OP_STORE : (STATE_DECODE, STATE_GOT_STORE_VALUE),
+	OP_SETTAG : (STATE_DECODE, STATE_GOT_NEW_TAG),
+	OP_REST : (STATE_DECODE, STATE_PUSH_MEM_RESULT),
+	OP_BFALSE : (STATE_DECODE, STATE_BFALSE2),
+	OP_GETLOCAL : (STATE_DECODE, STATE_GETLOCAL2, STATE_PUSH_MEM_RESULT)
+}
+
+for _op in (OP_ADD, OP_SUB, OP_GTR, OP_GTE, OP_EQ, OP_NEQ, OP_AND, OP_OR,
+	OP_XOR, OP_LSHIFT, OP_RSHIFT):
+	INSTRUCTION_STATES[_op] = (STATE_DECODE, STATE_GOT_NOS)
+
+def getInstructionStates(opcode):
+	return INSTRUCTION_STATES.get(opcode, (STATE_DECODE,))
+
+def loadHexFile(filename):
+	words = []
+	with open(filename, 'r') as f:
+		for line in f:
+			line = line.strip()
+			if line:
+				words += [ int(line, 16) ]
+
+	return words
+
+#
+# Compute the result of the ALU for the binary operations.  op0 is the top
+# of stack, op1 is the next value on the stack.  Only the low 16 bits
+# are returned.
+#
+def aluOp(opcode, op0, op1):
+	op0 &= 0xffff
+	op1 &= 0xffff
+	diff = (op0 - op1) & 0xffff
+	if opcode == OP_ADD:
+		return (op0 + op1) & 0xffff
+	elif opcode == OP_SUB:
+		return diff
+	elif opcode == OP_GTR:
+		return 1 if (diff & 0x8000) == 0 and diff != 0 else 0
+	elif opcode == OP_GTE:
+		return 1 if (diff & 0x8000) == 0 else 0
+	elif opcode == OP_EQ:
+		return 1 if diff == 0 else 0
+	elif opcode == OP_NEQ:
+		return 1 if diff != 0 else 0
+	elif opcode == OP_AND:
+		return op0 & op1
+	elif opcode == OP_OR:
+		return op0 | op1
+	elif opcode == OP_XOR:
+		return op0 ^ op1
+	elif opcode == OP_LSHIFT:
+		return (op0 << op1) & 0xffff if op1 < 16 else 0
+	elif opcode == OP_RSHIFT:
+		return op0 >> op1 if op1 < 16 else 0
+	else:
+		raise Exception('not an ALU operation: ' + str(opcode))
+
+class Simulator:
+	def __init__(self, program, memSize=MEM_SIZE, data=None):
+		self.rom = [ 0 for x in range(0x10000) ]
+		self.rom[:len(program)] = program
+		self.memSize = memSize
+		self.memory = [ 0 for x in range(0x10000) ]
+		if data:
+			self.memory[:len(data)] = data		# Initial contents (data.hex)
+		self.output = []
+		self.outputStream = None	# If set, register writes are printed immediately
+
+		# Reset state from lisp_core.v
+		self.ip = 0
+		self.sp = (memSize - 8) & 0xffff
+		self.bp = (memSize - 4) & 0xffff
+		self.tos = 0
+		self.halted = False
+		self.cycles = 0
+		self.stateCycles = [ 0 for x in STATE_NAMES ]
+		self.instructionCount = 0
+
+	#
+	# Called when the program writes to a hardware register.  The default
+	# behavior mimics testbench.v.
+	#
+	def writeRegister(self, index, value):
+		if index == 0:
+			text = chr(value & 0xff)
+		else:
+			text = 'set register %4d <= %5d\n' % (index, value)
+
+		if self.outputStream:
+			self.outputStream.write(text)
+		else:
+			self.output += [ text ]
+
+	# testbench.v always returns zero for register reads
+	def readRegister(self, index):
+		return 0
+
+	def getOutput(self):
+		return ''.join(self.output)
+
+	def getStateCycles(self):
+		return dict(zip(STATE_NAMES, self.stateCycles))
+
+	#
+	# The core cannot write its own instruction memory, but callers of the
+	# simulator may patch the program between (or during) runs.
+	#
+	def writeCode(self, address, word):
+		self.rom[address & 0xffff] = word
+
+	def readMemory(self, address):
+		if (address & REGISTER_BASE) == REGISTER_BASE:
+			return self.readRegister(address & 0xfff) & 0xffff
+		else:
+			return self.memory[address]
+
+	def writeMemory(self, address, value):
+		if (address & REGISTER_BASE) == REGISTER_BASE:
+			self.writeRegister(address & 0xfff, value & 0xffff)
+		else:
+			self.memory[address] = value
+
+	#
+	# Run until the program halts or maxCycles have elapsed.  The program is
+	# considered to be halted when it reaches a goto that branches to itself,
+	# which the compiler places at the end of main.  Execution always stops at
+	# an instruction boundary, so this may run a few cycles past maxCycles.
+	#
+	def run(self, maxCycles=DEFAULT_MAX_CYCLES):
+		while not self.halted and self.cycles < maxCycles:
+			self.step()
+
+		return self.halted
+
+	def step(self):
+		rom = self.rom
+		mem = self.memory
+		ip = self.ip
+		sp = self.sp
+		bp = self.bp
+		tos = self.tos
+
+		word = rom[ip]
+		op = word >> 16
+		param = word & 0xffff
+		nextIp = (ip + 1) & 0xffff
+
+		if op == OP_PUSH:
+			sp = (sp - 1) & 0xffff
+			mem[sp] = tos
+			tos = param
+		elif op == OP_GETLOCAL:
+			sp = (sp - 1) & 0xffff
+			mem[sp] = tos
+			tos = mem[(bp + param) & 0xffff]
+		elif op == OP_SETLOCAL:
+			mem[(bp + param) & 0xffff] = tos
+		elif op == OP_POP:
+			tos = mem[sp]
+			sp = (sp + 1) & 0xffff
+		elif op == OP_BFALSE:
+			if (tos & 0xffff) == 0:
+				nextIp = param
+
+			tos = mem[sp]
+			sp = (sp + 1) & 0xffff
+		elif op == OP_GOTO:
+			if param == ip:
+				self.halted = True
+				return
+
+			nextIp = param
+		elif op == OP_LOAD:
+			tos = self.readMemory(tos & 0xffff)
+		elif op == OP_REST:
+			tos = self.readMemory((tos + 1) & 0xffff)
+		elif op == OP_STORE:
+			value = mem[sp]
+			self.writeMemory(tos & 0xffff, value)
+			tos = value
+			sp = (sp + 1) & 0xffff
+		elif op == OP_CALL:
+			sp = (sp - 1) & 0xffff
+			mem[sp] = bp
+			bp = sp
+			nextIp = tos & 0xffff
+			tos = (ip + 1) & 0xffff
+		elif op == OP_RETURN:
+			nextIp = mem[(bp - 1) & 0xffff] & 0xffff
+			sp = (bp + 1) & 0xffff
+			bp = mem[bp] & 0xffff
+		elif op == OP_RESERVE:
+			if param != 0:
+				mem[(sp - 1) & 0xffff] = tos
+				sp = (sp - param) & 0xffff
+		elif op == OP_CLEANUP:
+			sp = (sp + param) & 0xffff
+		elif op == OP_DUP:
+			sp = (sp - 1) & 0xffff
+			mem[sp] = tos
+		elif op == OP_GETTAG:
+			tos = (tos >> 16) & 7
+		elif op == OP_SETTAG:
+			tos = ((mem[sp] & 7) << 16) | (tos & 0xffff)
+			sp = (sp + 1) & 0xffff
+		elif op == OP_GETBP:
+			sp = (sp - 1) & 0xffff
+			mem[sp] = tos
+			tos = bp
+		elif op in ALU_OPS:
+			tos = (tos & 0x70000) | aluOp(op, tos, mem[sp])
+			sp = (sp + 1) & 0xffff
+
+		# else: NOP or unknown instruction
+
+		for state in getInstructionStates(op):
+			self.stateCycles[state] += 1
+			self.cycles += 1
+
+		self.instructionCount += 1
+		self.ip = nextIp
+		self.sp = sp
+		self.bp = bp
+		self.tos = tos
+
+ALU_OPS = frozenset([ OP_ADD, OP_SUB, OP_GTR, OP_GTE, OP_EQ, OP_NEQ, OP_AND,
+	OP_OR, OP_XOR, OP_LSHIFT, OP_RSHIFT ])
+
+#
+# A basic block is a straight line sequence of instructions that ends with a
+# goto, bfalse, call, or return.  It is translated into a python function
+# that takes the machine state on entry (sp, bp, tos) and returns the state
+# on exit as (ip, sp, bp, tos).
+#
+class Block:
+	def __init__(self, start):
+		self.start = start
+		self.end = start		# Address after the last instruction
+		self.function = None	# None means this is the halt loop
+		self.source = None
+		self.cycles = 0
+		self.stateCycles = [ 0 for x in STATE_NAMES ]
+		self.numInstructions = 0
+		self.executionCount = 0
+
+def toSigned(value):
+	if value & 0x8000:
+		return value - 0x10000
+	else:
+		return value
+
+#
+# Converts a basic block into python source.  The stack pointer only moves by
+# constant amounts within a block, so every stack access is turned into an
+# access at a fixed offset from the stack pointer on entry.  Values that are
+# pushed and popped within the block are kept in python variables rather than
+# being read back from memory.  The memory writes still happen so the memory
+# image is the same as it would be on hardware.
+#
+class BlockTranslator:
+	MAX_BLOCK_LENGTH = 256
+
+	def __init__(self, rom):
+		self.rom = rom
+
+	def translate(self, start):
+		block = Block(start)
+		self.lines = []
+		self.numTemps = 0
+		self.clean = set([ 'bp' ])	# Variables known to have a zero tag
+		self.known = {}		# sp offset -> variable holding that stack slot
+		self.spOffset = 0
+		self.tos = 'tos'
+		nextIp = bp = sp = None
+
+		ip = start
+		while True:
+			word = self.rom[ip]
+			op = word >> 16
+			param = word & 0xffff
+			if block.numInstructions > 0 and ((op == OP_GOTO and param == ip)
+				or block.numInstructions == self.MAX_BLOCK_LENGTH):
+				# Leave the halt loop for the next block, which will detect it.
+				nextIp = ip
+				break
+
+			for state in getInstructionStates(op):
+				block.stateCycles[state] += 1
+				block.cycles += 1
+
+			block.numInstructions += 1
+			ip = (ip + 1) & 0xffff
+			if op == OP_GOTO:
+				nextIp = param
+				break
+			elif op == OP_BFALSE:
+				cond = self.low(self.tos)
+				self.tos = self.readNextOnStack()
+				self.spOffset += 1
+				if isinstance(cond, int):
+					nextIp = param if cond == 0 else ip
+				else:
+					nextIp = '%d if %s == 0 else %d' % (param, cond, ip)
+
+				break
+			elif op == OP_CALL:
+				self.emit('mem[%s] = bp' % self.stackSlot(-1))
+				sp = bp = self.stackAddress(-1)
+				nextIp = self.low(self.tos)
+				self.tos = ip
+				break
+			elif op == OP_RETURN:
+				nextIp = 'mem[%s] & 0xffff' % self.frameSlot(-1)
+				sp = '(bp + 1) & 0xffff'
+				bp = 'mem[bp] & 0xffff'
+				break
+
+			self.translateInstruction(op, param)
+
+		if isinstance(nextIp, int):
+			nextIp = str(nextIp)
+
+		if sp is None:
+			sp = self.stackAddress(0)
+
+		block.end = ip
+		block.source = ('def block_%d(sp, bp, tos, mem, sim):\n' % start
+			+ ''.join([ '\t' + line + '\n' for line in self.lines ])
+			+ '\treturn %s, %s, %s, %s\n' % (nextIp, sp, bp or 'bp', self.tos))
+		namespace = {}
+		exec(compile(block.source, '<block %d>' % start, 'exec'), namespace)
+		block.function = namespace['block_%d' % start]
+		return block
+
+	def translateInstruction(self, op, param):
+		if op == OP_PUSH:
+			self.push(param)
+		elif op == OP_GETLOCAL:
+			# The push happens before the read, which matters if the local is
+			# in the slot that was just written.
+			self.push(None)
+			self.tos = self.temp('mem[%s]' % self.frameSlot(toSigned(param)))
+		elif op == OP_SETLOCAL:
+			self.emit('mem[%s] = %s' % (self.frameSlot(toSigned(param)), self.tos))
+			self.known = {}
+		elif op == OP_POP:
+			self.tos = self.readNextOnStack()
+			self.spOffset += 1
+		elif op == OP_LOAD or op == OP_REST:
+			if op == OP_LOAD:
+				address = self.low(self.tos)
+			elif isinstance(self.tos, int):
+				address = (self.tos + 1) & 0xffff
+			else:
+				address = '(%s + 1) & 0xffff' % self.tos
+
+			if isinstance(address, int):
+				if address < REGISTER_BASE:
+					self.tos = self.temp('mem[%d]' % address)
+				else:
+					self.tos = self.temp('sim.readMemory(%d)' % address)
+			else:
+				address = self.temp(address)
+				self.tos = self.temp('mem[%s] if %s < 0x%x else sim.readMemory(%s)'
+					% (address, address, REGISTER_BASE, address))
+		elif op == OP_STORE:
+			value = self.readNextOnStack()
+			address = self.low(self.tos)
+			if isinstance(address, int):
+				if address < REGISTER_BASE:
+					self.emit('mem[%d] = %s' % (address, value))
+				else:
+					self.emit('sim.writeMemory(%d, %s)' % (address, value))
+			else:
+				address = self.temp(address)
+				self.emit('if %s < 0x%x: mem[%s] = %s' % (address, REGISTER_BASE, address, value))
+				self.emit('else: sim.writeMemory(%s, %s)' % (address, value))
+
+			self.tos = value
+			self.spOffset += 1
+			self.known = {}		# The store may have overwritten a stack slot
+		elif op == OP_RESERVE:
+			if param != 0:
+				self.writeStackSlot(-1, self.tos)
+				self.spOffset -= toSigned(param)
+		elif op == OP_CLEANUP:
+			self.spOffset += toSigned(param)
+		elif op == OP_DUP:
+			self.writeStackSlot(-1, self.tos)
+			self.spOffset -= 1
+		elif op == OP_GETTAG:
+			if isinstance(self.tos, int):
+				self.tos = (self.tos >> 16) & 7
+			else:
+				self.tos = self.temp('(%s >> 16) & 7' % self.tos, True)
+		elif op == OP_SETTAG:
+			tag = self.readNextOnStack()
+			self.spOffset += 1
+			if isinstance(tag, int) and isinstance(self.tos, int):
+				self.tos = ((tag & 7) << 16) | (self.tos & 0xffff)
+			else:
+				self.tos = self.temp('((%s & 7) << 16) | %s' % (tag, self.low(self.tos)))
+		elif op == OP_GETBP:
+			self.push('bp')
+		elif op in ALU_OPS:
+			self.translateAluOp(op)
+
+		# else: NOP or unknown instruction
+
+	def translateAluOp(self, op):
+		op0 = self.low(self.tos)
+		op1 = self.low(self.readNextOnStack())
+		self.spOffset += 1
+		if isinstance(op0, int) and isinstance(op1, int):
+			self.tos = (self.tos & 0x70000) | aluOp(op, op0, op1)
+			return
+
+		if op == OP_ADD:
+			expr = '(%s + %s) & 0xffff' % (op0, op1)
+		elif op == OP_SUB:
+			expr = '(%s - %s) & 0xffff' % (op0, op1)
+		elif op == OP_GTR:
+			expr = '1 if 0 < ((%s - %s) & 0xffff) < 0x8000 else 0' % (op0, op1)
+		elif op == OP_GTE:
+			expr = '1 if ((%s - %s) & 0xffff) < 0x8000 else 0' % (op0, op1)
+		elif op == OP_EQ:
+			expr = '1 if %s == %s else 0' % (op0, op1)
+		elif op == OP_NEQ:
+			expr = '1 if %s != %s else 0' % (op0, op1)
+		elif op == OP_AND:
+			expr = '%s & %s' % (op0, op1)
+		elif op == OP_OR:
+			expr = '%s | %s' % (op0, op1)
+		elif op == OP_XOR:
+			expr = '%s ^ %s' % (op0, op1)
+		elif op == OP_LSHIFT:
+			expr = '(%s << %s) & 0xffff if %s < 16 else 0' % (op0, op1, op1)
+		elif op == OP_RSHIFT:
+			expr = '%s >> %s' % (op0, op1)
+
+		# The result keeps the tag of TOS, which may be a constant that was
+		# folded from a settag.
+		if isinstance(self.tos, int) and self.tos & 0x70000:
+			self.tos = self.temp('0x%x | (%s)' % (self.tos & 0x70000, expr))
+		elif isinstance(self.tos, int) or self.tos in self.clean:
+			self.tos = self.temp(expr, True)
+		else:
+			self.tos = self.temp('(%s & 0x70000) | (%s)' % (self.tos, expr))
+
+	def emit(self, line):
+		self.lines += [ line ]
+
+	def temp(self, expr, clean=False):
+		name = 't%d' % self.numTemps
+		self.numTemps += 1
+		self.emit(name + ' = ' + expr)
+		if clean:
+			self.clean.add(name)
+
+		return name
+
+	# Low 16 bits of a value, as a constant or an expression
+	def low(self, value):
+		if isinstance(value, int):
+			return value & 0xffff
+		elif value in self.clean:
+			return value
+		else:
+			return '(%s & 0xffff)' % value
+
+	# Expression to index the memory array at an offset from the current
+	# stack pointer.  Negative indices wrap around to the top of the
+	# (64k entry) memory array, which matches the 16 bit address arithmetic.
+	def stackSlot(self, offset):
+		offset += self.spOffset
+		if offset == 0:
+			return 'sp'
+		elif offset < 0 and offset > -0x10000:
+			return 'sp - %d' % -offset
+		else:
+			return '(sp + %d) & 0xffff' % offset
+
+	# Same as stackSlot, but always a valid 16 bit address
+	def stackAddress(self, offset):
+		offset += self.spOffset
+		if offset == 0:
+			return 'sp'
+		else:
+			return '(sp + %d) & 0xffff' % offset
+
+	def frameSlot(self, offset):
+		if offset == 0:
+			return 'bp'
+		elif offset < 0:
+			return 'bp - %d' % -offset
+		else:
+			return '(bp + %d) & 0xffff' % offset
+
+	def writeStackSlot(self, offset, value):
+		self.emit('mem[%s] = %s' % (self.stackSlot(offset), value))
+		self.known[self.spOffset + offset] = value
+
+	def readNextOnStack(self):
+		if self.spOffset in self.known:
+			return self.known[self.spOffset]
+		else:
+			return self.temp('mem[%s]' % self.stackSlot(0))
+
+	def push(self, value):
+		self.writeStackSlot(-1, self.tos)
+		self.spOffset -= 1
+		self.tos = value
+
+#
+# Executes the program by translating each basic block into a python function
+# the first time it is reached.  This produces exactly the same results and
+# cycle counts as Simulator, but runs much faster.
+#
+class TranslatingSimulator(Simulator):
+	def __init__(self, program, memSize=MEM_SIZE, data=None):
+		Simulator.__init__(self, program, memSize, data)
+		self.translator = BlockTranslator(self.rom)
+		self.blocks = {}
+
+	def writeCode(self, address, word):
+		Simulator.writeCode(self, address, word)
+		self.accumulateBlockStats()
+		address &= 0xffff
+		for block in list(self.blocks.values()):
+			if block.start <= address < block.end or block.start == address:
+				del self.blocks[block.start]
+
+	def getBlock(self, ip):
+		word = self.rom[ip]
+		if (word >> 16) == OP_GOTO and (word & 0xffff) == ip:
+			block = Block(ip)	# Halt loop
+			block.end = ip + 1
+		else:
+			block = self.translator.translate(ip)
+
+		self.blocks[ip] = block
+		return block
+
+	def run(self, maxCycles=DEFAULT_MAX_CYCLES):
+		blocks = self.blocks
+		mem = self.memory
+		ip = self.ip
+		sp = self.sp
+		bp = self.bp
+		tos = self.tos
+		cycles = self.cycles
+		while not self.halted:
+			block = blocks.get(ip)
+			if block is None:
+				block = self.getBlock(ip)
+
+			if block.function is None:
+				self.halted = True
+				break
+
+			if cycles + block.cycles > maxCycles:
+				break
+
+			ip, sp, bp, tos = block.function(sp, bp, tos, mem, self)
+			block.executionCount += 1
+			cycles += block.cycles
+
+		self.ip = ip
+		self.sp = sp
+		self.bp = bp
+		self.tos = tos
+		self.cycles = cycles
+		self.accumulateBlockStats()
+
+		# Run the remaining cycles one instruction at a time so execution
+		# stops at the same point the interpreter would.
+		return Simulator.run(self, maxCycles)
+
+	def accumulateBlockStats(self):
+		for block in self.blocks.values():
+			if block.executionCount:
+				for state, count in enumerate(block.stateCycles):
+					self.stateCycles[state] += count * block.executionCount
+
+				self.instructionCount += block.numInstructions * block.executionCount
+				block.executionCount = 0
+
+def main():
+	parser = argparse.ArgumentParser(description='Run a compiled program without the RTL simulator')
+	parser.add_argument('hexfile', nargs='?', default='program.hex')
+	parser.add_argument('--data', default='data.hex',
+		help='initial data memory contents, ignored if the file does not exist')
+	parser.add_argument('--cycles', type=int, default=DEFAULT_MAX_CYCLES,
+		help='maximum number of clock cycles to simulate')
+	parser.add_argument('--stats', action='store_true',
+		help='print the number of cycles spent in each core state')
+	parser.add_argument('--interpret', action='store_true',
+		help='decode one instruction at a time instead of translating basic blocks')
+	args = parser.parse_args()
+
+	program = loadHexFile(args.hexfile)
+	data = loadHexFile(args.data) if os.path.exists(args.data) else None
+	if args.interpret:
+		sim = Simulator(program, data=data)
+	else:
+		sim = TranslatingSimulator(program, data=data)
+
+	sim.outputStream = sys.stdout
+	sim.run(args.cycles)
+	sys.stdout.flush()
+	if args.stats:
+		sys.stderr.write('\n%d instructions, %d cycles%s\n' % (sim.instructionCount,
+			sim.cycles, ' (halted)' if sim.halted else ''))
+		for name, count in zip(STATE_NAMES, sim.stateCycles):
+			sys.stderr.write('  %-16s %d\n' % (name, count))
+
+if __name__ == '__main__':
+	main()
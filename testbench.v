@@ -29,6 +29,7 @@ module testbench;
 	wire				register_write;
 	wire[15:0]			register_write_value;
 	reg[15:0]			register_read_value = 0;
+	integer				cycle_count = 0;
 	
 	ulisp l(
 		.clk(clk),
@@ -45,8 +46,13 @@ module testbench;
 		#5 reset = 1;
 		#5 reset = 0;
 
-		$dumpfile("trace.vcd");
-		$dumpvars(100, l);
+		// Waveform dumping is slow and creates large files, so only do it
+		// when requested with 'vvp sim.vvp +vcd'
+		if ($test$plusargs("vcd"))
+		begin
+			$dumpfile("trace.vcd");
+			$dumpvars(100, l);
+		end
 
 		for (i = 0; i < 400000; i = i + 1)
 		begin
@@ -58,6 +64,23 @@ module testbench;
 		end
 	end
 	
+	always @(posedge clk)
+		cycle_count <= cycle_count + 1;
+
+	// The compiler puts a goto to itself at the end of the program.  Once the
+	// core reaches it, nothing else can happen, so stop the simulation.  The
+	// first clock after reset only fetches the first instruction, so it is not
+	// included in the cycle count.
+	always @(negedge clk)
+	begin
+		if (!reset && l.c.state == l.c.STATE_DECODE && l.c.opcode == l.c.OP_GOTO
+			&& l.c.param == l.c.instruction_pointer)
+		begin
+			$fdisplay(32'h8000_0002, "halted after %0d cycles", cycle_count - 1);
+			$finish;
+		end
+	end
+
 	always @(posedge clk)
 	begin	
 		if (register_write)
@@ -0,0 +1,66 @@
+; 
+; Copyright 2011-2015 Jeff Bush
+; 
+; Licensed under the Apache License, Version 2.0 (the "License");
+; you may not use this file except in compliance with the License.
+; You may obtain a copy of the License at
+; 
+;     http://www.apache.org/licenses/LICENSE-2.0
+; 
+; Unless required by applicable law or agreed to in writing, software
+; distributed under the License is distributed on an "AS IS" BASIS,
+; WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+; See the License for the specific language governing permissions and
+; limitations under the License.
+; 
+
+;
+; Quoted lists and strings are placed in the data segment by the compiler
+; rather than being built with cons when the program runs.
+;
+
+; Identical constants share storage, as do common tails.
+(print (if (= "abc" "abc") 1 0)) ; CHECK: 1
+(print (if (= (rest "xabc") "abc") 1 0)) ; CHECK: 1
+(print (if (= '(1 2) '(1 2)) 1 0)) ; CHECK: 1
+(print (if (= '(1 2) '(1 3)) 1 0)) ; CHECK: 0
+(print '(1 (2 3) "de")) ; CHECK: \(1 \(2 3\) \(34 100 101 34\)\)
+(assign pair '(4 . 5))
+(print (first pair)) ; CHECK: 4
+(print (rest pair)) ; CHECK: 5
+
+; Lists on the heap can point to constants.  Run the garbage collector, then
+; reuse the cells it freed, and make sure the constants and the lists that
+; point to them are intact.
+(assign saved (cons 7 '(8 9)))
+(assign nested (cons '(10 11) nil))
+(for i 0 20 1
+	(cons i i))
+
+($gc)
+(for i 0 40 1
+	(cons 99 99))
+
+(print saved) ; CHECK: \(7 8 9\)
+(print nested) ; CHECK: \(\(10 11\)\)
+($printstr "done") ; CHECK: done
+
+; Constant cells can be changed to point to lists on the heap, so the garbage
+; collector must treat them as roots.
+(assign changed '(12 13))
+(store changed (cons 55 (cons 66 nil)))
+(for i 0 2 1
+	(begin
+		($gc)
+		(for j 0 40 1
+			(cons j j))))
+
+(print changed) ; CHECK: \(\(55 66\) 13\)
+
+; The copying collector must update the pointer in the constant when it moves
+; the list.
+(assign also-changed '(14 15))
+(assign kept (cons 77 nil))
+(store also-changed kept)
+($gc)
+(print (if (= (first also-changed) kept) 1 0)) ; CHECK: 1
@@ -0,0 +1,89 @@
+; 
+; Copyright 2011-2015 Jeff Bush
+; 
+; Licensed under the Apache License, Version 2.0 (the "License");
+; you may not use this file except in compliance with the License.
+; You may obtain a copy of the License at
+; 
+;     http://www.apache.org/licenses/LICENSE-2.0
+; 
+; Unless required by applicable law or agreed to in writing, software
+; distributed under the License is distributed on an "AS IS" BASIS,
+; WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+; See the License for the specific language governing permissions and
+; limitations under the License.
+; 
+
+; Values computed more than once are reused
+
+(assign cell (cons 5 7))
+(assign scale 3)
+
+; Both operands are the same, so the value is duplicated on the stack
+(function double-first (node)
+	(+ (first node) (first node)))
+
+(print (double-first cell))
+($printchar 32)
+
+; Reused from a local variable later
+(function spread (node)
+	(let ((a (+ (first node) (rest node))))
+		(- (lshift (+ (first node) (rest node)) 2) a)))
+
+(print (spread cell))
+($printchar 32)
+
+; A store between the reads changes the value in memory
+(function bump-first (node)
+	(let ((old (first node)))
+		(store node (+ (first node) 1))
+		(+ (lshift old 4) (first node))))
+
+(print (bump-first cell))
+($printchar 32)
+
+; A function call may change memory and globals
+(function set-scale (value)
+	(assign scale value))
+
+(function call-between (node)
+	(let ((before (+ (first node) scale)))
+		(set-scale 10)
+		(- (+ (first node) scale) before)))
+
+(print (call-between cell))
+($printchar 32)
+
+; Assigning a variable changes values that use it
+(function assign-between (x)
+	(let ((y (lshift x 2)))
+		(assign x (+ x 1))
+		(+ (lshift x 2) y)))
+
+(print (assign-between (rest cell)))
+($printchar 32)
+
+; Values computed in only one branch of an if aren't reused after it
+(function branches (node flag)
+	(let ((total 0))
+		(if flag
+			(assign total (lshift (first node) 1)))
+		(+ total (lshift (first node) 1))))
+
+(print (branches cell 1))
+($printchar 32)
+(print (branches cell 0))
+($printchar 32)
+
+; Values in a loop are computed again each iteration
+(function sum-firsts (lst)
+	(let ((total 0))
+		(while lst
+			(assign total (+ total (bitwise-and (first lst) (first lst))))
+			(assign lst (rest lst)))
+		total))
+
+(print (sum-firsts '(1 2 3 4)))
+
+; CHECK: 10 36 86 7 60 24 12 10
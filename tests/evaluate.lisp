@@ -0,0 +1,97 @@
+; 
+; Copyright 2011-2015 Jeff Bush
+; 
+; Licensed under the Apache License, Version 2.0 (the "License");
+; you may not use this file except in compliance with the License.
+; You may obtain a copy of the License at
+; 
+;     http://www.apache.org/licenses/LICENSE-2.0
+; 
+; Unless required by applicable law or agreed to in writing, software
+; distributed under the License is distributed on an "AS IS" BASIS,
+; WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+; See the License for the specific language governing permissions and
+; limitations under the License.
+; 
+
+;
+; Calls to functions without side effects with constant arguments are
+; evaluated by the compiler.  The results must be the same as if the calls
+; were made when the program runs.
+;
+
+(function fib (n)
+	(if (< n 2)
+		n
+		(+ (fib (- n 1)) (fib (- n 2)))))
+
+(print (fib 10)) ; CHECK: 55
+
+; Results wrap to 16 bits
+(function square (x)
+	(* x x))
+
+(print (square 300)) ; CHECK: 24464
+(print (square 200)) ; CHECK: -25536
+
+; Comparisons subtract the operands, so they wrap too
+(function less (a b)
+	(< a b))
+
+(print (less 30000 -30000)) ; CHECK: 1
+
+(function count-up (limit)
+	(let ((i 0) (total 0))
+		(while (< i limit)
+			(if (= i 7)
+				(break total))
+
+			(assign total (+ total i))
+			(assign i (+ i 1)))))
+
+(print (count-up 100)) ; CHECK: 21
+(print (count-up 5)) ; CHECK: 0
+
+; Assigns a global variable, so this must be called when the program runs.
+(assign counter 0)
+(function bump (n)
+	(assign counter (+ counter n)))
+
+(bump 2)
+(bump 3)
+(print counter) ; CHECK: 5
+
+; Takes too many steps to evaluate while compiling
+(function slow-count (n)
+	(let ((count 0))
+		(while (> n 0)
+			(assign count (+ count 1))
+			(assign n (- n 1)))
+		count))
+
+(print (slow-count 2000)) ; CHECK: 2000
+
+; Operands and arguments are evaluated in the same order as the compiled
+; code, which matters when they assign a local variable.  The second operand
+; of a primitive is evaluated first, except for < and <=, and arguments are
+; evaluated from last to first.
+(function assign-in-operand (x)
+	(let ((a x))
+		(+ (assign a 5) a)))
+
+(print (assign-in-operand 1)) ; CHECK: 6
+
+(function assign-in-less (x)
+	(let ((a x))
+		(< a (assign a 5))))
+
+(print (assign-in-less 1)) ; CHECK: 1
+
+(function difference (a b)
+	(- a b))
+
+(function assign-in-argument (x)
+	(let ((a x))
+		(difference a (assign a 5))))
+
+(print (assign-in-argument 1)) ; CHECK: 0
@@ -0,0 +1,55 @@
+; 
+; Copyright 2011-2015 Jeff Bush
+; 
+; Licensed under the Apache License, Version 2.0 (the "License");
+; you may not use this file except in compliance with the License.
+; You may obtain a copy of the License at
+; 
+;     http://www.apache.org/licenses/LICENSE-2.0
+; 
+; Unless required by applicable law or agreed to in writing, software
+; distributed under the License is distributed on an "AS IS" BASIS,
+; WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+; See the License for the specific language governing permissions and
+; limitations under the License.
+; 
+
+;
+; The garbage collector marks with a fixed size stack.  These structures are
+; too big for it, so it has to rescan the heap to find everything.
+;
+
+; Nested 100 deep through first
+(assign deep nil)
+(for i 0 100 1
+	(assign deep (cons deep i)))
+
+; More pointers than will fit on the mark stack
+(assign vec (make-vector 40))
+(for i 0 40 1
+	(vector-set! vec i (cons i nil)))
+
+(for i 0 40 1
+	(cons i i))
+
+($gc)
+
+; Reuse the freed cells
+(for i 0 40 1
+	(cons 0 0))
+
+(assign depth 0)
+(assign total 0)
+(while deep
+	(assign total (+ total (rest deep)))
+	(assign depth (+ depth 1))
+	(assign deep (first deep)))
+
+(print depth)	; CHECK: 100
+(print total)	; CHECK: 4950
+
+(assign total 0)
+(for i 0 40 1
+	(assign total (+ total (first (vector-ref vec i)))))
+
+(print total)	; CHECK: 780
@@ -0,0 +1,55 @@
+; 
+; Copyright 2011-2015 Jeff Bush
+; 
+; Licensed under the Apache License, Version 2.0 (the "License");
+; you may not use this file except in compliance with the License.
+; You may obtain a copy of the License at
+; 
+;     http://www.apache.org/licenses/LICENSE-2.0
+; 
+; Unless required by applicable law or agreed to in writing, software
+; distributed under the License is distributed on an "AS IS" BASIS,
+; WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+; See the License for the specific language governing permissions and
+; limitations under the License.
+; 
+
+;
+; The copying garbage collector moves objects, so the compiler can't keep the
+; address of a vector element in a local variable across a call, and the
+; garbage collector must ignore such addresses on the stack.  Each call to
+; $gc moves the vectors to the other half of the heap.
+;
+
+; The address v + 3 is the same on every iteration, but must not be computed
+; before the loop.  The last store is made after an odd number of
+; collections, when v is in the other half from where it started.
+(let ((v (make-vector 3)) (i 0))
+	(while (< i 3)
+		($gc)
+		(vector-set! v 1 (cons i nil))
+		(assign i (+ i 1)))
+
+	(print v))	; CHECK: #\(0 \(2\) 0\)
+
+; The address of element i must not be reused after the call.
+(function set-twice (v i)
+	(vector-set! v i 7)
+	($gc)
+	(vector-set! v i 8))
+
+(let ((v (make-vector 4)))
+	(set-twice v 1)
+	(print v))	; CHECK: #\(0 8 0 0\)
+
+; The parameter is the address of an element, which has the same tag as a
+; pointer to a vector.  The garbage collector must not treat it as one.
+(function collect-with (ptr)
+	($gc)
+	ptr)
+
+(let ((v (make-vector 4)) (w (make-vector 8)))
+	(vector-set! v 1 5)
+	(collect-with (+ (+ v 2) 1))
+	(print v)	; CHECK: #\(0 5 0 0\)
+	(print (gettag (vector-ref v 1))))	; CHECK: 0
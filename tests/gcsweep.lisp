@@ -0,0 +1,70 @@
+; 
+; Copyright 2011-2015 Jeff Bush
+; 
+; Licensed under the Apache License, Version 2.0 (the "License");
+; you may not use this file except in compliance with the License.
+; You may obtain a copy of the License at
+; 
+;     http://www.apache.org/licenses/LICENSE-2.0
+; 
+; Unless required by applicable law or agreed to in writing, software
+; distributed under the License is distributed on an "AS IS" BASIS,
+; WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+; See the License for the specific language governing permissions and
+; limitations under the License.
+; 
+
+;
+; The heap is swept a little at a time after each garbage collection.  Copy
+; a list over and over, so some copies are made from cells that haven't been
+; swept yet, then make sure the list survives later collections.
+;
+
+; Storing to a live cell that hasn't been swept yet must not free it.  The
+; kept cells are marked, then changed before make-vector finishes the sweep.
+(for i 0 5 1
+	(cons i i))
+
+(assign kept nil)
+(for i 0 5 1
+	(assign kept (cons i kept)))
+
+($gc)
+(let ((cell kept))
+	(while cell
+		(store cell 7)
+		(assign cell (rest cell))))
+
+(make-vector 0)
+(for i 0 10 1
+	(cons i i))
+
+(assign total 0)
+(foreach x kept
+	(assign total (+ total x)))
+
+(print (length kept))
+($printchar 32)
+(print total)	; CHECK: 5 35
+
+; Make the heap small so this has to garbage collect several times.
+(assign $max-heap (+ $wilderness-start 120))
+(assign live nil)
+(for i 0 20 1
+	(assign live (cons i live)))
+
+(for round 0 8 1
+	(let ((copy nil))
+		(foreach x live
+			(assign copy (cons x copy)))
+
+		(assign live copy)))
+
+(print live)	; CHECK: \(19 18 17 16 15 14 13 12 11 10 9 8 7 6 5 4 3 2 1 0\)
+
+; Everything above the list is garbage, so the whole top of the heap is
+; returned to the wilderness.
+(for i 0 100 1
+	(cons i i))
+
+(print live)	; CHECK: \(19 18 17 16 15 14 13 12 11 10 9 8 7 6 5 4 3 2 1 0\)
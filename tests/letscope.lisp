@@ -0,0 +1,49 @@
+; 
+; Copyright 2011-2015 Jeff Bush
+; 
+; Licensed under the Apache License, Version 2.0 (the "License");
+; you may not use this file except in compliance with the License.
+; You may obtain a copy of the License at
+; 
+;     http://www.apache.org/licenses/LICENSE-2.0
+; 
+; Unless required by applicable law or agreed to in writing, software
+; distributed under the License is distributed on an "AS IS" BASIS,
+; WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+; See the License for the specific language governing permissions and
+; limitations under the License.
+; 
+
+; Variables in sibling let blocks share stack slots, but variables that are
+; still in scope keep their values.
+
+(function siblings (n)
+	(let ((outer (+ n 1)))
+		(let ((a (+ n 2)) (b (+ n 3)))
+			(print (+ a b))
+			($printchar 32))
+		(let ((c (+ n 4)))
+			(let ((d (+ c 5)))
+				(print (- d outer))
+				($printchar 32))
+			(let ((e (+ c 6)))
+				(print (+ e outer))
+				($printchar 32)))
+		outer))
+
+(print (siblings 10))
+($printchar 32)
+
+; Both expansions of for declare __endval
+(function loops (n)
+	(let ((total 0))
+		(for i 0 n 1
+			(assign total (+ total i)))
+		(for j n 0 -1
+			(let ((sq (* j j)))
+				(assign total (+ total sq))))
+		total))
+
+(print (loops (length '(1 2 3 4))))
+
+; CHECK: 25 8 31 11 36
@@ -0,0 +1,99 @@
+; 
+; Copyright 2011-2015 Jeff Bush
+; 
+; Licensed under the Apache License, Version 2.0 (the "License");
+; you may not use this file except in compliance with the License.
+; You may obtain a copy of the License at
+; 
+;     http://www.apache.org/licenses/LICENSE-2.0
+; 
+; Unless required by applicable law or agreed to in writing, software
+; distributed under the License is distributed on an "AS IS" BASIS,
+; WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+; See the License for the specific language governing permissions and
+; limitations under the License.
+; 
+
+; Values that don't change in a loop are computed before it
+
+(assign width 10)
+(assign height 3)
+(assign counter 0)
+
+; Arithmetic on parameters and globals is moved out of the loop, including
+; the invariant part of a sum.
+(function scaled-sum (n)
+	(let ((total 0))
+		(for i 0 (- n 1) 1
+			(assign total (+ (+ total (+ width (lshift n 2))) (- i height))))
+		total))
+
+(print (scaled-sum 5))
+($printchar 32)
+
+; Globals assigned by a function called in the loop, or assigned through
+; a function pointer, are read again each iteration.
+(function bump ()
+	(assign counter (+ counter 1)))
+
+(function calls-bump (n)
+	(let ((total 0))
+		(for i 0 n 1
+			(begin
+				(bump)
+				(assign total (+ total (+ counter 100)))))
+		total))
+
+(function call-pointer (fn n)
+	(let ((total 0))
+		(for i 0 n 1
+			(begin
+				(fn)
+				(assign total (+ total (+ counter 100)))))
+		total))
+
+(print (calls-bump 3))
+($printchar 32)
+(print (call-pointer bump 3))
+($printchar 32)
+
+; Nested loops.  The inner loop's bound only depends on the outer loop's
+; parameter.
+(function nested (n)
+	(let ((total 0))
+		(for i 0 n 1
+			(for j 0 (* n 2) 1
+				(assign total (+ total (bitwise-and (+ i width) 7)))))
+		total))
+
+(print (nested 3))
+($printchar 32)
+
+; A global read in many places is copied into a local
+(function many-reads (lst)
+	(let ((total 0))
+		(foreach x lst
+			(begin
+				(if (= x width)
+					(assign total (- total (rshift width 1))))
+				(if (> x width)
+					(assign total (+ total width))
+					(if (< x (- 0 width))
+						(assign total (- total width))
+						(assign total (+ (+ total (* x width)) (- height width)))))))
+		total))
+
+(print (many-reads '(1 20 -30 10 2)))
+($printchar 32)
+
+; A loop whose condition is invariant, left with break
+(function find-first (lst limit)
+	(let ((result nil))
+		(while (> (+ limit height) 0)
+			(if (< (first lst) (+ limit height))
+				(break (first lst)))
+			(assign lst (rest lst)))))
+
+(print (find-first '(9 7 5 3) 3))
+
+; CHECK: 114 306 315 54 104 5
@@ -94,3 +94,70 @@
 
 
 
+
+;
+; Algebraic simplification.  These use variables, so they can't be folded
+; into constants.
+;
+(assign b 7)
+(assign n -13)
+(print (+ b 0)) ; CHECK: 7
+(print (+ 0 b)) ; CHECK: 7
+(print (- b 0)) ; CHECK: 7
+(print (- b b)) ; CHECK: 0
+(print (- (+ b n) b)) ; CHECK: -13
+(print (bitwise-and b 0)) ; CHECK: 0
+(print (bitwise-and -1 b)) ; CHECK: 7
+(print (bitwise-or b 0)) ; CHECK: 7
+(print (bitwise-or b -1)) ; CHECK: -1
+(print (bitwise-xor 0 b)) ; CHECK: 7
+(print (lshift b 0)) ; CHECK: 7
+(print (rshift b 0)) ; CHECK: 7
+(print (lshift b 16)) ; CHECK: 0
+
+; The result of arithmetic has the tag of the first operand, so a constant
+; first operand can't be removed if the other one is a pointer.
+(assign lst (cons 1 nil))
+(print (gettag (+ 0 lst))) ; CHECK: 0
+(print (gettag (bitwise-and -1 lst))) ; CHECK: 0
+(print (gettag (+ (+ 1 lst) 2))) ; CHECK: 0
+(print (gettag (+ lst 0))) ; CHECK: 1
+
+; Reassociating constants in add/subtract chains
+(print (+ (+ b 3) 4)) ; CHECK: 14
+(print (- (+ b 10) 3)) ; CHECK: 14
+(print (- 5 (- 2 b))) ; CHECK: 10
+(print (+ (- b 3) (+ 3 n))) ; CHECK: -6
+(print (- (- 1 b) 32767)) ; CHECK: 32763
+
+;
+; Multiplies by constants are converted to shifts and adds
+;
+(print (* b 1)) ; CHECK: 7
+(print (* b 0)) ; CHECK: 0
+(print (* b -1)) ; CHECK: -7
+(print (* b 10)) ; CHECK: 70
+(print (* n 10)) ; CHECK: -130
+(print (* 3 b)) ; CHECK: 21
+(print (* b 15)) ; CHECK: 105
+(print (* b -6)) ; CHECK: -42
+(print (* n -6)) ; CHECK: 78
+(print (* (+ b 1) 7)) ; CHECK: 56
+(print (* b 1000)) ; CHECK: 7000
+(print (* n 1000)) ; CHECK: -13000
+(print (* b 12345)) ; CHECK: 20879
+(print (* b -16)) ; CHECK: -112
+
+;
+; Divides and remainders by powers of two
+;
+(print (/ b 1)) ; CHECK: 7
+(print (/ b -1)) ; CHECK: -7
+(print (mod b 1)) ; CHECK: 0
+(print (/ (bitwise-and b 255) 4)) ; CHECK: 1
+(print (mod (bitwise-and b 255) 4)) ; CHECK: 3
+(print (/ n 4)) ; CHECK: -3
+(print (mod n 4)) ; CHECK: 1
+(print (/ b 4)) ; CHECK: 1
+(print (mod b 4)) ; CHECK: 3
+(print (mod b -4)) ; CHECK: -3
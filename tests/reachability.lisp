@@ -0,0 +1,48 @@
+; 
+; Copyright 2011-2015 Jeff Bush
+; 
+; Licensed under the Apache License, Version 2.0 (the "License");
+; you may not use this file except in compliance with the License.
+; You may obtain a copy of the License at
+; 
+;     http://www.apache.org/licenses/LICENSE-2.0
+; 
+; Unless required by applicable law or agreed to in writing, software
+; distributed under the License is distributed on an "AS IS" BASIS,
+; WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+; See the License for the specific language governing permissions and
+; limitations under the License.
+; 
+
+; Functions and globals that can't be reached from the top level code are
+; removed.  The ones that are only reached through function pointers,
+; anonymous functions, and forward references must be kept.
+
+; Only used by unused-outer, which is never called
+(function unused-inner (x)
+	(assign unused-global (+ x 1)))
+
+(function unused-outer ()
+	(unused-inner 2))
+
+; Forward reference, so the address is stored in a global
+(assign handler (function (x) (later x)))
+
+(function later (x)
+	(* x 3))
+
+(function apply (fn x)
+	(fn x))
+
+(print (apply handler 5))
+($printchar 32)
+(print (apply later 7))
+($printchar 32)
+(print (handler 2))
+
+; Only assigned, so the stores are removed, but the side effects of
+; computing the value must remain.
+(assign write-only 1)
+(assign write-only (begin ($printchar 32) (print 9) 2))
+
+; CHECK: 15 21 6 9
@@ -0,0 +1,39 @@
+; 
+; Copyright 2011-2015 Jeff Bush
+; 
+; Licensed under the Apache License, Version 2.0 (the "License");
+; you may not use this file except in compliance with the License.
+; You may obtain a copy of the License at
+; 
+;     http://www.apache.org/licenses/LICENSE-2.0
+; 
+; Unless required by applicable law or agreed to in writing, software
+; distributed under the License is distributed on an "AS IS" BASIS,
+; WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+; See the License for the specific language governing permissions and
+; limitations under the License.
+; 
+
+;
+; testbench.v returns zero for every register read, but the batch backend in
+; runtests.py also runs this with other register values and compares each
+; run with simulator.Simulator.  The loop and branches make those runs take
+; different paths through the program.
+;
+
+(let ((count (bitwise-and (read-register 1) 15))
+	(total 0))
+	(for i 0 count 1
+		(assign total (+ total (read-register 2))))
+
+	(write-register 3 total)
+	($printdec total)
+	($printchar 32)
+	(if (read-register 4)
+		($printstr "set")
+		($printstr "clear"))
+
+	($printchar 32)
+	($printhex (bitwise-xor (read-register 5) (read-register 2))))
+
+; CHECK: 0 clear 0000
@@ -1,6 +1,12 @@
 #!/usr/bin/env python
 
-import subprocess, sys, re
+import subprocess, sys, re, os, argparse, tempfile, shutil, time, multiprocessing
+
+TOP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+TEST_DIR = os.path.join(TOP_DIR, 'tests')
+sys.path.insert(0, TOP_DIR)
+import simulator
+import compile
 
 TESTS = [
 	'map-reduce.lisp',
@@ -21,77 +27,334 @@ TESTS = [
 	'hello.lisp',
 	'dict.lisp',
 	'muldiv.lisp',
-	'nth.lisp'
+	'nth.lisp',
+	'tailcall.lisp',
+	'evaluate.lisp',
+	'constants.lisp',
+	'loopinvariant.lisp',
+	'cse.lisp',
+	'letscope.lisp',
+	'reachability.lisp',
+	'stackdepth.lisp',
+	'vector.lisp',
+	'gcmark.lisp',
+	'gcsweep.lisp',
+	'gcmove.lisp',
+	'registers.lisp'
+]
+
+# Tests that are also run with other compiler options (attributes of
+# compile.CompileOptions)
+OPTION_TESTS = [
+	( 'anagram.lisp', { 'inlineCons' : True } ),
+	( 'dict.lisp', { 'inlineCons' : True } ),
+	( 'filter.lisp', { 'inlineCons' : True } ),
+	( 'map-reduce.lisp', { 'collector' : 'copying' } ),
+	( 'constants.lisp', { 'collector' : 'copying' } ),
+	( 'vector.lisp', { 'collector' : 'copying' } ),
+	( 'gcmark.lisp', { 'collector' : 'copying' } ),
+	( 'gcsweep.lisp', { 'collector' : 'copying', 'inlineCons' : True } ),
+	( 'gcmove.lisp', { 'collector' : 'copying' } )
 ]
 
+# Number of cycles the python simulator runs between checks of its output
+CYCLE_SLICE = 20000
+
+# Values returned by hardware register reads in each instance the batch
+# backend runs.  The first instance reads zero like testbench.v, so its output
+# is checked against the CHECK: lines.  Every instance is also compared with
+# simulator.Simulator given the same values.
+BATCH_REGISTER_VALUES = [
+	[ 0 ] * 16,
+	range(1, 17),
+	[ 0x8000 + index * 3 for index in range(16) ],
+	[ 0xffff ] * 16
+]
+
+#
+# Compares the program output to the CHECK: lines in the test as the output
+# is produced, so the simulation can be stopped as soon as the result is
+# known.  A pattern that matches all the way to the end of the output received
+# so far is not accepted until more output arrives (or the program finishes),
+# since it might match differently once the rest of the output is available.
+#
+class OutputChecker:
+	def __init__(self, checkFilename):
+		self.checks = []	# (line number, pattern)
+		self.output = ''
+		self.resultOffset = 0
+		f = open(checkFilename, 'r')
+		for lineNo, line in enumerate(f.readlines()):
+			chkoffs = line.find('CHECK: ')
+			if chkoffs != -1:
+				self.checks += [ (lineNo + 1, line[chkoffs + 7:].strip()) ]
+
+		f.close()
+		self.nextCheck = 0
+
+	# Returns True once all checks have matched
+	def feed(self, text):
+		self.output += text
+		self.match(False)
+		return self.nextCheck == len(self.checks)
+
+	#
+	# Called when there is no more output.  Returns None if the output matched
+	# all CHECK: lines, otherwise a message describing the failure.
+	#
+	def finish(self):
+		self.match(True)
+		if not self.checks:
+			return 'no lines with CHECK: were found'
+		elif self.nextCheck < len(self.checks):
+			lineNo, expected = self.checks[self.nextCheck]
+			return ('line ' + str(lineNo) + ' expected string ' + expected + ' was not found\n'
+				+ 'searching here:' + self.output[self.resultOffset:])
+		else:
+			return None
+
+	def match(self, isFinal):
+		while self.nextCheck < len(self.checks):
+			lineNo, expected = self.checks[self.nextCheck]
+			got = re.compile(expected).search(self.output, self.resultOffset)
+			if not got or (not isFinal and got.end() == len(self.output)):
+				return
+
+			self.resultOffset = got.end()
+			self.nextCheck += 1
+
 def checkOutput(output, checkFilename):
-    resultOffset = 0
-    lineNo = 1
-    foundCheckLines = False
-    f = open(checkFilename, 'r')
-    for line in f.readlines():
-    	chkoffs = line.find('CHECK: ')
-    	if chkoffs != -1:
-    		foundCheckLines = True
-    		expected = line[chkoffs + 7:].strip()
-    		regexp = re.compile(expected)
-    		got = regexp.search(output, resultOffset)
-    		if got:
-    			resultOffset = got.end()
-    		else:
-    			print 'FAIL: line ' + str(lineNo) + ' expected string ' + expected + ' was not found'
-    			print 'searching here:' + result[resultOffset:]
-    			return False
-			
-    	lineNo += 1
-
-    if not foundCheckLines:
-    	print 'FAIL: no lines with CHECK: were found'    
-        return False
-        
-    return True
-    
-def runtest(filename):
+	checker = OutputChecker(checkFilename)
+	checker.feed(output)
+	return checker.finish()
+
+class TestResult:
+	def __init__(self, name):
+		self.name = name
+		self.passed = False
+		self.message = None
+		self.elapsed = 0.0
+		self.cycles = None
+
+#
+# Compile and run a test.  Any files the verilog simulator needs are written
+# to workDir, so several tests can run at once.
+#
+def runtest(filename, backend, workDir, runtimeFile, optionValues):
+	result = TestResult(testName(filename, optionValues))
+
+	# Compile test
+	options = compile.CompileOptions()
+	options.runtimeFile = runtimeFile
+	for name, value in optionValues.items():
+		setattr(options, name, value)
+
+	if backend == 'verilog':
+		options.hexFilename = os.path.join(workDir, 'program.hex')
+		options.dataFilename = os.path.join(workDir, 'data.hex')
+
 	try:
-		# Compile test
-		args = [ 'python', 'compile.py', filename ]
-		process = None
-		try:
-			process = subprocess.Popen(args)
-			process.communicate()
-		except:
-			print 'compile failed'
-			if process: 
-				process.kill()
-		
-			raise
-		
-		# Run test
-		args = [ 'vvp', 'sim.vvp' ]
-		process = None
-		output = None
-		try:
-			process = subprocess.Popen(args, stdout=subprocess.PIPE)
-			output = process.communicate()[0].strip()
-		except:
-			if process:
-				process.kill()
-
-			raise
-
-		if output:
-			if checkOutput(output, filename):
-				print 'PASS'
-				
+		program = compile.compileProgram([ filename ], options)
 	except KeyboardInterrupt:
 		raise
-	except:
-		print 'FAIL: exception thrown'
+	except Exception as exc:
+		result.message = 'compile failed: ' + str(exc)
+		return result
+
+	# Run test
+	checker = OutputChecker(filename)
+	if backend == 'python':
+		runPythonSimulator(program, checker, result)
+	elif backend == 'batch':
+		result.message = runBatchSimulator(program, checker, result)
+	else:
+		runVerilogSimulator(workDir, checker, result)
+
+	if result.message is None:
+		result.message = checker.finish()
+
+	result.passed = result.message is None
+	return result
+
+def runPythonSimulator(program, checker, result):
+	sim = simulator.TranslatingSimulator(program.instructions, data=program.data)
+	while not sim.halted and sim.cycles < simulator.DEFAULT_MAX_CYCLES:
+		sim.run(min(sim.cycles + CYCLE_SLICE, simulator.DEFAULT_MAX_CYCLES))
+		done = checker.feed(sim.getOutput())
+		sim.output = []
+		if done:
+			break
+
+	result.cycles = sim.cycles
+
+#
+# simulator.Simulator with the register behavior of batchsim.BatchSimulator:
+# reads return fixed values, and writes other than to register 0 are only
+# recorded.
+#
+class RegisterSimulator(simulator.Simulator):
+	def __init__(self, program, data, registerReadValues):
+		simulator.Simulator.__init__(self, program, data=data)
+		self.registerReadValues = registerReadValues
+		self.registerWriteValues = [ 0 for value in registerReadValues ]
+
+	def readRegister(self, index):
+		if index < len(self.registerReadValues):
+			return self.registerReadValues[index]
+		else:
+			return 0
+
+	def writeRegister(self, index, value):
+		if index < len(self.registerWriteValues):
+			self.registerWriteValues[index] = value
+
+		if index == 0:
+			self.output += [ chr(value & 0xff) ]
+
+#
+# Runs several instances of the program in batchsim.BatchSimulator, each
+# reading different register values, and checks that every instance ends in
+# the same state as simulator.Simulator.  Returns a message describing the
+# first difference, or None if there were none.
+#
+def runBatchSimulator(program, checker, result):
+	import batchsim		# Requires NumPy, which the other backends do not
+
+	batch = batchsim.BatchSimulator(program.instructions, len(BATCH_REGISTER_VALUES),
+		data=program.data)
+	batch.registerReadValues[:] = BATCH_REGISTER_VALUES
+	batch.run(simulator.DEFAULT_MAX_CYCLES)
+	checker.feed(batch.getOutput(0))
+	result.cycles = int(batch.cycles[0])
+	for instance, registerReadValues in enumerate(BATCH_REGISTER_VALUES):
+		sim = RegisterSimulator(program.instructions, program.data, registerReadValues)
+		sim.run(simulator.DEFAULT_MAX_CYCLES)
+		expected = [
+			( 'output', sim.getOutput(), batch.getOutput(instance) ),
+			( 'halted', sim.halted, bool(batch.halted[instance]) ),
+			( 'cycles', sim.cycles, batch.cycles[instance] ),
+			( 'state cycles', sim.stateCycles, list(batch.stateCycles[instance]) ),
+			( 'instructions', sim.instructionCount, batch.instructionCount[instance] ),
+			( 'registers', [ sim.ip, sim.sp, sim.bp, sim.tos ], [ batch.ip[instance],
+				batch.sp[instance], batch.bp[instance], batch.tos[instance] ] ),
+			( 'register writes', sim.registerWriteValues,
+				list(batch.registerWriteValues[instance]) ),
+			( 'memory', sim.memory[:batch.memSize], list(batch.memory[instance]) )
+		]
+		for name, simValue, batchValue in expected:
+			if simValue != batchValue:
+				return ('instance %d %s differs from simulator.Simulator\n' % (instance, name)
+					+ 'expected: ' + repr(simValue)[:200] + '\ngot: ' + repr(batchValue)[:200])
+
+	return None
+
+#
+# Reads the output of vvp as it is produced and kills it once all checks have
+# matched.  testbench.v exits by itself when the program halts.
+#
+def runVerilogSimulator(workDir, checker, result):
+	args = [ 'vvp', os.path.join(TOP_DIR, 'sim.vvp') ]
+	process = subprocess.Popen(args, cwd=workDir, stdout=subprocess.PIPE,
+		stderr=subprocess.PIPE)
+	try:
+		while True:
+			text = os.read(process.stdout.fileno(), 4096)
+			if not text or checker.feed(text):
+				break
+	finally:
+		if process.poll() is None:
+			process.kill()
+
+		errors = process.communicate()[1]
+
+	got = re.search('halted after (\\d+) cycles', errors)
+	if got:
+		result.cycles = int(got.group(1))
+
+def testName(filename, optionValues):
+	return ' '.join([ os.path.basename(filename) ] + [ name if value is True
+		else name + '=' + str(value) for name, value in sorted(optionValues.items()) ])
+
+def runTestInScratchDir(params):
+	filename, backend, runtimeFile, optionValues = params
+	workDir = tempfile.mkdtemp(prefix='lisptest')
+	startTime = time.time()
+	try:
+		result = runtest(filename, backend, workDir, runtimeFile, optionValues)
+	except KeyboardInterrupt:
 		raise
+	except Exception as exc:
+		result = TestResult(testName(filename, optionValues))
+		result.message = 'exception thrown: ' + str(exc)
+	finally:
+		shutil.rmtree(workDir, ignore_errors=True)
 
-if len(sys.argv) > 1:
-	runtest('tests/' + sys.argv[1])
+	result.elapsed = time.time() - startTime
+	return result
+
+def printResult(result):
+	print '%-42s %s %7.2fs %10s' % (result.name, 'PASS' if result.passed else 'FAIL',
+		result.elapsed, '-' if result.cycles is None else str(result.cycles))
+	if result.message:
+		print '    ' + result.message.replace('\n', '\n    ')
+
+argParser = argparse.ArgumentParser()
+argParser.add_argument('test', nargs='*')
+argParser.add_argument('--backend', choices=[ 'verilog', 'python', 'batch' ], default='verilog',
+	help='run tests with the verilog model (sim.vvp), the python simulator, or '
+	+ 'batchsim.py compared against the python simulator')
+argParser.add_argument('-j', '--jobs', type=int, default=multiprocessing.cpu_count(),
+	help='number of tests to run in parallel')
+args = argParser.parse_args()
+
+startTime = time.time()
+
+if args.test:
+	tests = [ ( name, {} ) for name in args.test ]
+else:
+	tests = [ ( name, {} ) for name in TESTS ] + OPTION_TESTS
+
+# Compile the runtime library once for each garbage collector the tests use,
+# rather than for every test.
+runtimeDir = tempfile.mkdtemp(prefix='lispruntime')
+runtimeFiles = {}
+for name, optionValues in tests:
+	collector = optionValues.get('collector', compile.CompileOptions().collector)
+	if collector not in runtimeFiles:
+		runtimeFiles[collector] = os.path.join(runtimeDir, collector + compile.OBJECT_EXTENSION)
+		options = compile.CompileOptions()
+		options.collector = collector
+		options.objectFilename = runtimeFiles[collector]
+		compile.compileProgram([], options)
+
+work = [ (os.path.join(TEST_DIR, name), args.backend,
+	runtimeFiles[optionValues.get('collector', compile.CompileOptions().collector)], optionValues)
+	for name, optionValues in tests ]
+if args.jobs > 1 and len(work) > 1:
+	pool = multiprocessing.Pool(min(args.jobs, len(work)))
+	results = pool.imap(runTestInScratchDir, work)
 else:
-	for filename in TESTS:
-		print filename, 
-		runtest('tests/' + filename)
+	pool = None
+	results = map(runTestInScratchDir, work)
+
+print '%-42s %s %8s %10s' % ('test', 'result', 'time', 'cycles')
+numFailed = 0
+totalCycles = 0
+for result in results:
+	printResult(result)
+	if not result.passed:
+		numFailed += 1
+
+	if result.cycles:
+		totalCycles += result.cycles
+
+if pool:
+	pool.close()
+	pool.join()
+
+shutil.rmtree(runtimeDir, ignore_errors=True)
+
+print '\n%d tests, %d passed, %d failed, %.2fs elapsed%s' % (len(work), len(work) - numFailed,
+	numFailed, time.time() - startTime, ', %d cycles simulated' % totalCycles if totalCycles else '')
+if numFailed:
+	sys.exit(1)
@@ -0,0 +1,43 @@
+; 
+; Copyright 2011-2015 Jeff Bush
+; 
+; Licensed under the Apache License, Version 2.0 (the "License");
+; you may not use this file except in compliance with the License.
+; You may obtain a copy of the License at
+; 
+;     http://www.apache.org/licenses/LICENSE-2.0
+; 
+; Unless required by applicable law or agreed to in writing, software
+; distributed under the License is distributed on an "AS IS" BASIS,
+; WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+; See the License for the specific language governing permissions and
+; limitations under the License.
+; 
+
+;
+; The heap limit is set from the most stack the program can use.  This
+; program has no recursion (and doesn't cons, so the garbage collector isn't
+; included), so the limit is just below the deepest frame.
+;
+
+(function yes-no (value)
+	($printchar (if value 89 78)))
+
+; Nothing this function pushes may be in the heap
+(function check-frame ()
+	(yes-no (> (- (getbp) 4) $max-heap)))
+
+; Calls a function before it is defined, which goes through a global variable
+(function nested (a b)
+	(let ((x (+ a b)) (y (- a b)))
+		(+ x (+ y (later (+ x 1) (- y 1))))))
+
+(function call-with (f a b)
+	(f a b))
+
+(function later (a b)
+	(check-frame)	; CHECK: Y
+	(+ a b))
+
+(yes-no (= (call-with nested (length '(1 2 3)) 2) 12))	; CHECK: Y
+(yes-no (< (- $stacktop $max-heap) 64))	; CHECK: Y
@@ -0,0 +1,110 @@
+; 
+; Copyright 2011-2015 Jeff Bush
+; 
+; Licensed under the Apache License, Version 2.0 (the "License");
+; you may not use this file except in compliance with the License.
+; You may obtain a copy of the License at
+; 
+;     http://www.apache.org/licenses/LICENSE-2.0
+; 
+; Unless required by applicable law or agreed to in writing, software
+; distributed under the License is distributed on an "AS IS" BASIS,
+; WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+; See the License for the specific language governing permissions and
+; limitations under the License.
+; 
+
+;
+; Tail calls to other functions reuse the caller's stack frame.  Each of
+; these recurses deeply enough to overflow the stack otherwise.
+;
+
+; The innermost call has the same stack frame as the outermost.
+(function frame-address (n)
+	(if (= n 0)
+		(getbp)
+		(frame-helper (- n 1))))
+
+(function frame-helper (n)
+	(frame-address n))
+
+(assign shallow (frame-address 0))
+(assign deep (frame-address 100))
+(print (- shallow deep))
+
+; CHECK: 0
+
+; is-odd is referenced before it is defined, so it is called through a global
+; variable.  is-even is called directly.
+(function is-even (n)
+	(if (= n 0)
+		true
+		(is-odd (- n 1))))
+
+(function is-odd (n)
+	(if (= n 0)
+		false
+		(is-even (- n 1))))
+
+(print (is-even 500))
+(print (is-odd 500))
+
+; CHECK: 1
+; CHECK: 0
+
+; Call through a function pointer passed as a parameter
+(function count-down (n f total)
+	(if (= n 0)
+		total
+		(f (- n 1) f (+ total 2))))
+
+(print (count-down 500 count-down 0))
+
+; CHECK: 1000
+
+; Anonymous function stored in a global
+(assign count-up (function (n limit)
+	(if (= n limit)
+		n
+		(count-up (+ n 1) limit))))
+
+(print (count-up 0 500))
+
+; CHECK: 500
+
+; Arguments are all evaluated before any parameters are replaced.
+(function swap (a b n)
+	(if (= n 0)
+		(- a b)
+		(swap-back b a (- n 1))))
+
+(function swap-back (a b n)
+	(swap a b n))
+
+(print (swap 10 3 501))
+
+; CHECK: -7
+
+; A parameter that is passed in the same position is not copied
+(function sum-to (n total)
+	(if (= n 0)
+		total
+		(sum-helper (- n 1) (+ total 1))))
+
+(function sum-helper (n total)
+	(sum-to n total))
+
+(print (sum-to 500 0))
+
+; CHECK: 500
+
+; A recursive call with more arguments than the function has parameters is
+; a normal call.
+(function extra-args (a)
+	(if a
+		(extra-args (- a 1) a)
+		0))
+
+(print (extra-args 3))
+
+; CHECK: 0
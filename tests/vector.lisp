@@ -0,0 +1,59 @@
+; 
+; Copyright 2011-2015 Jeff Bush
+; 
+; Licensed under the Apache License, Version 2.0 (the "License");
+; you may not use this file except in compliance with the License.
+; You may obtain a copy of the License at
+; 
+;     http://www.apache.org/licenses/LICENSE-2.0
+; 
+; Unless required by applicable law or agreed to in writing, software
+; distributed under the License is distributed on an "AS IS" BASIS,
+; WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+; See the License for the specific language governing permissions and
+; limitations under the License.
+; 
+
+(assign v (make-vector 5))
+(for i 0 5 1
+	(vector-set! v i (+ i 10)))
+
+(print (vector-length v))	; CHECK: 5
+(print (vector-ref v 3))	; CHECK: 13
+(print v)	; CHECK: #\(10 11 12 13 14\)
+(print (vector? v))	; CHECK: 1
+(print (list? v))	; CHECK: 0
+(print (make-vector 0))	; CHECK: #\(\)
+
+; Strings stored in vectors
+(assign s #"vector")
+($printstr s)	; CHECK: vector
+(print (vector-length s))	; CHECK: 6
+(print (vector-ref s 1))	; CHECK: 101
+(print '(1 #"ab"))	; CHECK: \(1 #\(97 98\)\)
+(print (if (= #"ab" #"ab") 1 0))	; CHECK: 1
+
+; Vectors of lists and lists of vectors survive garbage collection, while
+; the vectors that aren't used any more are freed and the memory reused for
+; both cells and vectors.
+(assign w (make-vector 3))
+(vector-set! w 0 (cons 1 (cons 2 nil)))
+(vector-set! w 2 (cons v nil))
+(assign keep nil)
+
+; Make the heap small so the loop has to garbage collect.
+(assign $max-heap (+ $wilderness-start 300))
+(for i 0 40 1
+	(let ((temp (make-vector (+ (bitwise-and i 7) 12))))
+		(if (= (bitwise-and i 15) 5)
+			(begin
+				(vector-set! temp 2 i)
+				(assign keep (cons temp keep))))
+
+		(cons i temp)))
+
+(print w)	; CHECK: #\(\(1 2\) 0 \(#\(10 11 12 13 14\)\)\)
+(foreach k keep
+	(begin
+		(print (vector-length k))
+		(print (vector-ref k 2))))	; CHECK: 17371721175
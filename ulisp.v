@@ -65,7 +65,7 @@ module ulisp(
 		.addr_i(instr_mem_address),
 		.value_o(instr_mem_read_value));
 	
-	ram #(MEM_SIZE, 19) data_mem(
+	ram #(MEM_SIZE, 19, 16, "data.hex") data_mem(
 		.clk(clk),
 		.addr_i(data_mem_address),
 		.value_i(data_mem_write_value),